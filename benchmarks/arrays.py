@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Compare fetching numeric rows as tuples and converting them to NumPy arrays
+with fetching them directly into arrays with binary COPY.
+
+Usage: arrays.py [DSN] [ROWS]
+"""
+
+import sys
+import time
+
+import numpy
+import psycopg2
+
+from momoko.arrays import copy_to_array
+
+
+QUERY = ('SELECT i, i * 0.5::float8 AS x, random() AS y, now() AS t '
+         'FROM generate_series(1, %d) AS i')
+
+
+def tuple_path(conn, query):
+    cursor = conn.cursor()
+    cursor.execute(query)
+    rows = cursor.fetchall()
+    return numpy.array([row[:3] for row in rows], dtype=[('i', 'i4'), ('x', 'f8'), ('y', 'f8')])
+
+
+def copy_path(conn, query):
+    return copy_to_array(conn, query)
+
+
+def best_of(func, repeat=5):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    dsn = sys.argv[1] if len(sys.argv) > 1 else 'dbname=momoko'
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    conn = psycopg2.connect(dsn)
+    query = QUERY % rows
+
+    for label, func in (('tuples', tuple_path), ('copy', copy_path)):
+        seconds = best_of(lambda: func(conn, query))
+        print('%-7s %8.1f ms %10.0f rows/s' % (label, seconds * 1000, rows / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare ``DbQueryQueue.format_sql`` with the implementation it replaced and
+with keeping params bound. No database is needed.
+"""
+
+import timeit
+
+from psycopg2.extensions import adapt
+
+from momoko.queue import DbQueryQueue
+
+
+def legacy_format_sql(sql_tmpl, params=None):
+    # DbQueryQueue.format_sql before 0.4.1, params are copied because it
+    # used to modify them
+    if params:
+        if isinstance(params, dict):
+            params = dict(params)
+            adapted = {}
+            for k in params.keys():
+                if isinstance(params[k], unicode):
+                    params[k] = params[k].encode('utf-8')
+                adapted[k] = adapt(params[k]).getquoted()
+            sql = sql_tmpl % adapted
+        elif isinstance(params, (list, tuple)):
+            adapted = []
+            for p in params:
+                if isinstance(p, unicode):
+                    p = p.encode('utf-8')
+                adapted.append(adapt(p).getquoted())
+            adapted = tuple(adapted)
+        sql = sql_tmpl % adapted
+    else:
+        sql = sql_tmpl
+    return sql
+
+
+CASES = {
+    'numbers': ('INSERT INTO t (a, b, c, d) VALUES (%s, %s, %s, %s)',
+                (1, 2.5, None, True)),
+    'mixed': ('INSERT INTO t (a, b, c, d) VALUES (%s, %s, %s, %s)',
+              (42, u'привет', 'hello', None)),
+    'named': ('UPDATE t SET a = %(a)s, b = %(b)s WHERE id = %(id)s',
+              {'a': 1.25, 'b': u'мир', 'id': 7}),
+}
+
+
+def main(number=100000):
+    queue = DbQueryQueue.__new__(DbQueryQueue)
+    queue.bind_params = True
+
+    for name, (sql, params) in sorted(CASES.items()):
+        assert queue.format_sql(sql, params) == legacy_format_sql(sql, params)
+        timings = [
+            ('legacy', lambda: legacy_format_sql(sql, params)),
+            ('format_sql', lambda: queue.format_sql(sql, params)),
+            ('bind', lambda: queue.bind(sql, params)),
+        ]
+        for label, func in timings:
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            print('%-8s %-10s %6.2f us/call' % (name, label, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the CPU time momoko itself spends per query. The queries are run
+on ``momoko.testing.FakeConnection`` connections, so no database is needed
+and the database doesn't hide the cost of the pool, the ``Poller`` and the
+callbacks.
+
+The time the fake connection (and the benchmark loop) needs itself is
+measured first and is shown subtracted from the results. Usage::
+
+    python benchmarks/overhead.py --save overhead.json
+    # ... make changes ...
+    python benchmarks/overhead.py --baseline overhead.json
+
+With ``--baseline`` the exit status is 1 when the total time of a benchmark
+got more than ``--tolerance`` slower.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+from optparse import OptionParser
+
+from tornado.ioloop import IOLoop
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import momoko
+from momoko.queue import DbQueryQueue
+from momoko.testing import FakeConnection, FakeAsyncClient, FakeAdispClient
+
+from suite import Runner, git_commit
+
+
+QUERY = 'SELECT 42, 12, %s, 11'
+
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock # Python 2
+
+
+def bench_fake(ioloop):
+    # the cost of the fake connection itself, without momoko
+    conn = FakeConnection(ioloop)
+    conn.poll()
+    def operation(done):
+        cursor = conn.cursor()
+        cursor.execute(QUERY, (40,))
+        conn.poll()
+        cursor.fetchall()
+        done()
+    return None, operation
+
+
+def bench_execute(ioloop):
+    db = FakeAsyncClient({'ioloop': ioloop, 'cleanup_timeout': 0})
+    def operation(done):
+        db.execute(QUERY, (40,), callback=lambda cursor: done(cursor.fetchall() and None))
+    return db, operation
+
+
+def bench_execute_records(ioloop):
+    db = FakeAsyncClient({'ioloop': ioloop, 'cleanup_timeout': 0})
+    def operation(done):
+        db.execute(QUERY, (40,), callback=lambda rows: done(), factory='records')
+    return db, operation
+
+
+def bench_adisp(ioloop):
+    db = FakeAdispClient({'ioloop': ioloop, 'cleanup_timeout': 0})
+    @momoko.process
+    def operation(done):
+        cursor = yield db.execute(QUERY, (40,))
+        cursor.fetchall()
+        done()
+    return db, operation
+
+
+def bench_chain(ioloop):
+    db = FakeAsyncClient({'ioloop': ioloop, 'cleanup_timeout': 0})
+    queries = ([QUERY, (1,)], [QUERY, (2,)], [QUERY, (3,)])
+    def operation(done):
+        db.chain(queries, callback=lambda cursors: done())
+    return db, operation
+
+
+def bench_batch(ioloop):
+    db = FakeAsyncClient({'ioloop': ioloop, 'cleanup_timeout': 0, 'min_conn': 3})
+    def operation(done):
+        queries = {'a': [QUERY, (1,)], 'b': [QUERY, (2,)], 'c': [QUERY, (3,)]}
+        db.batch(queries, callback=lambda cursors: done())
+    return db, operation
+
+
+def bench_queue_fetchone(ioloop):
+    db = FakeAsyncClient({'ioloop': ioloop, 'cleanup_timeout': 0})
+    queue = DbQueryQueue(db, ioloop, poll_timeout=0.01, queue_length=1)
+    queue.start()
+    def operation(done):
+        queue.fetchone(QUERY, (40,), callback=lambda row: done())
+    return queue, operation
+
+
+BENCHMARKS = [
+    ('execute', bench_execute),
+    ('execute_records', bench_execute_records),
+    ('adisp', bench_adisp),
+    ('chain', bench_chain),
+    ('batch', bench_batch),
+    ('queue_fetchone', bench_queue_fetchone),
+]
+
+
+def measure(factory, total, repeat):
+    """Return the lowest CPU time per operation in microseconds.
+    """
+    ioloop = IOLoop.instance()
+    owner, operation = factory(ioloop)
+    best = None
+    try:
+        Runner(ioloop, operation, 1, 1000).run()
+        for i in range(repeat):
+            runner = Runner(ioloop, operation, 1, total)
+            gc.collect()
+            gc.disable()
+            start = cpu_time()
+            runner.run()
+            elapsed = (cpu_time() - start) / total * 1e6
+            gc.enable()
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if isinstance(owner, DbQueryQueue):
+            owner.stop()
+        elif owner is not None:
+            owner.close()
+    return best
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--queries', type='int', default=20000,
+                      help='operations per run [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='runs per benchmark, the fastest is used [%default]')
+    parser.add_option('--save', help='write the results to a JSON file')
+    parser.add_option('--baseline', help='JSON file of an earlier run')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='allowed slowdown compared with the baseline [%default]')
+    options, args = parser.parse_args()
+
+    fake = measure(bench_fake, options.queries, options.repeat)
+    print('fake connection: %.1f us/query' % fake)
+    print('%-16s %10s %12s' % ('benchmark', 'total us', 'overhead us'))
+    results = {}
+    for name, factory in BENCHMARKS:
+        total = measure(factory, options.queries, options.repeat)
+        queries = 3 if name in ('chain', 'batch') else 1
+        results[name] = round(total, 2)
+        print('%-16s %10.1f %12.1f' % (name, total, max(total - fake * queries, 0)))
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'fake_us': round(fake, 2),
+                'total_us': results,
+            }, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        failed = []
+        for name, value in sorted(results.items()):
+            old = baseline['total_us'].get(name)
+            if old and value > old * (1 + options.tolerance):
+                failed.append('%s: %.1f us, was %.1f us' % (name, value, old))
+        if failed:
+            print('\nSlower than %s:' % options.baseline)
+            for line in failed:
+                print('  ' + line)
+            sys.exit(1)
+        print('\nNo regressions compared with %s' % options.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure latency and throughput of the client, pool and queue hot paths
+against a local PostgreSQL server.
+
+Every benchmark is run for each combination of pool size and concurrency
+(the number of operations that are in flight at the same time). The
+results are printed and written to a JSON file, together with the commit
+that was measured, so runs can be compared with ``--compare``.
+
+Usage::
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py -b execute,queue_fetchone -c 1,50 -p 5
+    python benchmarks/suite.py --compare results-1a2b3c4.json
+
+The connection settings are read from ``tests/database.cfg``, see
+``benchmarks/README.rst``.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from optparse import OptionParser
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    import configparser # Python 3
+
+import psycopg2
+import tornado
+from tornado.ioloop import IOLoop
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import momoko
+from momoko.queue import DbQueryQueue
+
+
+QUERY = 'SELECT 42, 12, %s, 11'
+
+
+def read_settings(filename):
+    config = configparser.ConfigParser()
+    if not config.read(filename):
+        raise SystemExit('Could not read %s' % filename)
+    return {
+        'host': config.get('default', 'host'),
+        'port': config.getint('default', 'port'),
+        'database': config.get('default', 'database'),
+        'user': config.get('default', 'user'),
+        'password': config.get('default', 'password'),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stdout=subprocess.PIPE).communicate()[0].strip().decode('ascii')
+    except OSError:
+        return None
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class Runner(object):
+    """Keep ``concurrency`` operations in flight until ``total`` operations
+    are done and record the latency of every operation.
+
+    ``operation(callback)`` starts one operation, the callback is called with
+    an error or ``None``. Operations that aren't done after ``timeout``
+    seconds count as errors.
+    """
+    def __init__(self, ioloop, operation, concurrency, total, timeout=60):
+        self.ioloop = ioloop
+        self.operation = operation
+        self.concurrency = concurrency
+        self.total = total
+        self.timeout = timeout
+        self.started = 0
+        self.latencies = []
+        self.errors = 0
+        self.timed_out = False
+
+    def run(self):
+        self.start_time = time.time()
+        for i in range(min(self.concurrency, self.total)):
+            self.ioloop.add_callback(self.next)
+        handle = self.ioloop.add_timeout(self.start_time + self.timeout, self.stop)
+        self.ioloop.start()
+        self.ioloop.remove_timeout(handle)
+        self.elapsed = time.time() - self.start_time
+
+    def stop(self):
+        self.timed_out = True
+        self.errors += self.total - len(self.latencies)
+        self.ioloop.stop()
+
+    def next(self):
+        if self.started >= self.total:
+            return
+        self.started += 1
+        start = time.time()
+        def done(error=None):
+            if self.timed_out:
+                return
+            self.latencies.append(time.time() - start)
+            if error is not None:
+                self.errors += 1
+            if len(self.latencies) >= self.total:
+                self.ioloop.stop()
+            else:
+                # the Poller can call back before execute returns
+                self.ioloop.add_callback(self.next)
+        self.operation(done)
+
+    def result(self):
+        latencies = sorted(self.latencies) or [float('nan')]
+        return {
+            'queries': len(self.latencies),
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 4),
+            'qps': round(len(self.latencies) / self.elapsed, 1),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        }
+
+
+def on_cursor(done):
+    def callback(cursor, error=None):
+        if error is None:
+            cursor.fetchall()
+        done(error)
+    return callback
+
+
+def bench_execute(ctx):
+    db = ctx.client(momoko.AsyncClient)
+    def operation(done):
+        db.execute(QUERY, (40,), callback=on_cursor(done))
+    return db, operation
+
+
+def bench_adisp(ctx):
+    db = ctx.client(momoko.AdispClient)
+    @momoko.process
+    def operation(done):
+        cursor = yield db.execute(QUERY, (40,))
+        cursor.fetchall()
+        done()
+    return db, operation
+
+
+def bench_chain(ctx):
+    db = ctx.client(momoko.AsyncClient)
+    queries = ([QUERY, (1,)], [QUERY, (2,)], [QUERY, (3,)])
+    def operation(done):
+        db.chain(queries, callback=lambda cursors: done())
+    return db, operation
+
+
+def bench_batch(ctx):
+    db = ctx.client(momoko.AsyncClient)
+    def operation(done):
+        queries = {'a': [QUERY, (1,)], 'b': [QUERY, (2,)], 'c': [QUERY, (3,)]}
+        db.batch(queries, callback=lambda cursors: done())
+    return db, operation
+
+
+def bench_queue_fetchone(ctx):
+    db = ctx.client(momoko.AsyncClient)
+    queue = DbQueryQueue(db, ctx.ioloop, poll_timeout=0.01,
+                         queue_length=ctx.pool_size)
+    queue.start()
+    def operation(done):
+        queue.fetchone(QUERY, (40,), callback=lambda row: done(),
+                       error_callback=done)
+    return queue, operation
+
+
+def bench_queue_noresult(ctx):
+    db = ctx.client(momoko.AsyncClient)
+    queue = DbQueryQueue(db, ctx.ioloop, queue_length=ctx.pool_size,
+                         noresult_poll_timeout=0.01,
+                         noresult_queue_length=ctx.concurrency)
+    queue.start()
+    def operation(done):
+        queue.execute_noresult('SELECT %s', (40,), callback=done)
+    return queue, operation
+
+
+BENCHMARKS = [
+    ('execute', bench_execute),
+    ('adisp', bench_adisp),
+    ('chain', bench_chain),
+    ('batch', bench_batch),
+    ('queue_fetchone', bench_queue_fetchone),
+    ('queue_noresult', bench_queue_noresult),
+]
+
+
+class Context(object):
+    def __init__(self, settings, pool_size, concurrency):
+        self.settings = settings
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.ioloop = IOLoop.instance()
+        self.clients = []
+
+    def client(self, cls):
+        settings = dict(self.settings)
+        # a fixed pool size, operations wait when every connection is busy
+        settings.update(min_conn=self.pool_size, max_conn=self.pool_size,
+                        cleanup_timeout=0, ioloop=self.ioloop)
+        db = cls(settings)
+        self.clients.append(db)
+        return db
+
+    def close(self):
+        for db in self.clients:
+            db.close()
+
+
+def run_one(name, factory, settings, pool_size, concurrency, total, timeout=60):
+    ctx = Context(settings, pool_size, concurrency)
+    owner, operation = factory(ctx)
+    try:
+        # let the connections be made and warm up the server
+        warmup = Runner(ctx.ioloop, operation, concurrency, max(pool_size, concurrency) * 2,
+                        timeout)
+        warmup.run()
+        runner = Runner(ctx.ioloop, operation, concurrency, total, timeout)
+        runner.run()
+    finally:
+        if isinstance(owner, DbQueryQueue):
+            owner.stop()
+        ctx.close()
+    result = runner.result()
+    result.update(benchmark=name, pool_size=pool_size, concurrency=concurrency)
+    return result
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = json.load(f)
+    old_results = dict(((r['benchmark'], r['pool_size'], r['concurrency']), r)
+                       for r in old['results'])
+    print('\nCompared with %s (%s)' % (filename, old.get('commit')))
+    print('%-16s %5s %5s %10s %10s' % ('benchmark', 'pool', 'conc', 'qps', 'p99'))
+    for r in results:
+        o = old_results.get((r['benchmark'], r['pool_size'], r['concurrency']))
+        if o is None:
+            continue
+        print('%-16s %5d %5d %+9.1f%% %+9.1f%%' % (
+            r['benchmark'], r['pool_size'], r['concurrency'],
+            (r['qps'] / o['qps'] - 1) * 100, (r['p99_ms'] / o['p99_ms'] - 1) * 100))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-b', '--benchmarks', default=','.join(n for n, f in BENCHMARKS),
+                      help='comma separated benchmarks [%default]')
+    parser.add_option('-c', '--concurrency', default='1,10,50',
+                      help='comma separated concurrency levels [%default]')
+    parser.add_option('-p', '--pool-sizes', default='1,5,20',
+                      help='comma separated pool sizes [%default]')
+    parser.add_option('-n', '--queries', type='int', default=2000,
+                      help='operations per run [%default]')
+    parser.add_option('-t', '--timeout', type='float', default=60,
+                      help='seconds before a run is stopped [%default]')
+    parser.add_option('--config', default=os.path.join(ROOT, 'tests', 'database.cfg'),
+                      help='database settings [%default]')
+    parser.add_option('-o', '--output', help='JSON file [results-<commit>.json]')
+    parser.add_option('--compare', help='JSON file of an earlier run')
+    options, args = parser.parse_args()
+
+    settings = read_settings(options.config)
+    selected = options.benchmarks.split(',')
+    unknown = set(selected) - set(n for n, f in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    concurrency_levels = [int(c) for c in options.concurrency.split(',')]
+    pool_sizes = [int(p) for p in options.pool_sizes.split(',')]
+
+    commit = git_commit()
+    results = []
+    print('%-16s %5s %5s %10s %9s %9s %6s' % (
+        'benchmark', 'pool', 'conc', 'qps', 'p50 ms', 'p99 ms', 'errors'))
+    for name, factory in BENCHMARKS:
+        if name not in selected:
+            continue
+        for pool_size in pool_sizes:
+            for concurrency in concurrency_levels:
+                r = run_one(name, factory, settings, pool_size, concurrency, options.queries,
+                            options.timeout)
+                results.append(r)
+                print('%-16s %5d %5d %10.1f %9.3f %9.3f %6d' % (
+                    name, pool_size, concurrency, r['qps'], r['p50_ms'],
+                    r['p99_ms'], r['errors']))
+
+    output = options.output or 'results-%s.json' % (commit or 'unknown')[:7]
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'psycopg2': psycopg2.__version__,
+            'tornado': tornado.version,
+            'momoko': momoko.__version__,
+            'queries': options.queries,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    print('\nResults written to %s' % output)
+
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
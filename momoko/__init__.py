@@ -16,5 +16,8 @@ __license__ = 'MIT'
 
 
 from .clients import BlockingClient, AsyncClient, AdispClient
-from .pools import BlockingPool, AsyncPool, PoolError
+from .pools import BlockingPool, AsyncPool, PoolSizer, PoolError, CircuitOpenError
+from .utils import CancelToken, CancelMixin
+from .stats import QueryStats
+from .retry import RetryPolicy, CircuitBreaker
 from .adisp import process, async
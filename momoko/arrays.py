@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.arrays
+    ~~~~~~~~~~~~~
+
+    Fetching query results into NumPy arrays with binary COPY and passing
+    NumPy arrays to queries.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import struct
+import functools
+import threading
+from array import array
+from io import BytesIO
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import psycopg2
+from psycopg2.extensions import register_adapter, AsIs
+from tornado.ioloop import IOLoop
+
+from .pools import _quote_ident
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from .utils import OrderedDict
+
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# PostgreSQL epoch (2000-01-01) in days and microseconds since 1970-01-01
+PG_EPOCH_DAYS = 10957
+PG_EPOCH_USECS = PG_EPOCH_DAYS * 86400 * 1000000
+
+# type oid: (wire type, result type)
+COPY_TYPES = {
+    16: ('?', '?'),                     # bool
+    20: ('>i8', 'i8'),                  # int8
+    21: ('>i2', 'i2'),                  # int2
+    23: ('>i4', 'i4'),                  # int4
+    26: ('>u4', 'u4'),                  # oid
+    700: ('>f4', 'f4'),                 # float4
+    701: ('>f8', 'f8'),                 # float8
+    1082: ('>i4', 'M8[D]'),             # date
+    1114: ('>i8', 'M8[us]'),            # timestamp
+    1184: ('>i8', 'M8[us]'),            # timestamptz
+}
+
+# type oid: value that replaces NULL before it's sent, the NULL is sent as a
+# separate boolean column (see ``copy_to_array``)
+NULL_FILLERS = {
+    16: "'f'",
+    1082: "'epoch'",
+    1114: "'epoch'",
+    1184: "'epoch'",
+}
+
+
+# NumPy dtype (kind and size): PostgreSQL array type
+NUMPY_TYPES = {
+    'b1': 'bool',
+    'i1': 'int2',
+    'i2': 'int2',
+    'i4': 'int4',
+    'i8': 'int8',
+    'u1': 'int2',
+    'u2': 'int4',
+    'u4': 'int8',
+    'u8': 'numeric',
+    'f4': 'float4',
+    'f8': 'float8',
+}
+
+# array.array typecode: PostgreSQL array type
+TYPECODES = {
+    'b': 'int2',
+    'B': 'int2',
+    'h': 'int2',
+    'H': 'int4',
+    'i': 'int4',
+    'I': 'int8',
+    'l': 'int8',
+    'L': 'numeric',
+    'f': 'float4',
+    'd': 'float8',
+}
+
+
+def _check_numpy():
+    if numpy is None:
+        raise ImportError('NumPy is needed to fetch arrays')
+
+
+def _convert(values, result_type, nulls=None):
+    """Convert wire values to the result type. NULLs become NaN or NaT,
+    NULLs in other columns are an error.
+    """
+    kind = numpy.dtype(result_type).kind
+    if kind == 'M':
+        epoch = PG_EPOCH_DAYS if result_type == 'M8[D]' else PG_EPOCH_USECS
+        result = (values.astype('i8') + epoch).view(result_type)
+        if nulls is not None:
+            result[nulls] = numpy.datetime64('NaT')
+        return result
+
+    result = values.astype(result_type)
+    if nulls is not None and nulls.any():
+        if kind != 'f':
+            raise ValueError('NULL in a column of type %s' % result_type)
+        result[nulls] = numpy.nan
+    return result
+
+
+def _check_types(names, type_oids):
+    for name, oid in zip(names, type_oids):
+        if oid not in COPY_TYPES:
+            raise ValueError('column %s has unsupported type oid %s' % (name, oid))
+
+
+def _data_start(data):
+    if not data.startswith(COPY_SIGNATURE):
+        raise ValueError('not binary COPY data')
+    extension, = struct.unpack('>i', data[15:19])
+    return 19 + extension
+
+
+def _parse_fixed(data, wire_types):
+    """Read COPY data without NULLs as one structured array and return the
+    wire values per column, or ``None`` when the rows don't have the same
+    layout.
+    """
+    start = _data_start(data)
+    body = len(data) - start - 2  # trailer is a single int16 -1
+
+    fields = [('count', '>i2')]
+    for i, wire_type in enumerate(wire_types):
+        fields.extend([('length%d' % i, '>i4'), ('f%d' % i, wire_type)])
+    row_type = numpy.dtype(fields)
+
+    if body % row_type.itemsize:
+        return None
+    rows = numpy.frombuffer(data, row_type, body // row_type.itemsize, start)
+    if ((rows['count'] == len(wire_types)).all() and
+            all((rows['length%d' % i] == t.itemsize).all() for i, t in enumerate(wire_types))):
+        return [rows['f%d' % i] for i in range(len(wire_types))]
+    return None
+
+
+def _result(names, values, columns):
+    if columns:
+        return OrderedDict(zip(names, values))
+    result = numpy.empty(len(values[0]) if values else 0,
+                         [(name, value.dtype) for name, value in zip(names, values)])
+    for name, value in zip(names, values):
+        result[name] = value
+    return result
+
+
+def parse_copy(data, names, type_oids, columns=False):
+    """Decode the output of ``COPY ... TO STDOUT WITH BINARY``.
+
+    When there are no NULLs all rows have the same layout and the whole
+    buffer is read as one structured array. Otherwise the fields are located
+    row by row, which is a lot slower. ``copy_to_array`` sends NULLs as
+    separate boolean columns, so it never takes the slow path.
+
+    :param data: A string (bytes) with the COPY output.
+    :param names: The column names.
+    :param type_oids: The type oids of the columns, see ``COPY_TYPES``.
+    :param columns: Return an ordered dictionary with an array per column
+                    instead of a structured array.
+    """
+    _check_numpy()
+    _check_types(names, type_oids)
+    wire_types = [numpy.dtype(COPY_TYPES[oid][0]) for oid in type_oids]
+    result_types = [COPY_TYPES[oid][1] for oid in type_oids]
+
+    fields = _parse_fixed(data, wire_types)
+    if fields is not None:
+        values = [_convert(field, result_type) for field, result_type in zip(fields, result_types)]
+    else:
+        values = _parse_rows(data, _data_start(data), wire_types, result_types)
+    return _result(names, values, columns)
+
+
+def _parse_rows(data, position, wire_types, result_types):
+    count = len(wire_types)
+    unpack_from = struct.unpack_from
+    offsets = [[] for i in range(count)]
+    while True:
+        fields, = unpack_from('>h', data, position)
+        position += 2
+        if fields == -1:
+            break
+        if fields != count:
+            raise ValueError('expected %d fields, got %d' % (count, fields))
+        for column in offsets:
+            length, = unpack_from('>i', data, position)
+            position += 4
+            if length == -1:
+                column.append(-1)
+            else:
+                column.append(position)
+                position += length
+
+    buf = numpy.frombuffer(data, numpy.uint8)
+    values = []
+    for column, wire_type, result_type in zip(offsets, wire_types, result_types):
+        column = numpy.array(column, numpy.int64)
+        nulls = column == -1
+        column[nulls] = 0
+        # gather the bytes of every value and read them as one array
+        raw = buf[column[:, None] + numpy.arange(wire_type.itemsize)]
+        raw = numpy.ascontiguousarray(raw).view(wire_type).reshape(-1)
+        values.append(_convert(raw, result_type, nulls))
+    return values
+
+
+def _copy_data(names, values, type_oids):
+    """Build binary COPY data from one array per column. NaN and NaT are
+    sent as NULL.
+    """
+    count = len(values[0]) if values else 0
+    fields = [('count', '>i2')]
+    for i, oid in enumerate(type_oids):
+        fields.extend([('length%d' % i, '>i4'), ('f%d' % i, COPY_TYPES[oid][0])])
+    rows = numpy.empty(count, fields)
+    rows['count'] = len(names)
+    keep = None
+    for i, (value, oid) in enumerate(zip(values, type_oids)):
+        if len(value) != count:
+            raise ValueError('column %s has %d values, expected %d' % (names[i], len(value), count))
+        wire_type, result_type = COPY_TYPES[oid]
+        value = numpy.asarray(value)
+        nulls = None
+        if value.dtype.kind == 'f':
+            nulls = numpy.isnan(value)
+        elif value.dtype.kind == 'M':
+            nulls = numpy.isnat(value)
+            epoch = PG_EPOCH_DAYS if result_type == 'M8[D]' else PG_EPOCH_USECS
+            value = value.astype(result_type).view('i8') - epoch
+        rows['length%d' % i] = rows.dtype['f%d' % i].itemsize
+        rows['f%d' % i] = value
+        if nulls is not None and nulls.any():
+            # a NULL is a length of -1 without value bytes
+            rows['length%d' % i][nulls] = -1
+            if keep is None:
+                keep = numpy.ones((count, rows.dtype.itemsize), bool)
+            offset = rows.dtype.fields['f%d' % i][1]
+            keep[nulls, offset:offset + rows.dtype['f%d' % i].itemsize] = False
+
+    data = rows.view(numpy.uint8).reshape(count, rows.dtype.itemsize)
+    data = data[keep] if keep is not None else data
+    return b''.join([COPY_SIGNATURE, struct.pack('>ii', 0, 0), data.tobytes(),
+                     struct.pack('>h', -1)])
+
+
+def copy_from_arrays(connection, table, columns):
+    """Insert arrays into a table with binary COPY. Values are converted to
+    the types of the table columns, no Python object is created per value.
+    NaN and NaT are inserted as NULL.
+
+    :param connection: A blocking psycopg2 connection.
+    :param table: The table name or a ``(schema, table)`` tuple.
+    :param columns: An ordered dictionary with an array per column or a
+                    structured array.
+    :return: The number of inserted rows.
+    """
+    _check_numpy()
+    if isinstance(columns, numpy.ndarray):
+        names = list(columns.dtype.names)
+        values = [columns[name] for name in names]
+    else:
+        names = list(columns.keys())
+        values = list(columns.values())
+
+    if isinstance(table, tuple):
+        table = '.'.join(_quote_ident(name) for name in table)
+    else:
+        table = _quote_ident(table)
+
+    cursor = connection.cursor()
+    quoted = ', '.join(_quote_ident(name) for name in names)
+    cursor.execute('SELECT %s FROM %s LIMIT 0' % (quoted, table))
+    type_oids = [column[1] for column in cursor.description]
+    for name, oid in zip(names, type_oids):
+        if oid not in COPY_TYPES:
+            raise ValueError('column %s has unsupported type oid %s' % (name, oid))
+
+    data = _copy_data(names, values, type_oids)
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH BINARY' % (table, quoted), BytesIO(data))
+    return len(values[0]) if values else 0
+
+
+def copy_to_array(connection, query, parameters=None, columns=False):
+    """Run a query on a blocking connection with binary COPY and return the
+    result as NumPy arrays.
+
+    The query is run with ``LIMIT 0`` first to get the column types, so it's
+    planned twice and it must not have side effects. Every column is sent
+    with a boolean column that tells if the value is NULL, so all rows have
+    the same layout and NULLs are decoded as a vectorised mask.
+
+    :param connection: A blocking psycopg2 connection.
+    :param query: A ``SELECT`` query (without a trailing semicolon).
+    :param parameters: Parameters for the query. Optional.
+    :param columns: Return an ordered dictionary with an array per column
+                    instead of a structured array.
+    """
+    _check_numpy()
+    cursor = connection.cursor()
+    if parameters:
+        query = cursor.mogrify(query, parameters)
+
+    # column names and types without fetching rows
+    cursor.execute('SELECT * FROM (%s) AS q LIMIT 0' % query)
+    names = [column[0] for column in cursor.description]
+    type_oids = [column[1] for column in cursor.description]
+    _check_types(names, type_oids)
+
+    aliases = ['c%d' % i for i in range(len(names))]
+    select = ', '.join('%s IS NULL, COALESCE(%s, %s)' % (alias, alias, NULL_FILLERS.get(oid, "'0'"))
+                       for alias, oid in zip(aliases, type_oids))
+    buf = BytesIO()
+    cursor.copy_expert('COPY (SELECT %s FROM (%s) AS q (%s)) TO STDOUT WITH BINARY' % (
+        select, query, ', '.join(aliases)), buf)
+
+    wire_types = []
+    for oid in type_oids:
+        wire_types.extend([numpy.dtype('?'), numpy.dtype(COPY_TYPES[oid][0])])
+    fields = _parse_fixed(buf.getvalue(), wire_types)
+    if fields is None:
+        raise ValueError('unexpected layout of binary COPY data')
+    values = [_convert(fields[2 * i + 1], COPY_TYPES[oid][1], fields[2 * i])
+              for i, oid in enumerate(type_oids)]
+    return _result(names, values, columns)
+
+
+class AsyncArrayFetcher(object):
+    """Fetch arrays in a worker thread, so the IOLoop isn't blocked. Every
+    fetcher has one worker thread that's started with the first fetch,
+    fetches run one at a time in the order they were started.
+
+    The worker thread has a connection of its own, pools aren't thread-safe.
+    The connection is made with the first fetch and made again when it was
+    lost.
+
+    :param settings: A dictionary with the connection settings, like the
+                     settings of a ``BlockingClient``. Pool settings are
+                     ignored.
+    :param ioloop: An instance of Tornado's IOLoop.
+    """
+    def __init__(self, settings, ioloop=None):
+        self._settings = dict((key, value) for key, value in settings.items()
+                              if key not in ('min_conn', 'max_conn', 'cleanup_timeout'))
+        self._ioloop = ioloop or IOLoop.instance()
+        self._tasks = Queue()
+        self._worker = None
+
+    def fetch(self, query, parameters=None, columns=False, callback=None):
+        """Fetch arrays, see ``BlockingClient.fetch_array``.
+
+        :param callback: A callable that is executed with the result on the
+                         IOLoop. When the query fails the callback gets
+                         ``None`` and the error.
+        """
+        self._start(copy_to_array, (query, parameters, columns), callback)
+
+    def copy(self, table, columns, callback=None):
+        """Insert arrays into a table, see ``BlockingClient.copy_arrays``.
+
+        :param callback: A callable that is executed with the number of
+                         inserted rows on the IOLoop. When the copy fails the
+                         callback gets ``None`` and the error.
+        """
+        self._start(copy_from_arrays, (table, columns), callback)
+
+    def close(self):
+        """Stop the worker thread and close its connection after the fetches
+        that were already started.
+        """
+        if self._worker is not None:
+            self._tasks.put(None)
+            self._worker = None
+
+    def _start(self, function, args, callback):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, args=(self._tasks,))
+            self._worker.daemon = True
+            self._worker.start()
+        self._tasks.put((function, args, callback))
+
+    def _work(self, tasks):
+        connection = None
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            if connection is None or connection.closed:
+                try:
+                    connection = psycopg2.connect(**self._settings)
+                except Exception as error:
+                    connection = None
+                    callback = task[2]
+                    if callback:
+                        self._ioloop.add_callback(functools.partial(callback, None, error))
+                    continue
+            self._run(connection, *task)
+        if connection is not None:
+            connection.close()
+
+    def _run(self, connection, function, args, callback):
+        try:
+            try:
+                result = function(connection, *args)
+            except:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            connection.commit()
+        except Exception as error:
+            if callback:
+                self._ioloop.add_callback(functools.partial(callback, None, error))
+        else:
+            if callback:
+                self._ioloop.add_callback(functools.partial(callback, result))
+
+
+class NumpyArrayAdapter(object):
+    """Adapt a one-dimensional NumPy array to a PostgreSQL array literal,
+    e.g. ``'{1,2,3}'::int8[]``. Values are converted to text by NumPy, they
+    are not adapted one by one.
+    """
+    def __init__(self, value):
+        self._value = value
+
+    def prepare(self, conn):
+        pass
+
+    def getquoted(self):
+        value = self._value
+        if value.ndim != 1:
+            raise ValueError('only one-dimensional arrays can be adapted')
+        dtype = value.dtype
+        try:
+            pg_type = NUMPY_TYPES['%s%d' % (dtype.kind, dtype.itemsize)]
+        except KeyError:
+            raise ValueError('arrays of %s can not be adapted' % dtype)
+        if dtype.kind == 'b':
+            text = numpy.where(value, 't', 'f')
+        else:
+            text = value.astype(str)
+        return "'{%s}'::%s[]" % (','.join(text), pg_type)
+
+
+def adapt_array(value):
+    """Adapt an ``array.array`` to a PostgreSQL array literal.
+    """
+    try:
+        pg_type = TYPECODES[value.typecode]
+    except KeyError:
+        raise ValueError('arrays of typecode %s can not be adapted' % value.typecode)
+    if numpy is not None:
+        return NumpyArrayAdapter(numpy.frombuffer(value, value.typecode))
+    # repr of a long has a trailing L on Python 2
+    text = map(repr if value.typecode in 'fd' else str, value)
+    return AsIs("'{%s}'::%s[]" % (','.join(text), pg_type))
+
+
+def register_adapters():
+    """Adapt ``array.array`` and, when NumPy is installed, NumPy arrays to
+    PostgreSQL arrays in query parameters. The adapters are registered
+    globally in ``psycopg2``, so call this once when the application starts.
+    """
+    register_adapter(array, adapt_array)
+    if numpy is not None:
+        register_adapter(numpy.ndarray, NumpyArrayAdapter)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.budget
+    ~~~~~~~~~~~~~
+
+    A connection budget that is shared by the processes on a host.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import os
+import time
+import mmap
+import errno
+import fcntl
+import struct
+
+
+_MAGIC = b'MMKB'
+# magic, total, denied, slots
+_HEADER = struct.Struct('<4sIQI')
+# pid, connections
+_SLOT = struct.Struct('<II')
+
+
+class HostBudget(object):
+    """A maximum number of connections for all pools on a host, e.g. for
+    the processes of a prefork Tornado server. Pass it to every pool with the
+    ``budget`` setting::
+
+        budget = HostBudget('/var/run/myapp/momoko.budget', total=100)
+        tornado.process.fork_processes(16)
+        db = momoko.AsyncClient({..., 'max_conn': 20, 'budget': budget})
+
+    Every process can use up to ``max_conn`` connections, as long as all
+    processes together have at most ``total`` connections. When the budget
+    is used up, operations wait for a connection of their own pool. Pools
+    close their idle connections (down to ``min_conn``) when a process was
+    refused a connection, so idle processes give their part of the budget
+    to busy ones.
+
+    The number of connections of every process is kept in a small file
+    that's mapped into memory and changes are locked with ``fcntl.lockf``.
+    The connections of processes that have died are reclaimed when the
+    budget is used up, at most once every ``check_interval`` seconds per
+    process. The ``LISTEN`` connection of a pool isn't counted.
+
+    :param path: The file, all processes have to use the same file.
+    :param total: The maximum number of connections on the host.
+    :param max_processes: The maximum number of processes that use the budget.
+    :param check_interval: Time in seconds between the checks of a pool for
+                           refused connections of other processes, and
+                           between the checks for processes that died.
+    """
+    def __init__(self, path, total, max_processes=128, check_interval=1.0):
+        self.path = path
+        self.total = total
+        self.max_processes = max_processes
+        self.check_interval = check_interval
+        self._pid = None
+        self._slot = None
+        self._reclaimed_at = 0
+
+        size = _HEADER.size + max_processes * _SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock()
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            magic, old_total, denied, slots = _HEADER.unpack_from(self._map, 0)
+            if magic != _MAGIC:
+                denied = 0
+                slots = max_processes
+            elif slots != max_processes:
+                raise ValueError('%s is used with max_processes=%d' % (path, slots))
+            _HEADER.pack_into(self._map, 0, _MAGIC, total, denied, slots)
+        finally:
+            self._unlock()
+
+    def _lock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _slots(self):
+        for i in range(self.max_processes):
+            pid, count = _SLOT.unpack_from(self._map, _HEADER.size + i * _SLOT.size)
+            yield i, pid, count
+
+    def _set_slot(self, index, pid, count):
+        _SLOT.pack_into(self._map, _HEADER.size + index * _SLOT.size, pid, count)
+
+    def _own_slot(self):
+        """Return the slot of this process or ``None`` when all slots are
+        taken. A forked process gets a new slot.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            slot = self._find_slot(pid)
+            if slot is None:
+                self._reclaim()
+                slot = self._find_slot(pid)
+            if slot is None:
+                return None
+            self._pid = pid
+            self._slot = slot
+        return self._slot
+
+    def _find_slot(self, pid):
+        free = None
+        for i, slot_pid, count in self._slots():
+            if slot_pid == pid:
+                return i
+            if slot_pid == 0 and free is None:
+                free = i
+        if free is not None:
+            self._set_slot(free, pid, 0)
+        return free
+
+    def _reclaim(self):
+        """Free the slots of processes that don't exist anymore. Returns the
+        number of reclaimed connections. It's a system call per slot, so it's
+        skipped when it was done less than ``check_interval`` seconds ago.
+        """
+        now = time.time()
+        if now - self._reclaimed_at < self.check_interval:
+            return 0
+        self._reclaimed_at = now
+        reclaimed = 0
+        for i, pid, count in self._slots():
+            if pid == 0 or pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    self._set_slot(i, 0, 0)
+                    reclaimed += count
+        return reclaimed
+
+    def _used(self):
+        return sum(count for i, pid, count in self._slots())
+
+    def acquire(self, n=1):
+        """Take ``n`` connections from the budget. Returns ``False`` when
+        there are not enough left.
+        """
+        self._lock()
+        try:
+            slot = self._own_slot()
+            if slot is not None:
+                used = self._used()
+                if used + n > self.total and self._reclaim():
+                    used = self._used()
+                if used + n <= self.total:
+                    pid, count = _SLOT.unpack_from(self._map, _HEADER.size + slot * _SLOT.size)
+                    self._set_slot(slot, pid, count + n)
+                    return True
+            magic, total, denied, slots = _HEADER.unpack_from(self._map, 0)
+            _HEADER.pack_into(self._map, 0, magic, total, denied + 1, slots)
+            return False
+        finally:
+            self._unlock()
+
+    def release(self, n=1):
+        """Give ``n`` connections back to the budget.
+        """
+        if n <= 0:
+            return
+        self._lock()
+        try:
+            slot = self._own_slot()
+            if slot is not None:
+                pid, count = _SLOT.unpack_from(self._map, _HEADER.size + slot * _SLOT.size)
+                self._set_slot(slot, pid, max(count - n, 0))
+        finally:
+            self._unlock()
+
+    @property
+    def denied(self):
+        """The number of times a connection was refused, by any process.
+        """
+        return _HEADER.unpack_from(self._map, 0)[2]
+
+    def status(self):
+        """Return the budget as a dictionary: ``total``, ``used``, ``denied``
+        and ``processes``, a dictionary with the number of connections per
+        process id.
+        """
+        self._lock()
+        try:
+            processes = dict((pid, count) for i, pid, count in self._slots() if pid)
+        finally:
+            self._unlock()
+        return {
+            'total': self.total,
+            'used': sum(processes.values()),
+            'denied': self.denied,
+            'processes': processes,
+        }
+
+    def close(self):
+        """Give back the connections of this process and close the file.
+        """
+        if self._map is None:
+            return
+        self._lock()
+        try:
+            if self._pid == os.getpid():
+                self._set_slot(self._slot, 0, 0)
+        finally:
+            self._unlock()
+        self._map.close()
+        os.close(self._fd)
+        self._map = None
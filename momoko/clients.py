@@ -15,7 +15,9 @@ from contextlib import contextmanager
 
 from .pools import AsyncPool, BlockingPool
 from .adisp import async, process
-from .utils import BatchQuery, QueryChain
+from .stats import ExplainSampler
+from .utils import (BatchQuery, QueryChain, Loader, get_factory, apply_factory,
+    values_pages)
 
 
 class BlockingClient(object):
@@ -47,6 +49,40 @@ class BlockingClient(object):
         else:
             conn.commit()
 
+    def fetch_array(self, query, parameters=None, columns=False):
+        """Fetch the result of a query into NumPy arrays.
+
+        The query is run with ``COPY (query) TO STDOUT WITH BINARY`` and the
+        output is decoded directly into arrays, no Python object is created
+        per value. Only boolean, integer, float, date and timestamp columns
+        are supported. NULLs become NaN in float columns and NaT in date
+        and timestamp columns.
+
+        :param query: A ``SELECT`` query (without a trailing semicolon).
+        :param parameters: Parameters for the query. Optional.
+        :param columns: Return an ordered dictionary with an array per column
+                        instead of a structured array.
+        :return: A NumPy structured array or an ordered dictionary of arrays.
+        """
+        from .arrays import copy_to_array
+        with self.connection as conn:
+            return copy_to_array(conn, query, parameters, columns)
+
+    def copy_arrays(self, table, columns):
+        """Insert NumPy arrays into a table with binary COPY.
+
+        Values are converted to the types of the table columns by NumPy, no
+        Python object is created per value.
+
+        :param table: The table name.
+        :param columns: An ordered dictionary with an array per column or a
+                        structured array (like the ones ``fetch_array``
+                        returns).
+        :return: The number of inserted rows.
+        """
+        from .arrays import copy_from_arrays
+        with self.connection as conn:
+            return copy_from_arrays(conn, table, columns)
 
 
 class AsyncClient(object):
@@ -56,14 +92,18 @@ class AsyncClient(object):
 
     :param settings: A dictionary that is passed to the ``AsyncPool`` object.
     """
+    pool_class = AsyncPool
+
     def __init__(self, settings):
-        self._pool = AsyncPool(**settings)
+        self._pool = self.pool_class(**settings)
 
-    def batch(self, queries, callback=None):
+    def batch(self, queries, callback=None, cancel_token=None,
+              max_concurrency=None, fail_fast=False):
         """Run a batch of queries all at once.
 
         **Note:** Every query needs a free connection. So if three queries are
-        are executed, three free connections are used.
+        are executed, three free connections are used. Use ``max_concurrency``
+        to limit the number of connections a batch uses.
 
         A dictionary with queries looks like this::
 
@@ -80,12 +120,20 @@ class AsyncClient(object):
         :param queries: A dictionary with all the queries.
         :param callback: The function that needs to be executed once all the
                          queries are finished. Optional.
+        :param cancel_token: A ``momoko.CancelToken`` to cancel the queries.
+                             Optional.
+        :param max_concurrency: The maximum number of queries that run at the
+                                same time. Optional.
+        :param fail_fast: Cancel the other queries when a query fails.
         :return: A dictionary with the same keys as the given queries with the
-                 resulting cursors as values.
+                 resulting cursors as values. Failed queries have the
+                 exception as value and queries cancelled by ``fail_fast``
+                 have ``None``.
         """
-        return BatchQuery(self, queries, callback)
+        return BatchQuery(self, queries, callback, cancel_token,
+                          max_concurrency, fail_fast)
 
-    def chain(self, queries, callback=None):
+    def chain(self, queries, callback=None, cancel_token=None, pipeline=False):
         """Run a chain of queries in the given order.
 
         A list/tuple with queries looks like this::
@@ -102,11 +150,50 @@ class AsyncClient(object):
         :param queries: A tuple or list with all the queries.
         :param callback: The function that needs to be executed once all the
                          queries are finished. Optional.
-        :return: A list with the resulting cursors.
+        :param cancel_token: A ``momoko.CancelToken`` to cancel the chain. The
+                             running query is cancelled and the remaining
+                             queries are skipped. Optional.
+        :param pipeline: Send all queries in one round trip as one
+                         transaction. Only the cursor of the last query is
+                         returned, see ``momoko.utils.QueryChain``.
+        :return: A list with the resulting cursors. A failed query has the
+                 exception instead of a cursor and the skipped queries after
+                 it have ``None``.
+        """
+        return QueryChain(self, queries, callback, cancel_token, pipeline)
+
+    def loader(self, query, key_column=0, many=False, window=0, max_keys=1000):
+        """Create a ``Loader`` that merges point lookups into one query.
+
+        For example::
+
+            users = db.loader('SELECT id, name FROM users WHERE id = ANY(%s)')
+            users.load(42, callback=on_user)
+            users.load(43, callback=on_user)
+
+        Both lookups are done with one query.
+
+        :param query: A query with one placeholder for the list of keys.
+        :param key_column: Index of the column with the key.
+        :param many: Return a list of rows for every key.
+        :param window: Time in seconds to wait for more keys. By default keys
+                       are collected until the end of the IOLoop iteration.
+        :param max_keys: Maximum number of keys in one query.
+        :return: A ``Loader`` instance.
         """
-        return QueryChain(self, queries, callback)
+        return Loader(self._fetchall, query, key_column, many, window,
+                      max_keys, self._pool._ioloop)
+
+    def _fetchall(self, operation, parameters, callback):
+        def on_result(cursor, error=None):
+            if error is not None:
+                callback(None, error)
+            else:
+                callback(cursor.fetchall())
+        AsyncClient.execute(self, operation, parameters, callback=on_result)
 
-    def execute(self, operation, parameters=(), callback=None):
+    def execute(self, operation, parameters=(), callback=None, factory=None,
+                cancel_token=None, idempotent=False, tag=None):
         """Prepare and execute a database operation (query or command).
 
         Parameters may be provided as sequence or mapping and will be bound to
@@ -121,10 +208,80 @@ class AsyncClient(object):
                            an empty tuple by default.
         :param callback: A callable that is executed once the operation is
                          finished. Optional.
+        :param factory: ``tuples``, ``records``, ``columns`` or a callable
+                        that takes the cursor. If given, the callback gets the
+                        result of the factory instead of the cursor. See
+                        ``momoko.utils.fetch_records`` and
+                        ``momoko.utils.fetch_columns``. Optional.
+        :param cancel_token: A ``momoko.CancelToken`` to cancel the operation.
+                             The callback isn't called when the token is
+                             cancelled. Optional.
+        :param idempotent: The operation is read-only or can safely be
+                           executed more than once, so it's retried after
+                           transient errors when the pool has a
+                           ``retry_policy``.
+        :param tag: The tag for the ``quotas`` of the pool, e.g. the name of
+                    the endpoint. Optional.
         """
-        self._pool.new_cursor('execute', (operation, parameters), callback)
+        if factory is not None and callback is not None:
+            callback = functools.partial(apply_factory, get_factory(factory), callback)
+        self._pool.new_cursor('execute', (operation, parameters), callback,
+                              cancel_token=cancel_token, idempotent=idempotent,
+                              tag=tag)
+
+    def execute_values(self, operation, argslist, template=None, page_size=100,
+                       callback=None, max_concurrency=1, fail_fast=True,
+                       fetch=False, cancel_token=None):
+        """Execute a query with many rows of parameters in pages, like
+        ``psycopg2.extras.execute_values`` does for blocking connections
+        (asynchronous connections don't support ``executemany``).
+
+        For example::
 
-    def callproc(self, procname, parameters=None, callback=None):
+            db.execute_values('INSERT INTO users (id, name) VALUES %s',
+                              [(1, 'a'), (2, 'b'), (3, 'c')], callback=on_done)
+
+        Every page of ``page_size`` rows is one multi-row query. By default
+        the pages are executed one after another, with ``max_concurrency``
+        more pages are executed at the same time on different connections.
+        Note that every page is its own transaction.
+
+        :param operation: A query with one ``%s`` placeholder for the rows.
+        :param argslist: A sequence of sequences or dictionaries.
+        :param template: The template of one row, e.g. ``(%s, %s, now())`` or
+                         ``(%(id)s, %(name)s)``. Required for dictionaries.
+        :param page_size: The maximum number of rows in one query.
+        :param callback: A callable that gets the total row count (or a list
+                         of rows when ``fetch`` is set). When a page failed
+                         it gets the total of the other pages and the error.
+                         Optional.
+        :param max_concurrency: The number of pages that are executed at the
+                                same time.
+        :param fail_fast: Skip the remaining pages when a page fails.
+        :param fetch: Pass on the rows of all pages, e.g. from ``RETURNING``.
+        :param cancel_token: A ``momoko.CancelToken`` to cancel the pages.
+                             Optional.
+        """
+        pages = dict(enumerate(values_pages(operation, argslist, template, page_size)))
+        BatchQuery(self, pages, functools.partial(self._values_done, fetch, callback),
+                   cancel_token, max_concurrency, fail_fast)
+
+    def _values_done(self, fetch, callback, cursors):
+        total = [] if fetch else 0
+        error = None
+        for key in sorted(cursors):
+            cursor = cursors[key]
+            if isinstance(cursor, Exception):
+                error = error or cursor
+            elif cursor is not None:
+                total += cursor.fetchall() if fetch else max(cursor.rowcount, 0)
+        if callback and error is not None:
+            callback(total, error)
+        elif callback:
+            callback(total)
+
+    def callproc(self, procname, parameters=None, callback=None, cancel_token=None,
+                 idempotent=False, tag=None):
         """Call a stored database procedure with the given name.
 
         The sequence of parameters must contain one entry for each argument that
@@ -139,8 +296,77 @@ class AsyncClient(object):
         :param parameters: A sequence with parameters. This is ``None`` by default.
         :param callback: A callable that is executed once the procedure is
                          finished. Optional.
+        :param cancel_token: A ``momoko.CancelToken`` to cancel the procedure call.
+                             Optional.
+        :param idempotent: The procedure can safely be called more than once,
+                           see ``execute``.
+        :param tag: The tag for the ``quotas`` of the pool. Optional.
+        """
+        self._pool.new_cursor('callproc', (procname, parameters), callback,
+                              cancel_token=cancel_token, idempotent=idempotent,
+                              tag=tag)
+
+    def add_listener(self, listener, sample_rate=1.0):
+        """Send query events to ``listener``, see ``AsyncPool.add_listener``.
+
+        For example::
+
+            class SlowQueries(object):
+                def on_complete(self, event):
+                    if event.server_time > 0.1:
+                        logging.info('%s took %.3fs', event.query, event.server_time)
+
+            db.add_listener(SlowQueries(), sample_rate=0.1)
+
+        :param listener: An object with ``on_enqueue``, ``on_checkout``,
+                         ``on_execute``, ``on_complete`` or ``on_error``
+                         methods, they get a ``momoko.utils.QueryEvent``.
+        :param sample_rate: The fraction of the operations (0 to 1) the
+                            listener gets events for.
+        """
+        self._pool.add_listener(listener, sample_rate)
+
+    def remove_listener(self, listener):
+        """Stop sending query events to ``listener``.
         """
-        self._pool.new_cursor('callproc', (procname, parameters), callback)
+        self._pool.remove_listener(listener)
+
+    def explain_slow_queries(self, threshold=1.0, sample_rate=0.1, max_per_minute=10):
+        """Run ``EXPLAIN (FORMAT JSON)`` for a sample of the queries that take
+        longer than ``threshold`` seconds. Plans are tracked per query
+        fingerprint and changed plans are logged to the ``momoko.slow``
+        logger, see ``momoko.stats.ExplainSampler``.
+
+        :param threshold: Time in seconds.
+        :param sample_rate: The fraction of slow queries (0 to 1) to explain.
+        :param max_per_minute: Maximum number of ``EXPLAIN`` queries a minute.
+        :return: The ``ExplainSampler``, remove it with ``remove_listener``.
+        """
+        sampler = ExplainSampler(self._pool, threshold, sample_rate, max_per_minute)
+        self._pool.add_listener(sampler)
+        return sampler
+
+    def listen(self, channel, callback):
+        """Call ``callback`` for every notification sent to ``channel``.
+
+        Notifications are received on a dedicated connection that isn't part
+        of the pool. It's reconnected when the connection is lost and all
+        channels are listened to again. Payloads sent while the connection
+        was down are lost.
+
+        :param channel: The name of the channel.
+        :param callback: A callable that gets a ``psycopg2.extensions.Notify``
+                         with ``pid``, ``channel`` and ``payload`` attributes.
+        """
+        self._pool.listen(channel, callback)
+
+    def unlisten(self, channel, callback):
+        """Stop calling ``callback`` for notifications sent to ``channel``.
+
+        :param channel: The name of the channel.
+        :param callback: The callable that was passed to ``listen``.
+        """
+        self._pool.unlisten(channel, callback)
 
     def close(self):
         """Close all connections in the connection pool.
@@ -165,7 +391,7 @@ class AdispClient(AsyncClient):
 
     @async
     @process
-    def chain(self, queries, callback):
+    def chain(self, queries, callback, cancel_token=None):
         """Run a chain of queries in the given order.
 
         A list/tuple with queries looks like this::
@@ -187,19 +413,20 @@ class AdispClient(AsyncClient):
         cursors = []
         for query in queries:
             if isinstance(query, str):
-                cursor = yield self.execute(query)
-            else:
-                cursor = yield self.execute(*query)
+                query = [query]
+            cursor = yield self.execute(*query, cancel_token=cancel_token)
             cursors.append(cursor)
         callback(cursors)
 
     @async
     @process
-    def batch(self, queries, callback):
+    def batch(self, queries, callback, cancel_token=None, max_concurrency=None,
+              fail_fast=False):
         """Run a batch of queries all at once.
 
         **Note:** Every query needs a free connection. So if three queries are
-        are executed, three free connections are used.
+        are executed, three free connections are used. Use ``max_concurrency``
+        to limit the number of connections a batch uses.
 
         A dictionary with queries looks like this::
 
@@ -216,14 +443,27 @@ class AdispClient(AsyncClient):
         :param queries: A dictionary with all the queries.
         :param callback: The function that needs to be executed once all the
                          queries are finished.
+        :param cancel_token: A ``momoko.CancelToken`` to cancel the queries.
+                             Optional.
+        :param max_concurrency: The maximum number of queries that run at the
+                                same time. Optional.
+        :param fail_fast: Cancel the other queries when a query fails.
         :return: A dictionary with the same keys as the given queries with the
-                 resulting cursors as values.
+                 resulting cursors as values. With ``max_concurrency`` or
+                 ``fail_fast`` failed queries have the exception as value and
+                 queries cancelled by ``fail_fast`` have ``None``.
         """
+        if max_concurrency or fail_fast:
+            cursors = yield async(BatchQuery)(self, queries, cancel_token=cancel_token,
+                max_concurrency=max_concurrency, fail_fast=fail_fast)
+            callback(cursors)
+            return
+
         def _exec_query(query, callback):
             if isinstance(query[1], str):
-                cursor = yield self.execute(query[1])
+                cursor = yield self.execute(query[1], cancel_token=cancel_token)
             else:
-                cursor = yield self.execute(*query[1])
+                cursor = yield self.execute(*query[1], cancel_token=cancel_token)
             callback((query[0], cursor))
         cursors = yield list(map(async(process(_exec_query)), queries.items()))
         callback(dict(cursors))
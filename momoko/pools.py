@@ -9,15 +9,19 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import time
+import random
 import logging
 import functools
+from collections import deque
 
 import psycopg2
 from psycopg2 import DatabaseError, InterfaceError
-from psycopg2.extensions import STATUS_READY
+from psycopg2.extensions import STATUS_READY, adapt
 from tornado.ioloop import IOLoop, PeriodicCallback
 
-from .utils import Poller
+from .utils import Poller, QueryEvent
+from .retry import is_connection_error
 
 
 class BlockingPool(object):
@@ -129,11 +133,36 @@ class AsyncPool(object):
     :param min_conn: The minimum amount of connections that is created when a
                      connection pool is created.
     :param max_conn: The maximum amount of connections the connection pool can
-                     have. If the amount of connections exceeds the limit a
-                     ``PoolError`` exception is raised.
+                     have. When all of them are busy new operations wait until
+                     a connection is returned to the pool.
     :param cleanup_timeout: Time in seconds between pool cleanups. Connections
                             will be closed until there are ``min_conn`` left.
     :param ioloop: An instance of Tornado's IOLoop.
+    :param init_sql: A list with SQL statements (e.g. ``SET``) that are
+                     executed once on every new connection. They are sent
+                     in one round trip.
+    :param type_casters: A dictionary with type names and functions that
+                         register typecasters on a new connection, e.g.
+                         ``{'hstore': lambda conn, oid, array_oid:
+                         psycopg2.extras.register_hstore(conn, oid=oid,
+                         array_oid=array_oid)}``. The type oids are looked up
+                         once per pool, together with ``init_sql``.
+    :param reset_sql: SQL that resets the session (e.g. ``RESET ALL``), it's
+                      executed every time a connection is given back to the
+                      pool. Note that ``DISCARD ALL`` also undoes ``init_sql``.
+    :param retry_policy: A ``momoko.RetryPolicy`` for operations that are
+                         marked idempotent.
+    :param circuit_breaker: A ``momoko.CircuitBreaker``. While it's open,
+                            callbacks get a ``CircuitOpenError`` right away.
+    :param autosize: A ``PoolSizer`` that grows and shrinks the pool between
+                     ``min_conn`` and ``max_conn``.
+    :param quotas: A dictionary with tags and the maximum number of
+                   connections operations with that tag may use at the same
+                   time, e.g. ``{'reports': 2}``. Operations over their quota
+                   wait in a queue per tag, other operations share the rest
+                   of the pool.
+    :param budget: A ``momoko.budget.HostBudget`` that limits the number of
+                   connections of all pools on the host.
     :param host: The database host address (defaults to UNIX socket if not provided)
     :param port: The database host port (defaults to 5432 if not provided)
     :param database: The database name
@@ -144,7 +173,9 @@ class AsyncPool(object):
                                should be a callable object taking a dsn argument.
     """
     def __init__(self, min_conn=1, max_conn=20, cleanup_timeout=10,
-                 ioloop=None, *args, **kwargs):
+                 ioloop=None, init_sql=(), type_casters=None, reset_sql=None,
+                 retry_policy=None, circuit_breaker=None, autosize=None,
+                 quotas=None, budget=None, *args, **kwargs):
         self.min_conn = min_conn
         self.max_conn = max_conn
         self.closed = False
@@ -152,17 +183,59 @@ class AsyncPool(object):
         self._args = args
         self._kwargs = kwargs
 
+        if isinstance(init_sql, basestring):
+            init_sql = [init_sql]
+        self._init_sql = list(init_sql)
+        self._type_casters = type_casters or {}
+        self._type_oids = None
+        self._reset_sql = reset_sql
+        self._retry_policy = retry_policy
+        self._circuit_breaker = circuit_breaker
+
         self._pool = []
+        self._listener = None
+        self._listeners = []
+        self._pinned = set()
+        # operations that wait for a connection, with the time they started
+        # waiting
+        self._waiting = deque()
+        self._connecting = 0
+        self._size = max_conn
+        self._quotas = quotas or {}
+        self._tag_busy = dict((tag, 0) for tag in self._quotas)
+        # operations of a tag that wait for a connection or a new connection
+        self._tag_connecting = dict((tag, 0) for tag in self._quotas)
+        self._tag_waiting = dict((tag, deque()) for tag in self._quotas)
+        self._budget = budget
 
         for i in range(self.min_conn):
+            if budget is not None and not budget.acquire():
+                logging.warning('Connection budget of the host is used up')
+                break
             self._new_conn()
 
         # Create a periodic callback that tries to close inactive connections
+        self._cleaner = None
         if cleanup_timeout > 0:
             self._cleaner = PeriodicCallback(self._clean_pool,
                 cleanup_timeout * 1000)
             self._cleaner.start()
 
+        self._sizer = autosize
+        self._resizer = None
+        if autosize is not None:
+            self._size = autosize.size = max(min_conn, 1)
+            self._resizer = PeriodicCallback(self._resize,
+                autosize.interval * 1000)
+            self._resizer.start()
+
+        self._budget_checker = None
+        if budget is not None:
+            self._budget_denied = budget.denied
+            self._budget_checker = PeriodicCallback(self._check_budget,
+                budget.check_interval * 1000)
+            self._budget_checker.start()
+
     def _new_conn(self, new_cursor_args={}):
         """Create a new connection.
 
@@ -171,68 +244,507 @@ class AsyncPool(object):
 
         :param new_cursor_args: Arguments (dictionary) for a new cursor.
         """
-        if len(self._pool) > self.max_conn:
-            raise PoolError('connection pool exausted')
-        conn = psycopg2.connect(async=1, *self._args, **self._kwargs)
-        add_conn = functools.partial(self._add_conn, conn)
+        try:
+            conn = self._connect()
+        except:
+            if self._budget is not None:
+                self._budget.release()
+            raise
+        self._connecting += 1
+        setup_conn = functools.partial(self._setup_conn, conn, new_cursor_args)
+        Poller(conn, (setup_conn,), ioloop=self._ioloop)
 
-        if new_cursor_args:
-            new_cursor_args['connection'] = conn
-            new_cursor = functools.partial(self.new_cursor, **new_cursor_args)
-            Poller(conn, (add_conn, new_cursor), ioloop=self._ioloop)
-        else:
-            Poller(conn, (add_conn,), ioloop=self._ioloop)
+    def _connect(self):
+        """Start a new asynchronous connection. Subclasses can override this
+        to make other connections, e.g. ``momoko.testing.FakeConnection``.
+        """
+        return psycopg2.connect(async=1, *self._args, **self._kwargs)
+
+    def _setup_conn(self, conn, new_cursor_args, error=None):
+        """Set up a new connection.
+
+        This function is used by `_new_conn` as a callback. The init SQL and,
+        if they are not known yet, the lookup of type oids are executed in
+        one query.
+
+        :param conn: A database connection.
+        :param new_cursor_args: Arguments (dictionary) for a new cursor.
+        """
+        lookup = None
+        if error is None:
+            statements = list(self._init_sql)
+            if self._type_casters and self._type_oids is None:
+                statements.append('SELECT typname, oid, typarray FROM pg_type '
+                    'WHERE typname IN %s' % adapt(tuple(self._type_casters)).getquoted())
+            if statements:
+                try:
+                    lookup = conn.cursor()
+                    lookup.execute(';\n'.join(statements))
+                except (DatabaseError, InterfaceError) as e:
+                    error = e
+                else:
+                    add_conn = functools.partial(self._add_conn, conn, new_cursor_args, lookup)
+                    Poller(conn, (add_conn,), ioloop=self._ioloop)
+                    return
+        self._add_conn(conn, new_cursor_args, lookup, error)
 
-    def _add_conn(self, conn):
+    def _add_conn(self, conn, new_cursor_args, lookup=None, error=None):
         """Add a connection to the pool.
 
-        This function is used by `_new_conn` as a callback to add the created
-        connection to the pool.
+        This function is used by `_setup_conn` as a callback to add the
+        created connection to the pool. When connecting or the set up failed,
+        the callback of the pending cursor gets the error.
 
         :param conn: A database connection.
+        :param new_cursor_args: Arguments (dictionary) for a new cursor.
+        :param lookup: A cursor with the result of the type oids lookup.
         """
+        self._connecting -= 1
+        if self.closed:
+            # the budget was given back by close
+            if not conn.closed:
+                conn.close()
+            return
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.record(error)
+        if error is not None:
+            logging.warning('Could not set up connection: %s', error)
+            if not conn.closed:
+                conn.close()
+            if self._budget is not None:
+                self._budget.release()
+            callback = new_cursor_args.get('callback')
+            event = new_cursor_args.get('event')
+            if event:
+                self._query_done(event, callback, None, error)
+            elif callback:
+                callback(None, error)
+            self._released()
+            if new_cursor_args.get('connecting'):
+                tag = new_cursor_args['tag']
+                self._tag_connecting[tag] -= 1
+                if self._tag_waiting[tag]:
+                    self._ioloop.add_callback(functools.partial(self._dispatch_tag, tag))
+            return
+
+        if self._type_casters:
+            if self._type_oids is None:
+                self._type_oids = {}
+                if lookup is not None and lookup.description:
+                    for name, oid, array_oid in lookup.fetchall():
+                        self._type_oids.setdefault(name, (oid, array_oid))
+            for name, register in self._type_casters.iteritems():
+                if name in self._type_oids:
+                    register(conn, *self._type_oids[name])
+                else:
+                    logging.warning('Type %s does not exist', name)
+
         self._pool.append(conn)
+        if new_cursor_args:
+            new_cursor_args['connection'] = conn
+            self.new_cursor(**new_cursor_args)
+        else:
+            # operations may have been waiting for the first connections
+            self._released()
+
+    def _reset_conn(self, conn, error=None):
+        """Reset the session of a connection that is given back to the pool.
 
-    def new_cursor(self, function, func_args=(), callback=None, connection=None):
+        :param conn: A database connection.
+        """
+        if conn.closed:
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self._reset_sql)
+        except (DatabaseError, InterfaceError) as error:
+            logging.warning('Could not reset connection: %s', error)
+        else:
+            # the cursor has to be kept until the query is done
+            Poller(conn, (functools.partial(self._reset_done, cursor),),
+                ioloop=self._ioloop)
+
+    def _reset_done(self, cursor, error=None):
+        if error is not None:
+            logging.warning('Could not reset connection: %s', error)
+        self._released()
+
+    def new_cursor(self, function, func_args=(), callback=None, connection=None,
+                   cancel_token=None, event=None, pin=False, idempotent=False,
+                   tag=None, admitted=False, connecting=False):
         """Create a new cursor.
 
         If there's no connection available, a new connection will be created and
         `new_cursor` will be called again after the connection has been made.
+        When the pool already has its maximum size, the operation waits until
+        a connection is free.
 
         :param function: ``execute``, ``executemany`` or ``callproc``.
         :param func_args: A tuple with the arguments for the specified function.
         :param callback: A callable that is executed once the operation is done.
+        :param cancel_token: A ``CancelToken``. The operation is skipped when
+                             the token is cancelled before it starts and the
+                             query is cancelled when it's running. The
+                             callback isn't called in both cases.
+        :param event: ``False`` to not send events to the listeners for this
+                      operation.
+        :param pin: Keep the connection for the caller, it isn't used for
+                    other operations until it's given back with ``release``.
+                    The connection is ``cursor.connection``, pass it as
+                    ``connection`` to the next operations.
+        :param idempotent: The operation can safely be executed again. With a
+                           ``retry_policy`` it's retried after transient
+                           errors, on another connection.
+        :param tag: The tag of the operation (e.g. an endpoint or a tenant)
+                    for the ``quotas`` of the pool.
+        :param admitted: Used by the pool for operations that waited for the
+                         quota of their tag, they were already let through
+                         by the circuit breaker.
+        :param connecting: Used by the pool for operations that waited for a
+                           connection, they were counted for the quota of
+                           their tag.
         """
-        if not connection:
+        if connecting:
+            self._tag_connecting[tag] -= 1
+        if cancel_token is not None and cancel_token.cancelled:
+            if connection and connection not in self._pinned:
+                # a waiting operation, the connection is free for the next one
+                self._released()
+            return
+        probe = False
+        if not connection and not admitted and self._circuit_breaker is not None:
+            if not self._circuit_breaker.allow_request():
+                if callback:
+                    callback(None, CircuitOpenError('circuit breaker is open'))
+                return
+            probe = self._circuit_breaker.state == self._circuit_breaker.HALF_OPEN
+        if idempotent and not connection and self._retry_policy is not None:
+            self._retry_policy.record_request()
+            callback = functools.partial(self._retry, function, func_args,
+                                         callback, cancel_token, 1, tag)
+        if event is None and self._listeners and not admitted:
+            event = self._new_event(function, func_args)
+
+        over_quota = (tag in self._quotas and connection not in self._pinned and
+                      self._tag_busy[tag] + self._tag_connecting[tag] >= self._quotas[tag])
+        if over_quota or not connection:
+            new_cursor_args = {
+                'function': function,
+                'func_args': func_args,
+                'callback': callback,
+                'cancel_token': cancel_token,
+                'event': event,
+                'pin': pin,
+                'tag': tag
+            }
+            if over_quota:
+                new_cursor_args['admitted'] = True
+                self._tag_waiting[tag].append(new_cursor_args)
+                if connection:
+                    # the connection isn't used, another operation can have it
+                    self._released()
+                return
             connection = self._get_free_conn()
             if not connection:
-                self._new_conn({
-                    'function': function,
-                    'func_args': func_args,
-                    'callback': callback
-                })
+                self._wait_for_conn(new_cursor_args)
                 return
 
+        # a connection that is pinned already belongs to the caller's session
+        pinned = connection in self._pinned
+        if pin:
+            self._pinned.add(connection)
+        if self._sizer is not None:
+            self._sizer.observe_busy(sum(1 for conn in self._pool if conn is connection
+                or conn.isexecuting() or conn in self._pinned))
+
         try:
+            if event:
+                event.checked_out = time.time()
+                event.connection_id = connection.get_backend_pid()
+                event.fire('on_checkout')
+
             cursor = connection.cursor()
             getattr(cursor, function)(*func_args)
 
+            # The connection is always polled, otherwise it stays busy. The
+            # reset is started before the callback, so the callback can't
+            # take the connection in the meantime.
+            callbacks = []
+            if self._circuit_breaker is not None:
+                callbacks.append(self._circuit_breaker.record)
+            if cancel_token is not None:
+                canceller = functools.partial(self._cancel_query, connection)
+                cancel_token.add_callback(canceller)
+                callbacks.append(functools.partial(self._forget_canceller,
+                    cancel_token, canceller))
+            if self._reset_sql and not (pin or pinned):
+                callbacks.append(functools.partial(self._reset_conn, connection))
+            callbacks.append(self._released)
+            if tag in self._quotas:
+                self._tag_busy[tag] += 1
+                callbacks.append(functools.partial(self._tag_released, tag))
             # Callbacks from cursor functions always get the cursor back
-            if callback:
-                Poller(cursor.connection, (functools.partial(callback, cursor),),
-                    ioloop=self._ioloop)
-        except (DatabaseError, InterfaceError):
-            logging.warning('Requested connection was closed')
-            self._pool.remove(connection)
+            done = callback
+            if callback and cancel_token is not None:
+                done = functools.partial(self._unless_cancelled, cancel_token, callback)
+            if event:
+                event.executed = time.time()
+                event.fire('on_execute')
+                callbacks.append(functools.partial(self._query_done, event, done, cursor))
+            elif done:
+                callbacks.append(functools.partial(done, cursor))
+            Poller(cursor.connection, callbacks, ioloop=self._ioloop)
+        except (DatabaseError, InterfaceError) as error:
+            if not connection.closed and not is_connection_error(error):
+                # an error in the query itself, the connection is fine
+                if pin and not pinned:
+                    self._pinned.discard(connection)
+                if self._circuit_breaker is not None:
+                    self._circuit_breaker.record(error)
+                if event:
+                    self._query_done(event, callback, None, error)
+                elif callback:
+                    callback(None, error)
+                return
+            if pinned:
+                # another connection would be outside the caller's session
+                logging.warning('Pinned connection failed: %s', error)
+                self._remove_conn(connection)
+                if self._circuit_breaker is not None:
+                    self._circuit_breaker.record(error)
+                if callback:
+                    callback(None, error)
+                return
+            logging.warning('Requested connection was closed: %s', error)
+            self._remove_conn(connection)
             connection = self._get_free_conn()
             if not connection:
-                self._new_conn({
+                self._wait_for_conn({
                     'function': function,
                     'func_args': func_args,
-                    'callback': callback
+                    'callback': callback,
+                    'cancel_token': cancel_token,
+                    'event': event,
+                    'pin': pin,
+                    'tag': tag
                 })
             else:
-                self.new_cursor(function, func_args, callback, connection)
+                self.new_cursor(function, func_args, callback, connection,
+                                cancel_token, event, pin, tag=tag)
+        except Exception:
+            # e.g. wrong parameters, the query wasn't sent
+            if pin and not pinned:
+                self._pinned.discard(connection)
+            if probe:
+                self._circuit_breaker.release()
+            self._released()
+            raise
+
+    def _retry(self, function, func_args, callback, cancel_token, attempt, tag,
+               cursor, error=None):
+        """Retry a failed idempotent operation when the retry policy allows
+        it, otherwise pass the result on to ``callback``.
+        """
+        if error is not None and not self.closed:
+            delay = self._retry_policy.retry_delay(error, attempt + 1)
+            if delay is not None:
+                logging.warning('Retrying query in %.3fs (attempt %d): %s',
+                                delay, attempt + 1, error)
+                retry = functools.partial(self._retry, function, func_args,
+                                          callback, cancel_token, attempt + 1, tag)
+                self._ioloop.add_timeout(time.time() + delay, functools.partial(
+                    self._retry_now, function, func_args, retry, cancel_token, tag))
+                return
+        if callback and error is not None:
+            callback(cursor, error)
+        elif callback:
+            callback(cursor)
+
+    def _retry_now(self, function, func_args, callback, cancel_token, tag):
+        if not self.closed:
+            self.new_cursor(function, func_args, callback, cancel_token=cancel_token,
+                            tag=tag)
+
+    def release(self, connection):
+        """Give back a connection that was pinned with ``new_cursor``.
+        """
+        if connection not in self._pinned:
+            return
+        self._pinned.discard(connection)
+        if self._reset_sql:
+            self._reset_conn(connection)
+        else:
+            self._released()
+
+    def _remove_conn(self, connection):
+        """Remove a connection that failed from the pool.
+        """
+        self._pinned.discard(connection)
+        if connection in self._pool:
+            self._pool.remove(connection)
+            if self._budget is not None:
+                self._budget.release()
+
+    def _has_room(self):
+        """Return ``True`` when a new connection can be made, it's taken
+        from the budget of the host.
+        """
+        return (len(self._pool) + self._connecting < self._size and
+                (self._budget is None or self._budget.acquire()))
+
+    def _wait_for_conn(self, new_cursor_args):
+        """Make a new connection for an operation or, when the pool has
+        its maximum size, let it wait for a connection. Until it has one it
+        counts as busy for the quota of its tag.
+        """
+        tag = new_cursor_args.get('tag')
+        if tag in self._quotas:
+            self._tag_connecting[tag] += 1
+            new_cursor_args['connecting'] = True
+        if self._has_room():
+            self._new_conn(new_cursor_args)
+        else:
+            self._waiting.append((time.time(), new_cursor_args))
+
+    def _released(self, error=None):
+        """Called when a connection could be free again.
+        """
+        if self._waiting:
+            # not right away, the Poller can call back before new_cursor
+            # returns
+            self._ioloop.add_callback(self._dispatch)
+
+    def _tag_released(self, tag, error=None):
+        """Let the next operation with ``tag`` run when one of its
+        connections is free again.
+        """
+        self._tag_busy[tag] -= 1
+        if self._tag_waiting[tag]:
+            self._ioloop.add_callback(functools.partial(self._dispatch_tag, tag))
+
+    def _dispatch_tag(self, tag):
+        # Operations that are cancelled, fail right away or wait for a
+        # connection don't take the free place, so continue with the next
+        # one. An operation that gets a connection later checks the quota
+        # again.
+        waiting = self._tag_waiting[tag]
+        while (waiting and not self.closed and
+               self._tag_busy[tag] + self._tag_connecting[tag] < self._quotas[tag]):
+            self.new_cursor(**waiting.popleft())
+
+    def _dispatch(self):
+        """Give free connections to waiting operations, or make new
+        connections for them when the pool has room.
+        """
+        while self._waiting and not self.closed:
+            connection = self._get_free_conn()
+            if not connection and not self._has_room():
+                return
+            queued, new_cursor_args = self._waiting.popleft()
+            if self._sizer is not None:
+                self._sizer.observe_wait(time.time() - queued)
+            if connection:
+                new_cursor_args['connection'] = connection
+                self.new_cursor(**new_cursor_args)
+            else:
+                self._new_conn(new_cursor_args)
+
+    def _check_budget(self):
+        """Close idle connections when another process was refused a
+        connection and retry waiting operations.
+        """
+        if self.closed:
+            return
+        denied = self._budget.denied
+        if denied != self._budget_denied:
+            self._budget_denied = denied
+            if not self._waiting:
+                self._close_idle(self.min_conn)
+        if self._waiting:
+            self._dispatch()
+
+    def _resize(self):
+        """Let the ``PoolSizer`` decide on the size of the pool.
+        """
+        if self.closed:
+            return
+        oldest = time.time() - self._waiting[0][0] if self._waiting else 0
+        self._size = self._sizer.resize(max(self.min_conn, 1), self.max_conn, oldest)
+        if self._waiting:
+            self._dispatch()
+        else:
+            self._close_idle(self._size)
+
+    def add_listener(self, listener, sample_rate=1.0):
+        """Send query events to ``listener``.
+
+        A listener is an object with one or more of these methods, every
+        method gets a ``QueryEvent``:
+
+        - ``on_enqueue`` -- the operation is requested.
+        - ``on_checkout`` -- a connection is taken from the pool.
+        - ``on_execute`` -- the query is sent to the server.
+        - ``on_complete`` -- the query is done and the callback has returned.
+        - ``on_error`` -- the query failed, after the callback has returned.
+
+        :param listener: The listener object.
+        :param sample_rate: The fraction of the operations (0 to 1) the
+                            listener gets events for.
+        """
+        self._listeners.append((listener, sample_rate))
+
+    def remove_listener(self, listener):
+        """Stop sending query events to ``listener``.
+        """
+        self._listeners = [(l, rate) for l, rate in self._listeners
+                           if l is not listener]
+
+    def _new_event(self, function, func_args):
+        """Return a ``QueryEvent`` or ``None`` when no listener samples
+        the operation.
+        """
+        listeners = [listener for listener, rate in self._listeners
+                     if rate >= 1 or random.random() < rate]
+        if not listeners:
+            return None
+        event = QueryEvent(listeners, function, *func_args[:2])
+        event.fire('on_enqueue')
+        return event
+
+    def _query_done(self, event, callback, cursor, error=None):
+        event.completed = time.time()
+        event.error = error
+        if cursor is not None:
+            event.rowcount = cursor.rowcount
+        try:
+            if callback and error is not None:
+                callback(cursor, error)
+            elif callback:
+                callback(cursor)
+        finally:
+            event.finished = time.time()
+            event.fire('on_error' if error is not None else 'on_complete')
+
+    def _cancel_query(self, conn):
+        """Ask the server to cancel the query that is running on ``conn``.
+        """
+        if conn.closed or not conn.isexecuting():
+            return
+        try:
+            conn.cancel()
+        except (DatabaseError, InterfaceError) as error:
+            logging.warning('Could not cancel query: %s', error)
+
+    def _forget_canceller(self, cancel_token, canceller, error=None):
+        cancel_token.remove_callback(canceller)
+
+    def _unless_cancelled(self, cancel_token, callback, cursor, error=None):
+        if cancel_token.cancelled:
+            return
+        if error is not None:
+            callback(cursor, error)
+        else:
+            callback(cursor)
 
     def _get_free_conn(self):
         """Look for a free connection and return it.
@@ -242,7 +754,7 @@ class AsyncPool(object):
         if self.closed:
             raise PoolError('connection pool is closed')
         for conn in self._pool:
-            if not conn.isexecuting():
+            if not conn.isexecuting() and conn not in self._pinned:
                 return conn
         return None
 
@@ -252,13 +764,20 @@ class AsyncPool(object):
         """
         if self.closed:
             raise PoolError('connection pool is closed')
-        if len(self._pool) > self.min_conn:
-            conns = len(self._pool) - self.min_conn
+        self._close_idle(self._size if self._sizer is not None else self.min_conn)
+
+    def _close_idle(self, keep):
+        """Close inactive connections until there are ``keep`` connections.
+        """
+        if len(self._pool) > keep:
+            conns = len(self._pool) - keep
             for conn in self._pool[:]:
-                if not conn.isexecuting():
+                if not conn.isexecuting() and conn not in self._pinned:
                     conn.close()
                     conns = conns - 1
                     self._pool.remove(conn)
+                    if self._budget is not None:
+                        self._budget.release()
                     if conns == 0:
                         break
 
@@ -270,10 +789,263 @@ class AsyncPool(object):
         for conn in self._pool:
             if not conn.closed:
                 conn.close()
-        self._cleaner.stop()
+        if self._cleaner:
+            self._cleaner.stop()
+        if self._resizer:
+            self._resizer.stop()
+        if self._budget_checker:
+            self._budget_checker.stop()
+            self._budget.release(len(self._pool) + self._connecting)
+        if self._listener:
+            self._listener.close()
         self._pool = []
         self.closed = True
 
+        waiting = [new_cursor_args for queued, new_cursor_args in self._waiting]
+        for tag_waiting in self._tag_waiting.values():
+            waiting.extend(tag_waiting)
+            tag_waiting.clear()
+        self._waiting.clear()
+        for new_cursor_args in waiting:
+            if new_cursor_args['callback']:
+                new_cursor_args['callback'](None, PoolError('connection pool is closed'))
+
+    def listen(self, channel, callback):
+        """Call ``callback`` with every notification on ``channel``.
+
+        Notifications are received on a dedicated connection that is created
+        the first time ``listen`` is used.
+
+        :param channel: The channel name, it's used as a quoted identifier.
+        :param callback: A callable that gets the ``psycopg2.extensions.Notify``.
+        """
+        if self.closed:
+            raise PoolError('connection pool is closed')
+        if not self._listener:
+            self._listener = Listener(self._ioloop, 1, self._connect)
+        self._listener.subscribe(channel, callback)
+
+    def unlisten(self, channel, callback):
+        """Stop calling ``callback`` for notifications on ``channel``.
+        """
+        if self._listener:
+            self._listener.unsubscribe(channel, callback)
+
+
+class Listener(object):
+    """A dedicated asynchronous connection that listens for notifications.
+
+    ``LISTEN`` is executed for every channel that has subscribers. When the
+    connection is lost a new connection is made after ``reconnect_delay``
+    seconds and all channels are listened to again.
+
+    :param ioloop: An instance of Tornado's IOLoop.
+    :param reconnect_delay: Time in seconds to wait before reconnecting.
+    :param connect: A callable that starts a new asynchronous connection,
+                    ``AsyncPool`` passes its ``_connect``. By default
+                    ``psycopg2.connect`` is used with the arguments below.
+    :param host: The database host address (defaults to UNIX socket if not provided)
+    :param port: The database host port (defaults to 5432 if not provided)
+    :param database: The database name
+    :param user: User name used to authenticate
+    :param password: Password used to authenticate
+    """
+    def __init__(self, ioloop=None, reconnect_delay=1, connect=None, *args, **kwargs):
+        self._ioloop = ioloop or IOLoop.instance()
+        self._reconnect_delay = reconnect_delay
+        self._open = connect or functools.partial(psycopg2.connect, async=1,
+            *args, **kwargs)
+
+        self._channels = {}
+        self._listening = set()
+        self._conn = None
+        self._ready = False
+        self._closed = False
+        self._connect()
+
+    def subscribe(self, channel, callback):
+        self._channels.setdefault(channel, []).append(callback)
+        self._sync()
+
+    def unsubscribe(self, channel, callback):
+        callbacks = self._channels.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self._channels.pop(channel, None)
+        self._sync()
+
+    def close(self):
+        self._closed = True
+        if self._ready:
+            self._ioloop.remove_handler(self._conn.fileno())
+        self._ready = False
+        if self._conn and not self._conn.closed:
+            self._conn.close()
+
+    def _connect(self):
+        if self._closed:
+            return
+        self._ready = False
+        self._listening = set()
+        try:
+            self._conn = self._open()
+        except psycopg2.Error as error:
+            self._lost(error)
+            return
+        Poller(self._conn, (self._connected,), ioloop=self._ioloop)
+
+    def _connected(self, error=None):
+        if error is not None:
+            self._lost(error)
+            return
+        self._ready = True
+        self._ioloop.add_handler(self._conn.fileno(), self._on_read, IOLoop.READ)
+        self._sync()
+
+    def _sync(self):
+        """Execute ``LISTEN`` and ``UNLISTEN`` for changed channels.
+        """
+        if not self._ready or self._conn.isexecuting():
+            return
+        wanted = set(self._channels)
+        statements = ['LISTEN %s' % _quote_ident(c) for c in wanted - self._listening]
+        statements.extend('UNLISTEN %s' % _quote_ident(c) for c in self._listening - wanted)
+        if not statements:
+            return
+
+        # the Poller needs the file descriptor while the query runs
+        self._ioloop.remove_handler(self._conn.fileno())
+        self._ready = False
+        try:
+            cursor = self._conn.cursor()
+            cursor.execute(';\n'.join(statements))
+        except psycopg2.Error as error:
+            self._lost(error)
+            return
+        Poller(self._conn, (functools.partial(self._synced, cursor, wanted),),
+            ioloop=self._ioloop)
+
+    def _synced(self, cursor, wanted, error=None):
+        if error is not None:
+            self._lost(error)
+            return
+        self._listening = wanted
+        self._connected()
+        self._dispatch()
+
+    def _on_read(self, fd, events):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as error:
+            self._ioloop.remove_handler(fd)
+            self._ready = False
+            self._lost(error)
+            return
+        self._dispatch()
+
+    def _dispatch(self):
+        notifies = self._conn.notifies
+        while notifies:
+            notify = notifies.pop(0)
+            for callback in list(self._channels.get(notify.channel, ())):
+                try:
+                    callback(notify)
+                except Exception:
+                    logging.exception('Notification callback failed')
+
+    def _lost(self, error):
+        if self._closed:
+            return
+        logging.warning('Listener connection lost: %s', error)
+        if self._conn and not self._conn.closed:
+            self._conn.close()
+        self._ioloop.add_timeout(time.time() + self._reconnect_delay, self._connect)
+
+
+def _quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class PoolSizer(object):
+    """Grow and shrink an ``AsyncPool`` with the load, between ``min_conn``
+    and ``max_conn``. Pass it to the pool with the ``autosize`` setting::
+
+        db = momoko.AsyncClient({..., 'min_conn': 2, 'max_conn': 50,
+                                 'autosize': momoko.PoolSizer(target_wait=0.01)})
+
+    The pool starts with ``min_conn`` connections and operations wait for a
+    free connection when all of them are busy. Every ``interval`` seconds
+    the pool is grown by ``step`` connections when operations waited longer
+    than ``target_wait`` seconds on average. It's shrunk by ``step`` when
+    the most connections in use at the same time stayed below
+    ``low_utilization`` of the pool for ``shrink_after`` intervals in a row.
+    Growing is fast and shrinking is slow, so the pool doesn't flap between
+    two sizes.
+
+    :param target_wait: Time in seconds operations may wait for a connection.
+    :param low_utilization: The fraction of the pool (0 to 1) that's in use
+                            when the pool is too big.
+    :param interval: Time in seconds between decisions.
+    :param shrink_after: The number of intervals with a low utilization before
+                         the pool is shrunk.
+    :param step: The number of connections to add or remove at once.
+    """
+    def __init__(self, target_wait=0.01, low_utilization=0.5, interval=1.0,
+                 shrink_after=30, step=1):
+        self.target_wait = target_wait
+        self.low_utilization = low_utilization
+        self.interval = interval
+        self.shrink_after = shrink_after
+        self.step = step
+        self.size = None
+        self.mean_wait = 0.0
+        self.peak_busy = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._busy = 0
+        self._low = 0
+
+    def observe_wait(self, wait):
+        """Record the time an operation waited for a connection.
+        """
+        self._waits += 1
+        self._wait_total += wait
+
+    def observe_busy(self, busy):
+        """Record the number of connections in use.
+        """
+        if busy > self._busy:
+            self._busy = busy
+
+    def resize(self, min_size, max_size, oldest_wait=0):
+        """Return the new size of the pool and start a new interval.
+
+        :param oldest_wait: Time in seconds the longest waiting operation has
+                            been waiting so far.
+        """
+        self.mean_wait = self._wait_total / self._waits if self._waits else 0.0
+        self.peak_busy = self._busy
+        if max(self.mean_wait, oldest_wait) > self.target_wait:
+            self.size = min(self.size + self.step, max_size)
+            self._low = 0
+        elif self._busy < self.size * self.low_utilization:
+            self._low += 1
+            if self._low >= self.shrink_after:
+                self.size = max(self.size - self.step, min_size)
+                self._low = 0
+        else:
+            self._low = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._busy = 0
+        return self.size
+
 
 class PoolError(Exception):
     pass
+
+
+class CircuitOpenError(PoolError):
+    """The operation was rejected because the circuit breaker is open.
+    """
@@ -1,23 +1,161 @@
 # -*- coding: utf-8 -*-
+import logging
 import tornado
 from tornado.ioloop import PeriodicCallback
 import time
 import functools
 from momoko.clients import AdispClient, AsyncClient
+from momoko.utils import Loader, get_factory
 import uuid
+import re
+from collections import deque
+from itertools import chain
 try:
     from collections import OrderedDict
 except ImportError:
     from utils import OrderedDict
 import psycopg2
 from psycopg2.extensions import adapt
-from tornado import gen
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 
+OVERFLOW_POLICIES = ('reject', 'drop_oldest', 'block')
+
+# errors caused by the statements themselves, a failed noresult batch is only
+# split to find the failing statements for these
+BISECT_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, psycopg2.ProgrammingError)
+
+INFINITY = float('inf')
+
+
+def _quote_int(value):
+    value = str(value)
+    # keep "1-%s" from turning into a comment
+    if value[0] == '-':
+        return ' ' + value
+    return value
+
+
+def _quote_float(value):
+    if value != value:
+        return "'NaN'::float"
+    if value == INFINITY:
+        return "'Infinity'::float"
+    if value == -INFINITY:
+        return "'-Infinity'::float"
+    value = repr(value)
+    if value[0] == '-':
+        return ' ' + value
+    return value
+
+
+def _quote_unicode(value):
+    return adapt(value.encode('utf-8')).getquoted()
+
+
+def _quote_other(value):
+    return adapt(value).getquoted()
+
+
+# Exact types only: subclasses and everything else go through psycopg2's
+# adapters. Results are the same as of adapt(value).getquoted().
+QUOTERS = {
+    int: _quote_int,
+    long: _quote_int,
+    float: _quote_float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'NULL',
+    unicode: _quote_unicode,
+}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class QueryExpired(Exception):
+    pass
+
+
+# Single-row ``INSERT INTO ... VALUES (...)`` statements; anything with a
+# trailing clause (RETURNING, ON CONFLICT, ...) or a placeholder in the head
+# is left alone.
+INSERT_RE = re.compile(r'^\s*(INSERT\s+INTO\s+[^%;]+?\s+VALUES)\s*(\(.*\))\s*;?\s*$',
+                       re.IGNORECASE | re.DOTALL)
+
+
+def split_insert(sql):
+    '''
+    Split a single-row INSERT into its head, its row and the number of
+    values in the row.
+    Returns ``(head, row, size)`` or ``None`` if statement can't be merged
+    with others.
+    '''
+    match = INSERT_RE.match(sql)
+    if not match:
+        return None
+    head, row = match.groups()
+
+    # row must be exactly one parenthesized group: "(1, 2), (3, 4)" or
+    # "(1) || (2)" are not
+    depth = 0
+    quoted = False
+    size = 1
+    for i, char in enumerate(row):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0 and i != len(row) - 1:
+                return None
+        elif char == ',' and depth == 1:
+            size += 1
+    if depth or quoted:
+        return None
+    return ' '.join(head.split()), row, size
+
+
 class DbQueryQueue(object):
+    '''
+    Queue for queries with results and for queries without results.
+
+    Queries with results are executed ``queue_length`` at a time. Every query
+    has a priority class, ``priorities`` maps each class to its weight, lower
+    number is the more important class. With ``scheduling='weighted'`` classes
+    share slots according to their weights, with ``scheduling='strict'`` a
+    class only gets a slot when all more important classes are empty.
+    ``reserved`` slots can only be used by the most important class.
+    Queries without a priority go to ``default_priority``, by default the
+    least important class, so they can't starve queries that do have one.
+
+    Params are rendered into SQL when a query is queued. With
+    ``bind_params=True`` positional params are kept separately and are
+    passed to psycopg2 when the query is executed.
 
-    def __init__(self, db, ioloop, poll_timeout=0.5, queue_length=5, noresult_poll_timeout=1, noresult_queue_length=5000):
+    Both queues can be limited in items (``max_items``,
+    ``noresult_max_items``) and in bytes of SQL (``max_bytes``,
+    ``noresult_max_bytes``). What happens to a query that doesn't fit is
+    decided by ``overflow``:
+
+    - ``reject`` -- ``QueueFull`` is raised.
+    - ``drop_oldest`` -- the oldest query of the least important class (but
+      not more important than the new query) is dropped, its callback gets
+      ``None`` (``QueueFull`` error for queries without result). When no
+      query can be dropped ``QueueFull`` is raised.
+    - ``block`` -- the query is parked until there is room. Producers should
+      wait with ``wait_for_space`` before adding more queries. At most as
+      many items and bytes as the queue limits are parked, after that
+      ``QueueFull`` is raised.
+    '''
+
+    def __init__(self, db, ioloop, poll_timeout=0.5, queue_length=5, noresult_poll_timeout=1, noresult_queue_length=5000,
+                 merge_inserts=True, priorities=None, scheduling='weighted', reserved=0,
+                 max_items=None, max_bytes=None, noresult_max_items=None, noresult_max_bytes=None,
+                 overflow='reject', bind_params=False, default_priority=None):
         self.db = db
 
         if isinstance(self.db, AdispClient):
@@ -29,18 +167,69 @@ class DbQueryQueue(object):
 
         self.ioloop = ioloop
 
+        assert scheduling in ('weighted', 'strict')
+        assert 0 <= reserved < queue_length
+        self.priorities = priorities or {0: 1}
+        self.scheduling = scheduling
+        self.reserved = reserved
+        self.top_priority = min(self.priorities)
+        if default_priority is None:
+            default_priority = max(self.priorities)
+        assert default_priority in self.priorities
+        self.default_priority = default_priority
+        self.passes = dict((p, 0.0) for p in self.priorities)
+        self.virtual_time = 0.0
+
         self.poll_timeout = poll_timeout
-        self.queue = OrderedDict()
+        self.queues = dict((p, OrderedDict()) for p in self.priorities)
         self.queue_length = queue_length
         self.queue_poll_handler = None
+        self.running = 0
+        self.running_low = 0
+        self.pending = dict((p, deque()) for p in self.priorities)
 
         self.noresult_queue = OrderedDict()
         self.noresult_poll_timeout = noresult_poll_timeout
         self.noresult_queue_dumper = PeriodicCallback(self.noresult_timeout_check, self.noresult_poll_timeout * 1000, io_loop=self.ioloop)
         self.noresult_queue_length = noresult_queue_length
         self.noresult_last_time = None
+        self.merge_inserts = merge_inserts
+        self.bind_params = bind_params
+        self.insert_templates = {}
+
+        assert overflow in OVERFLOW_POLICIES
+        self.overflow = overflow
+        self.limits = {
+            False: (max_items, max_bytes),
+            True: (noresult_max_items, noresult_max_bytes),
+        }
+        self.queue_bytes = 0
+        self.noresult_bytes = 0
+        self.parked = {False: deque(), True: deque()}
+        self.parked_bytes = {False: 0, True: 0}
+        self.waiters = {False: deque(), True: deque()}
+        self.dropped = 0
+        self.rejected = 0
+        self.expired = 0
+        self.failed = 0
+        self.bisected = 0
+
         self.periodic_purge = PeriodicCallback(self.purge_expired, 30 * 1000, io_loop=self.ioloop)
 
+    @property
+    def queue(self):
+        '''
+        Queued queries with results, as before priority classes were added.
+        With one class it's the queue itself, otherwise a copy of all classes
+        in order of priority.
+        '''
+        if len(self.queues) == 1:
+            return self.queues[self.top_priority]
+        queue = OrderedDict()
+        for priority in sorted(self.queues):
+            queue.update(self.queues[priority])
+        return queue
+
     def start(self):
         '''
         Start queue polling
@@ -58,101 +247,397 @@ class DbQueryQueue(object):
         self.periodic_purge.stop()
         if self.queue_poll_handler:
             self.ioloop.remove_timeout(self.queue_poll_handler)
+            self.queue_poll_handler = None
 
     def format_sql(self, sql_tmpl, params=None):
-        if params:
-            if isinstance(params, dict):
-                adapted = {}
-                for k in params.keys():
-                    if isinstance(params[k], unicode):
-                        params[k] = params[k].encode('utf-8')
-                    adapted[k] = adapt(params[k]).getquoted()
-                sql = sql_tmpl % adapted
-            elif isinstance(params, (list, tuple)):
-                adapted = []
-                for p in params:
-                    if isinstance(p, unicode):
-                        p = p.encode('utf-8')
-                    adapted.append(adapt(p).getquoted())
-                adapted = tuple(adapted)
-            sql = sql_tmpl % adapted
+        '''
+        Render params into SQL template. ``params`` is not modified.
+        '''
+        if not params:
+            return sql_tmpl
+        get = QUOTERS.get
+        if isinstance(params, dict):
+            adapted = {}
+            for k, v in params.iteritems():
+                adapted[k] = get(type(v), _quote_other)(v)
         else:
-            sql = sql_tmpl
-        return sql
+            adapted = tuple([get(type(p), _quote_other)(p) for p in params])
+        return sql_tmpl % adapted
+
+    def bind(self, sql_tmpl, params=None):
+        '''
+        Get ``(sql, params)`` to keep in the queue. With ``bind_params``
+        positional params are kept apart from SQL and psycopg2 renders them
+        when query is executed, everything else is rendered right away.
+        '''
+        if self.bind_params and params and not isinstance(params, dict):
+            return sql_tmpl, tuple(params)
+        return self.format_sql(sql_tmpl, params), None
 
-    def fetchone(self, sql_tmpl, params=None, callback=None, timeout=5*60):
-        self.execute(sql_tmpl, params, command='fetchone', callback=callback, timeout=timeout)
+    def fetchone(self, sql_tmpl, params=None, callback=None, timeout=5*60, priority=None,
+                 error_callback=None):
+        self.execute(sql_tmpl, params, command='fetchone', callback=callback, timeout=timeout,
+                     priority=priority, error_callback=error_callback)
 
-    def fetchall(self, sql_tmpl, params=None, callback=None, timeout=5*60):
-        self.execute(sql_tmpl, params, command='fetchall', callback=callback, timeout=timeout)
+    def fetchall(self, sql_tmpl, params=None, callback=None, timeout=5*60, priority=None,
+                 error_callback=None):
+        self.execute(sql_tmpl, params, command='fetchall', callback=callback, timeout=timeout,
+                     priority=priority, error_callback=error_callback)
+
+    def loader(self, sql_tmpl, key_column=0, many=False, window=0, max_keys=1000, priority=None):
+        '''
+        Create a ``momoko.utils.Loader`` that merges point lookups into one
+        queued query, e.g. ``SELECT id, name FROM users WHERE id = ANY(%s)``.
+        '''
+        def fetch(sql, params, callback):
+            # failed, expired and dropped lookups fail the pending keys
+            # instead of caching them as missing
+            self.fetchall(sql, params, callback=callback, priority=priority,
+                          error_callback=functools.partial(callback, None))
+        return Loader(fetch, sql_tmpl, key_column, many, window, max_keys, self.ioloop)
 
-    def execute(self, sql_tmpl, params=None, command='', callback=None, timeout=5*60):
-        assert command in ('fetchall', 'fetchone')
-        sql = self.format_sql(sql_tmpl, params)
+    def execute(self, sql_tmpl, params=None, command='', callback=None, timeout=5*60, priority=None,
+                error_callback=None):
+        '''
+        Queue query with result.
+        :param command: ``fetchall``, ``fetchone`` or other result factory
+                        (``tuples``, ``records``, ``columns`` or a callable
+                        that takes the cursor).
+        :param error_callback: Callback that gets the error when query failed,
+                               expired (``QueryExpired``) or was dropped
+                               (``QueueFull``). Without it ``callback`` gets
+                               ``None`` in these cases.
+        '''
+        command = get_factory(command)
+        if priority is None:
+            priority = self.default_priority
+        assert priority in self.queues
+        sql, params = self.bind(sql_tmpl, params)
         key = str(uuid.uuid4())
         expires_at = time.time() + timeout
-        self.queue[key] = (sql, callback, key, command, expires_at)
+        item = (sql, callback, key, command, expires_at, params, error_callback)
+        if self.admit(False, len(sql), priority):
+            self.push(priority, item)
+        else:
+            self.park(False, len(sql), functools.partial(self.push, priority, item))
 
-    @gen.engine
-    def poller(self):
-        i = 0
-        self.temp_queries = OrderedDict()
+    def push(self, priority, item):
+        queue = self.queues[priority]
+        if not queue:
+            # class becomes active: don't let it spend credit saved while idle
+            self.passes[priority] = max(self.passes[priority], self.virtual_time)
+        queue[item[2]] = item
+        self.queue_bytes += len(item[0])
 
-        while self.queue and i < self.queue_length:
-            i += 1
-            uid, item = self.queue.popitem(last=False)  # FIFO
-            self.temp_queries[uid] = item
+    def has_room(self, noresult=False, size=0):
+        '''
+        Check if a query of ``size`` bytes fits in the queue.
+        '''
+        max_items, max_bytes = self.limits[noresult]
+        if noresult:
+            items, used = len(self.noresult_queue), self.noresult_bytes
+        else:
+            items, used = sum(len(q) for q in self.queues.itervalues()), self.queue_bytes
+        if max_items is not None and items >= max_items:
+            return False
+        # a single query bigger than the limit still gets in when queue is empty
+        if max_bytes is not None and items and used + size > max_bytes:
+            return False
+        return True
 
-        if not self.temp_queries:
-            self.queue_poll_handler = self.ioloop.add_timeout(time.time()+self.poll_timeout, self.poller)
-            return
+    def admit(self, noresult, size, priority=None):
+        '''
+        Make room for a new query according to the overflow policy.
+        Returns ``False`` when the query has to be parked.
+        '''
+        # parked queries go first, a new query is parked behind them
+        if not self.parked[noresult]:
+            while not self.has_room(noresult, size):
+                if self.overflow == 'reject':
+                    self.reject(noresult)
+                elif self.overflow == 'drop_oldest':
+                    if not self.drop_oldest(noresult, priority):
+                        self.reject(noresult)
+                else:
+                    break
+            else:
+                return True
+        if not self.has_parking_room(noresult, size):
+            self.reject(noresult)
+        return False
 
-        keys = []
-        for sql, callback, uid, command, exp_at in self.temp_queries.values():
-            keys.append(uid)
-            self._execute(sql, callback=(yield gen.Callback(uid)))
+    def reject(self, noresult):
+        self.rejected += 1
+        raise QueueFull('%s queue is full' % ('noresult' if noresult else 'result'))
 
-        cursors = yield gen.WaitAll(keys)
+    def has_parking_room(self, noresult, size):
+        '''
+        Check if a query of ``size`` bytes can be parked, the parking has
+        the same limits as the queue.
+        '''
+        max_items, max_bytes = self.limits[noresult]
+        parked = self.parked[noresult]
+        if max_items is not None and len(parked) >= max_items:
+            return False
+        if max_bytes is not None and parked and self.parked_bytes[noresult] + size > max_bytes:
+            return False
+        return True
 
-        for uid, cursor in zip(keys, cursors):
-            sql, callback, uid, command, exp_at = self.temp_queries.pop(uid)
+    def park(self, noresult, size, push):
+        self.parked[noresult].append((size, push))
+        self.parked_bytes[noresult] += size
+
+    def drop_oldest(self, noresult=False, priority=None):
+        '''
+        Drop the oldest query of the least important class that isn't more
+        important than ``priority``. Returns ``False`` when there is no
+        such query.
+        '''
+        if noresult:
+            if not self.noresult_queue:
+                return False
+            self.dropped += 1
+            uid, item = self.noresult_queue.popitem(last=False)
+            self.noresult_bytes -= len(item[0]) + len(item[3] or '')
+            callback = item[1]
+            if callback:
+                self.ioloop.add_callback(functools.partial(callback, QueueFull('query was dropped')))
+            return True
+        candidates = [p for p, q in self.queues.iteritems()
+                      if q and (priority is None or p >= priority)]
+        if not candidates:
+            return False
+        self.dropped += 1
+        uid, item = self.queues[max(candidates)].popitem(last=False)
+        self.queue_bytes -= len(item[0])
+        self.ioloop.add_callback(functools.partial(self.fail, item, QueueFull('query was dropped')))
+        return True
+
+    def fail(self, item, error):
+        '''
+        Pass error of query with result to its error callback, or ``None`` to
+        its callback.
+        '''
+        callback, error_callback = item[1], item[6]
+        if error_callback:
+            error_callback(error)
+        elif callback:
+            callback(None)
+
+    def release(self, noresult=False):
+        '''
+        Move parked queries into the queue and wake up waiting producers
+        once there is room again.
+        '''
+        parked = self.parked[noresult]
+        while parked and self.has_room(noresult, parked[0][0]):
+            size, push = parked.popleft()
+            self.parked_bytes[noresult] -= size
+            push()
+        waiters = self.waiters[noresult]
+        while waiters and not parked and self.has_room(noresult):
+            self.ioloop.add_callback(waiters.popleft())
+
+    def wait_for_space(self, callback, noresult=False):
+        '''
+        Call ``callback`` once there is room in the queue.
+        Can be used with ``gen.Task``.
+        :param noresult: Wait for the noresult queue instead of the result queue.
+        '''
+        self.waiters[noresult].append(callback)
+        self.release(noresult)
+
+    def stats(self):
+        '''
+        Queue depth and counters.
+        '''
+        return {
+            'queued': sum(len(q) for q in self.queues.itervalues()),
+            'queued_bytes': self.queue_bytes,
+            'running': self.running,
+            'parked': len(self.parked[False]),
+            'parked_bytes': self.parked_bytes[False],
+            'noresult_queued': len(self.noresult_queue),
+            'noresult_bytes': self.noresult_bytes,
+            'noresult_parked': len(self.parked[True]),
+            'noresult_parked_bytes': self.parked_bytes[True],
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+            'expired': self.expired,
+            'noresult_failed': self.failed,
+            'noresult_bisected': self.bisected,
+        }
+
+    def next_priority(self):
+        '''
+        Choose the priority class to take the next query from.
+        ``None`` is returned when nothing can be dispatched now.
+        '''
+        low_limit = self.queue_length - self.reserved
+        candidates = [p for p, queue in self.queues.iteritems()
+                      if queue and (p == self.top_priority or self.running_low < low_limit)]
+        if not candidates:
+            return None
+        if self.scheduling == 'strict':
+            return min(candidates)
+
+        # weighted fair: class with the least consumed share goes first
+        priority = min(candidates, key=lambda p: (self.passes[p], p))
+        self.virtual_time = self.passes[priority]
+        self.passes[priority] += 1.0 / self.priorities[priority]
+        return priority
+
+    def poller(self):
+        self.dispatch()
+        self.queue_poll_handler = self.ioloop.add_timeout(time.time()+self.poll_timeout, self.poller)
+
+    def dispatch(self):
+        '''
+        Execute queued queries while there are free slots.
+        '''
+        while self.running < self.queue_length:
+            priority = self.next_priority()
+            if priority is None:
+                break
+            uid, item = self.queues[priority].popitem(last=False)  # FIFO
+            self.queue_bytes -= len(item[0])
+            self.running += 1
+            if priority != self.top_priority:
+                self.running_low += 1
+            # [item, cursor, error]; results are handed out in FIFO order
+            # within a priority class
+            pending = [item, None, None]
+            self.pending[priority].append(pending)
+            self._execute(item[0], item[5], callback=functools.partial(self.on_result, priority, pending))
+        self.release()
+
+    def on_result(self, priority, pending, cursor, error=None):
+        self.running -= 1
+        if priority != self.top_priority:
+            self.running_low -= 1
+        pending[1] = cursor
+        pending[2] = error or True
+
+        waiting = self.pending[priority]
+        while waiting and waiting[0][2]:
+            item, cursor, error = waiting.popleft()
+            callback, command = item[1], item[3]
             try:
-                data = getattr(cursor, command)()
-                callback(data)
+                if error is not True:
+                    self.fail(item, error)
+                    continue
+                data = command(cursor)
+                if callback:
+                    callback(data)
             except Exception as e:
                 print 'DBQUERY-QUEUE:ERROR:', e.message
 
-        # if queue is not empty - call poller without timeout
-        if self.queue:
-            self.ioloop.add_callback(self.poller)
-        else:
-            self.queue_poll_handler = self.ioloop.add_timeout(time.time()+self.poll_timeout, self.poller)
+        # slot is free - don't wait for next poll
+        if self.queue_poll_handler:
+            self.ioloop.add_callback(self.dispatch)
 
     def purge_expired(self):
         cur_time = time.time()
-        new_queue = OrderedDict()
-        for k, v in self.queue.iteritems():
-            callback = v[1]
-            expires_at = v[4]
-            if cur_time > expires_at:
-                self.ioloop.add_callback(functools.partial(callback, None))
-            else:
-                new_queue[k] = v
-        self.queue = new_queue
+        for priority, queue in self.queues.items():
+            new_queue = OrderedDict()
+            for k, v in queue.iteritems():
+                expires_at = v[4]
+                if cur_time > expires_at:
+                    self.expired += 1
+                    self.queue_bytes -= len(v[0])
+                    self.ioloop.add_callback(functools.partial(self.fail, v, QueryExpired('query expired')))
+                else:
+                    new_queue[k] = v
+            self.queues[priority] = new_queue
+        self.release()
 
     def execute_noresult(self, sql_tmpl, params=None, callback=None):
         '''
         Execute query without result
         :param sql_tmpl: Template of SQL query of SQL query if params is None.
         :param params: Tuple, list or dict of params.
-        :param callback: Callback to execute after query is complete.
+        :param callback: Callback to execute after query is complete. It gets
+                         no arguments when query succeeded and the error when
+                         query failed or was dropped.
         '''
-        sql = self.format_sql(sql_tmpl, params)
+        sql, bound = self.bind(sql_tmpl, params)
+        head, row = self.split_noresult(sql_tmpl, params)
         key = str(uuid.uuid4())
-        self.noresult_queue[key] = (sql, callback)
+        item = (sql, callback, head, row, bound)
+        size = len(sql) + len(row or '')
+        if self.admit(True, size):
+            self.push_noresult(key, item)
+        else:
+            self.park(True, size, functools.partial(self.push_noresult, key, item))
+
+    def push_noresult(self, key, item):
+        self.noresult_queue[key] = item
+        self.noresult_bytes += len(item[0]) + len(item[3] or '')
 
         if len(self.noresult_queue) >= self.noresult_queue_length:
             self.ioloop.add_callback(self.execute_noresult_queue)
+        else:
+            # flush early when limits are reached, waiting for the timer
+            # would only keep producers blocked
+            max_items, max_bytes = self.limits[True]
+            if ((max_items is not None and len(self.noresult_queue) >= max_items) or
+                    (max_bytes is not None and self.noresult_bytes >= max_bytes)):
+                self.ioloop.add_callback(self.execute_noresult_queue)
+
+    def split_noresult(self, sql_tmpl, params=None):
+        '''
+        Get ``((head, size), row)`` of single-row INSERT for merging into
+        multi-row INSERT with other queued rows of the same head and number
+        of values. ``(None, None)`` is returned when query can't be merged.
+        '''
+        if not self.merge_inserts:
+            return None, None
+        if params:
+            # templates are reused, so cache them
+            try:
+                split = self.insert_templates[sql_tmpl]
+            except KeyError:
+                split = self.insert_templates[sql_tmpl] = split_insert(sql_tmpl)
+        else:
+            # rendered SQL can be anything, don't fill the cache with it
+            split = split_insert(sql_tmpl)
+        if split is None:
+            return None, None
+        head, row, size = split
+        return (head, size), self.bind(row, params)[0]
+
+    def join_noresult(self, items):
+        '''
+        Join queued items into one SQL string and params for it.
+        Consecutive INSERTs with the same head and number of values are
+        merged into a single multi-row INSERT, so order of statements is kept.
+        '''
+        bound = [item[4] for item in items if item[4] is not None]
+        params = None
+        if bound:
+            # SQL goes through psycopg2 formatting, so rendered parts need
+            # their % escaped
+            params = tuple(chain.from_iterable(bound))
+            items = [item if item[4] is not None else
+                     (item[0].replace('%', '%%'), item[1], item[2],
+                      item[3] and item[3].replace('%', '%%'), None)
+                     for item in items]
+
+        statements = []
+        rows = []
+        head = None
+        for sql, callback, insert_head, row, unused in items:
+            if rows and insert_head != head:
+                statements.append('%s %s' % (head[0], ',\n'.join(rows)))
+                rows = []
+            if insert_head is None:
+                statements.append(sql)
+            else:
+                head = insert_head
+                rows.append(row)
+        if rows:
+            statements.append('%s %s' % (head[0], ',\n'.join(rows)))
+        return ';\n'.join(statements), params
 
     def noresult_timeout_check(self):
         '''
@@ -169,21 +654,50 @@ class DbQueryQueue(object):
         if not self.noresult_queue:
             return
 
-        callbacks = []
-        sql_defs = []
+        items = []
         while self.noresult_queue:
             uid, item = self.noresult_queue.popitem(last=False)
-            sql, callback = item
-            sql_defs.append(sql)
-            if callback:
-                callbacks.append(callback)
-        sql = ';\n'.join(sql_defs)
-
-        callback = functools.partial(self.perform_callbacks, callbacks=callbacks)
-        self._execute(sql, callback=callback)
+            items.append(item)
+        self.noresult_bytes = 0
+        self.execute_noresult_items(items)
 
         self.noresult_last_time = time.time()
+        self.release(True)
 
-    def perform_callbacks(self, cursor, callbacks=None):
-        for callback in callbacks:
-            callback()
+    def execute_noresult_items(self, items, done=None):
+        '''
+        Execute items in single query.
+        A query that failed because of bad data or SQL is split in halves
+        that are executed one after another, until the failing statements
+        are found, the rest is still applied. Other errors (e.g. a lost
+        connection) fail all items.
+        :param done: Callable that is executed after all callbacks of items.
+        '''
+        sql, params = self.join_noresult(items)
+        callback = functools.partial(self.perform_callbacks, items, done)
+        self._execute(sql, params, callback=callback)
+
+    def perform_callbacks(self, items, done, cursor, error=None):
+        if isinstance(error, BISECT_ERRORS) and len(items) > 1:
+            # whole query was rolled back, retry halves
+            self.bisected += 1
+            middle = len(items) // 2
+            self.execute_noresult_items(items[:middle],
+                functools.partial(self.execute_noresult_items, items[middle:], done))
+            return
+
+        if error is not None:
+            self.failed += 1
+        for item in items:
+            callback = item[1]
+            if not callback:
+                continue
+            try:
+                if error is None:
+                    callback()
+                else:
+                    callback(error)
+            except Exception:
+                logging.exception('DBQUERY-QUEUE: noresult callback failed')
+        if done:
+            done()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.retry
+    ~~~~~~~~~~~~
+
+    Retrying idempotent queries after transient errors and a circuit
+    breaker for an unhealthy database.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import time
+import random
+
+import psycopg2
+
+
+# serialization_failure and deadlock_detected
+RETRY_PGCODES = frozenset(['40001', '40P01'])
+
+# admin_shutdown, crash_shutdown and cannot_connect_now
+CONNECTION_PGCODES = frozenset(['57P01', '57P02', '57P03'])
+
+
+def is_connection_error(error):
+    """Return ``True`` when ``error`` means that the connection was lost (or
+    couldn't be made), as opposed to an error in the query.
+    """
+    if not isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        return False
+    code = getattr(error, 'pgcode', None)
+    return code is None or code.startswith('08') or code in CONNECTION_PGCODES
+
+
+def is_transient_error(error):
+    """Return ``True`` when a query that failed with ``error`` may succeed
+    when it's executed again: a lost connection, a serialization failure or
+    a deadlock.
+    """
+    return (getattr(error, 'pgcode', None) in RETRY_PGCODES or
+            is_connection_error(error))
+
+
+class RetryPolicy(object):
+    """Retry idempotent operations that failed with a transient error (see
+    ``is_transient_error``). Pass it to the pool with the ``retry_policy``
+    setting and mark operations with ``idempotent=True``::
+
+        db = momoko.AsyncClient({..., 'retry_policy': momoko.RetryPolicy()})
+        db.execute('SELECT * FROM users WHERE id = %s', (42,),
+                   callback=on_user, idempotent=True)
+
+    Retries wait for a random time between zero and ``base_delay * 2 **
+    (attempt - 1)`` seconds (at most ``max_delay``), so clients that failed
+    at the same time don't retry at the same time.
+
+    A retry budget keeps retries from multiplying the load when the
+    database is down: every operation adds ``budget_ratio`` to the budget
+    and ``budget_per_second`` is added every second, up to ``max_budget``.
+    A retry takes one from the budget and there are no retries when it's
+    empty.
+
+    :param max_attempts: The maximum number of attempts, including the first.
+    :param base_delay: The delay before the first retry in seconds.
+    :param max_delay: The maximum delay in seconds.
+    :param budget_ratio: The budget an operation adds, ``0.1`` allows one
+                         retry for every ten operations.
+    :param budget_per_second: The budget that's added every second.
+    :param max_budget: The maximum budget, it's also the starting budget.
+    """
+    def __init__(self, max_attempts=3, base_delay=0.05, max_delay=2.0,
+                 budget_ratio=0.1, budget_per_second=1.0, max_budget=10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_per_second = budget_per_second
+        self.max_budget = max_budget
+        self.budget = max_budget
+        self.retries = 0
+        self.exhausted = 0
+        self._updated = time.time()
+
+    def record_request(self):
+        """Add the budget of an operation.
+        """
+        self.budget = min(self.budget + self.budget_ratio, self.max_budget)
+
+    def retry_delay(self, error, attempt):
+        """Return the time in seconds to wait before attempt number
+        ``attempt`` (the first retry is attempt 2), or ``None`` when the
+        operation shouldn't be retried.
+        """
+        if attempt > self.max_attempts or not is_transient_error(error):
+            return None
+
+        now = time.time()
+        self.budget = min(self.budget + (now - self._updated) * self.budget_per_second,
+                          self.max_budget)
+        self._updated = now
+        if self.budget < 1:
+            self.exhausted += 1
+            return None
+        self.budget -= 1
+        self.retries += 1
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 2)))
+
+
+class CircuitBreaker(object):
+    """Reject operations right away while the database seems to be down,
+    instead of letting every operation wait for its own connection attempt
+    to fail. Pass it to the pool with the ``circuit_breaker`` setting::
+
+        breaker = momoko.CircuitBreaker(failure_threshold=5, reset_timeout=10)
+        db = momoko.AsyncClient({..., 'circuit_breaker': breaker})
+
+    The breaker is ``closed`` at first and operations run as usual. After
+    ``failure_threshold`` failures in a row it's ``open`` and callbacks get a
+    ``momoko.CircuitOpenError`` immediately. After ``reset_timeout``
+    seconds it's ``half-open``: ``half_open_probes`` operations are let
+    through and the breaker is closed when one succeeds or opened again
+    when one fails. A probe that doesn't get a result (e.g. because it was
+    cancelled) gives its place to another operation after ``probe_timeout``
+    seconds.
+
+    Failed connection attempts and queries that failed because the
+    connection was lost count as failures (see ``is_failure``), errors in
+    queries don't.
+
+    :param failure_threshold: The number of failures in a row that opens the
+                              breaker.
+    :param reset_timeout: Time in seconds before an open breaker lets probes
+                          through.
+    :param half_open_probes: The number of operations that are let through
+                             at the same time while half-open.
+    :param probe_timeout: Time in seconds after which a probe doesn't count
+                          anymore, ``reset_timeout`` by default.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10, half_open_probes=1,
+                 probe_timeout=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.probe_timeout = reset_timeout if probe_timeout is None else probe_timeout
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+        # start times of the running probes
+        self._probes = []
+
+    @property
+    def state(self):
+        """``closed``, ``open`` or ``half-open``.
+        """
+        if (self._state == self.OPEN and
+                time.time() >= self.opened_at + self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self._probes = []
+        return self._state
+
+    def is_failure(self, error):
+        """Return ``True`` when ``error`` counts as a failure. Override this
+        to count other errors too, e.g. statement timeouts.
+        """
+        return is_connection_error(error)
+
+    def allow_request(self):
+        """Return ``True`` when an operation may run.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            now = time.time()
+            self._probes = [started for started in self._probes
+                            if now - started < self.probe_timeout]
+            if len(self._probes) < self.half_open_probes:
+                self._probes.append(now)
+                return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        """Give back the place of a probe that ended without a result, e.g.
+        because the operation failed before it was sent.
+        """
+        if self.state == self.HALF_OPEN and self._probes:
+            self._probes.pop(0)
+
+    def record(self, error=None):
+        """Record the result of an operation or a connection attempt.
+        """
+        state = self.state
+        if error is not None and not self.is_failure(error):
+            error = None
+        if state == self.HALF_OPEN:
+            if self._probes:
+                self._probes.pop(0)
+            if error is not None:
+                self._open()
+            else:
+                self._state = self.CLOSED
+                self.failures = 0
+        elif state == self.CLOSED:
+            if error is None:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self._open()
+
+    def _open(self):
+        self._state = self.OPEN
+        self.opened_at = time.time()
+        self._probes = []
+
+    def status(self):
+        """Return the state as a dictionary, e.g. for a health check.
+        """
+        state = self.state
+        return {
+            'state': state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'opened_at': self.opened_at,
+            'retry_at': (self.opened_at + self.reset_timeout
+                         if state == self.OPEN else None),
+        }
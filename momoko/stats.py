@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.stats
+    ~~~~~~~~~~~~
+
+    Client-side query statistics per query fingerprint and a slow query log.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import functools
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from .utils import OrderedDict
+
+
+slow_log = logging.getLogger('momoko.slow')
+
+_LITERALS_RE = re.compile(r"""
+      [eE]?'(?:[^']|'')*'           # string literals
+    | \$([A-Za-z_]*)\$.*?\$\1\$      # dollar quoted strings
+    | %\(\w+\)s | %s                # placeholders
+    | (?<![\w$."])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?  # numbers
+    """, re.VERBOSE | re.DOTALL)
+_LISTS_RE = re.compile(r'\?(?:\s*,\s*\?)+')
+_ROWS_RE = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+_SPACE_RE = re.compile(r'\s+')
+
+_fingerprints = {}
+
+
+def fingerprint(sql):
+    """Normalize a query into a fingerprint, literals and placeholders are
+    replaced by ``?``, lists of them (``IN (1, 2, 3)``, multi-row
+    ``VALUES``) are collapsed into one and white space is normalized::
+
+        >>> fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'")
+        'SELECT * FROM t WHERE id IN (?) AND name = ?'
+    """
+    try:
+        return _fingerprints[sql]
+    except KeyError:
+        pass
+    result = _LITERALS_RE.sub('?', sql)
+    result = _LISTS_RE.sub('?', result)
+    result = _ROWS_RE.sub('(?)', result)
+    result = _SPACE_RE.sub(' ', result).strip()
+    if len(_fingerprints) >= 10000:
+        _fingerprints.clear()
+    _fingerprints[sql] = result
+    return result
+
+
+class QueryStatsEntry(object):
+    """Statistics of one fingerprint. Times are in seconds, ``total_time``
+    and ``max_time`` are measured from sending the query until receiving the
+    result and ``total_wait`` is the time it took to get a connection.
+    """
+    __slots__ = ('fingerprint', 'calls', 'errors', 'rows', 'total_time',
+                 'max_time', 'total_wait')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def as_dict(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_time': self.total_time,
+            'mean_time': self.mean_time,
+            'max_time': self.max_time,
+            'total_wait': self.total_wait,
+        }
+
+
+class QueryStats(object):
+    """A query listener that keeps statistics per query fingerprint, like
+    ``pg_stat_statements`` does on the server::
+
+        stats = momoko.QueryStats(slow_threshold=0.5)
+        db.add_listener(stats)
+        ...
+        for entry in stats.top(10):
+            print entry['fingerprint'], entry['calls'], entry['total_time']
+
+    The table keeps at most ``max_entries`` fingerprints, the least recently
+    used fingerprint is removed when a new one doesn't fit.
+
+    Queries that take longer than ``slow_threshold`` seconds are logged to
+    the ``momoko.slow`` logger. Only the fingerprint is logged, the literals
+    and parameters are left out.
+
+    :param max_entries: Maximum number of fingerprints.
+    :param slow_threshold: Time in seconds, ``None`` disables the slow query
+                           log.
+    """
+    def __init__(self, max_entries=1000, slow_threshold=None):
+        self.max_entries = max_entries
+        self.slow_threshold = slow_threshold
+        self.evicted = 0
+        self._entries = OrderedDict()
+
+    def on_complete(self, event):
+        self._record(event)
+
+    def on_error(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        if event.executed is None:
+            # connecting failed, no query was sent
+            return
+        key = fingerprint(event.query)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = QueryStatsEntry(key)
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        self._entries[key] = entry
+
+        elapsed = event.server_time
+        entry.calls += 1
+        entry.total_time += elapsed
+        entry.total_wait += event.wait_time
+        if elapsed > entry.max_time:
+            entry.max_time = elapsed
+        if event.error is not None:
+            entry.errors += 1
+        elif event.rowcount > 0:
+            entry.rows += event.rowcount
+
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.log_slow(event, key)
+
+    def log_slow(self, event, fingerprint):
+        """Write a slow query to the log. Override this to send it somewhere
+        else.
+        """
+        slow_log.warning('Slow query (%.3fs, %d rows, pid %s): %s', event.server_time,
+                         max(event.rowcount, 0), event.connection_id, fingerprint)
+
+    def get(self, sql):
+        """Return the statistics (a dictionary) of the fingerprint of ``sql``
+        or ``None``.
+        """
+        entry = self._entries.get(fingerprint(sql))
+        return entry.as_dict() if entry is not None else None
+
+    def top(self, n=None, key='total_time'):
+        """Return the statistics of the fingerprints as a list of
+        dictionaries, sorted by ``key`` (``calls``, ``errors``, ``rows``,
+        ``total_time``, ``mean_time``, ``max_time`` or ``total_wait``).
+        """
+        entries = sorted((entry.as_dict() for entry in self._entries.values()),
+                         key=lambda entry: entry[key], reverse=True)
+        return entries[:n] if n is not None else entries
+
+    def reset(self):
+        """Forget all statistics.
+        """
+        self._entries.clear()
+        self.evicted = 0
+
+
+_EXPLAINABLE_RE = re.compile(r'^\s*(SELECT|WITH|VALUES|INSERT|UPDATE|DELETE)\b', re.I)
+_PLAN_KEYS = ('Node Type', 'Relation Name', 'Index Name', 'Join Type',
+              'Strategy', 'Parent Relationship', 'Scan Direction')
+
+
+def plan_hash(plan):
+    """Return a hash of the shape of a JSON plan: node types, relations,
+    indexes and join types. Costs and row estimates are left out, so the
+    hash only changes when the plan itself changes.
+    """
+    def shape(node):
+        return [[node.get(key) for key in _PLAN_KEYS],
+                [shape(child) for child in node.get('Plans', ())]]
+    return hashlib.md5(json.dumps(shape(plan[0]['Plan']))).hexdigest()[:16]
+
+
+class ExplainSampler(object):
+    """A query listener that runs ``EXPLAIN (FORMAT JSON)`` for slow queries.
+
+    A query that took longer than ``threshold`` seconds is explained with a
+    chance of ``sample_rate`` and at most ``max_per_minute`` times a minute.
+    The ``EXPLAIN`` runs on a connection from the pool (when the query is
+    done, so not while it holds the connection) and isn't sent to the
+    listeners itself. Only single ``SELECT``, ``WITH``, ``VALUES``,
+    ``INSERT``, ``UPDATE`` and ``DELETE`` statements are explained.
+
+    The plan is passed to ``on_plan`` and stored in ``event.data['plan']``
+    of the slow query event. The ``EXPLAIN`` finishes after the listeners
+    got the event, so they (e.g. the slow query log of ``QueryStats``) don't
+    see the plan. The default ``on_plan`` logs the fingerprint of the query
+    together with its plan to the ``momoko.slow`` logger. A hash of the plan is kept per
+    fingerprint, so a changed plan is noticed.
+
+    :param pool: The ``AsyncPool`` to run ``EXPLAIN`` on.
+    :param threshold: Time in seconds.
+    :param sample_rate: The fraction of slow queries (0 to 1) to explain.
+    :param max_per_minute: Maximum number of ``EXPLAIN`` queries a minute.
+    :param max_entries: Maximum number of fingerprints to keep plan hashes for.
+    """
+    def __init__(self, pool, threshold=1.0, sample_rate=0.1, max_per_minute=10,
+                 max_entries=1000):
+        self._pool = pool
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_per_minute = max_per_minute
+        self.max_entries = max_entries
+        self.plans = OrderedDict()
+        self._minute = 0
+        self._count = 0
+
+    def on_complete(self, event):
+        if (event.function != 'execute' or event.server_time < self.threshold or
+                random.random() >= self.sample_rate):
+            return
+        query = event.query.strip().rstrip(';')
+        if ';' in query or not _EXPLAINABLE_RE.match(query):
+            return
+
+        minute = int(time.time() // 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._count = 0
+        if self._count >= self.max_per_minute:
+            return
+        self._count += 1
+
+        self._pool.new_cursor('execute', ('EXPLAIN (FORMAT JSON) ' + query, event.parameters),
+            functools.partial(self._explained, event), event=False)
+
+    def _explained(self, event, cursor, error=None):
+        if error is not None:
+            logging.warning('Could not explain query: %s', error)
+            return
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+
+        key = fingerprint(event.query)
+        digest = plan_hash(plan)
+        entry = self.plans.pop(key, None)
+        if entry is None:
+            entry = {'hash': digest, 'changes': 0}
+            if len(self.plans) >= self.max_entries:
+                self.plans.popitem(last=False)
+        previous = entry['hash']
+        changed = previous != digest
+        if changed:
+            entry['changes'] += 1
+            entry['previous'] = previous
+            entry['hash'] = digest
+        entry['plan'] = plan
+        entry['explained'] = time.time()
+        self.plans[key] = entry
+
+        event.data['plan'] = plan
+        event.data['plan_hash'] = digest
+        self.on_plan(event, key, plan, changed)
+
+    def on_plan(self, event, fingerprint, plan, changed):
+        """Called with every plan. ``changed`` is ``True`` when the plan hash
+        differs from the previous plan of the fingerprint. Override this to
+        send plans somewhere else.
+        """
+        slow_log.warning('Slow query (%.3fs, plan %s%s): %s\n%s', event.server_time,
+                         event.data['plan_hash'], ', changed' if changed else '',
+                         fingerprint, json.dumps(plan, indent=2))
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+    momoko.testing
+    ~~~~~~~~~~~~~~
+
+    An in-process stand-in for asynchronous psycopg2 connections. It's used
+    to measure the overhead of momoko itself and to test failure handling
+    without a database server.
+
+    :copyright: (c) 2011 by Frank Smit.
+    :license: MIT, see LICENSE for more details.
+"""
+
+
+import time
+import errno
+import socket
+import random
+import itertools
+
+import psycopg2
+from psycopg2.extensions import (POLL_OK, POLL_READ, STATUS_READY,
+    QueryCanceledError)
+from tornado.ioloop import IOLoop
+
+from .pools import AsyncPool
+from .clients import AsyncClient, AdispClient
+
+
+_backend_pids = itertools.count(1000)
+
+
+def default_results(query, parameters):
+    return [(1,)]
+
+
+class FakeConnection(object):
+    """A fake asynchronous psycopg2 connection.
+
+    Every connection has a socket pair, ``fileno`` returns one end and the
+    "server" writes a byte to the other end when a query is done. So the
+    IOLoop waits for a real file descriptor, like it does for a real
+    connection. Queries are done after ``latency`` seconds, with a latency
+    of ``0`` the result is available right away.
+
+    :param ioloop: An instance of Tornado's IOLoop.
+    :param latency: Time in seconds a query takes.
+    :param connect_latency: Time in seconds it takes to connect.
+    :param failure_rate: The fraction of queries that fail (0 to 1).
+    :param error: The exception class that's raised by failed queries. An
+                  ``OperationalError`` also closes the connection, like a
+                  lost connection does.
+    :param results: A callable that gets the query and the parameters and
+                    returns a list of rows. By default every query returns
+                    ``[(1,)]``.
+    :param seed: Seed for the random numbers that decide which queries fail.
+                 The same seed gives the same failures.
+    """
+    def __init__(self, ioloop=None, latency=0, connect_latency=0,
+                 failure_rate=0, error=psycopg2.OperationalError, results=None,
+                 seed=0):
+        self._ioloop = ioloop or IOLoop.instance()
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self._error = error
+        self._results = results or default_results
+        self._random = random.Random(seed)
+
+        self._server, self._client = socket.socketpair()
+        self._server.setblocking(0)
+        self._client.setblocking(0)
+
+        self.closed = 0
+        self.status = STATUS_READY
+        self.notifies = []
+        self.queries = 0
+        self._pid = next(_backend_pids)
+        self._executing = False
+        self._outcome = None
+        self._timeout = None
+        self._start(connect_latency, (None, None))
+
+    def fileno(self):
+        return self._client.fileno()
+
+    def get_backend_pid(self):
+        return self._pid
+
+    def isexecuting(self):
+        return self._executing
+
+    def cursor(self, *args, **kwargs):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        return FakeCursor(self)
+
+    def poll(self):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if not self._executing:
+            return POLL_OK
+        try:
+            self._client.recv(1)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return POLL_READ
+            raise
+
+        self._executing = False
+        cursor, error = self._outcome
+        self._outcome = None
+        if error is not None:
+            if isinstance(error, psycopg2.OperationalError):
+                self.close()
+            raise error
+        if cursor is not None:
+            cursor._done()
+        return POLL_OK
+
+    def cancel(self):
+        if self._executing and self._outcome[0] is not None:
+            self._outcome = (self._outcome[0],
+                QueryCanceledError('canceling statement due to user request'))
+            self._respond()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = 1
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._server.close()
+        self._client.close()
+
+    def _execute(self, cursor, query, parameters):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+        if self._executing:
+            raise psycopg2.ProgrammingError('execute cannot be used while an '
+                'asynchronous query is underway')
+        self.queries += 1
+        error = None
+        if self._failure_rate and self._random.random() < self._failure_rate:
+            error = self._error('fake query failure')
+        self._start(self._latency, (cursor, error))
+
+    def _start(self, latency, outcome):
+        self._executing = True
+        self._outcome = outcome
+        if latency > 0:
+            self._timeout = self._ioloop.add_timeout(time.time() + latency,
+                self._respond)
+        else:
+            self._respond()
+
+    def _respond(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        if not self.closed:
+            self._server.send(b'x')
+
+
+class FakeCursor(object):
+    """A cursor of a ``FakeConnection``. The rows are returned by the
+    ``results`` callable of the connection.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.query = None
+        self.description = None
+        self.rowcount = -1
+        self.closed = False
+        self._parameters = None
+        self._rows = []
+        self._position = 0
+
+    def execute(self, query, parameters=None):
+        self.query = query
+        self._parameters = parameters
+        self.connection._execute(self, query, parameters)
+
+    def callproc(self, procname, parameters=None):
+        self.execute('SELECT * FROM %s(...)' % procname, parameters)
+        return parameters
+
+    def _done(self):
+        self._rows = list(self.connection._results(self.query, self._parameters))
+        self._position = 0
+        self.rowcount = len(self._rows)
+        if self._rows:
+            self.description = tuple(('column%d' % i, 23, None, 4, None, None, None)
+                                     for i in range(len(self._rows[0])))
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncPool(AsyncPool):
+    """An ``AsyncPool`` with ``FakeConnection`` connections. It takes the same
+    arguments as ``AsyncPool`` and the arguments of ``FakeConnection``
+    (except ``ioloop``).
+    """
+    def __init__(self, min_conn=1, max_conn=20, cleanup_timeout=10,
+                 ioloop=None, latency=0, connect_latency=0, failure_rate=0,
+                 error=psycopg2.OperationalError, results=None, seed=0,
+                 *args, **kwargs):
+        self._fake_args = {
+            'latency': latency,
+            'connect_latency': connect_latency,
+            'failure_rate': failure_rate,
+            'error': error,
+            'results': results,
+        }
+        # every connection gets its own random numbers
+        self._seeds = itertools.count(seed)
+        super(FakeAsyncPool, self).__init__(min_conn, max_conn, cleanup_timeout,
+            ioloop, *args, **kwargs)
+
+    def _connect(self):
+        return FakeConnection(self._ioloop, seed=next(self._seeds), **self._fake_args)
+
+
+class FakeAsyncClient(AsyncClient):
+    """An ``AsyncClient`` that uses a ``FakeAsyncPool``.
+    """
+    pool_class = FakeAsyncPool
+
+
+class FakeAdispClient(AdispClient):
+    """An ``AdispClient`` that uses a ``FakeAsyncPool``.
+    """
+    pool_class = FakeAsyncPool
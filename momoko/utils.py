@@ -10,13 +10,98 @@
 """
 
 
+import re
+import time
+import logging
 import functools
+import itertools
+from array import array
+from collections import namedtuple
 
 import psycopg2
 import psycopg2.extensions
 from tornado.ioloop import IOLoop
 from UserDict import DictMixin
 
+from .retry import is_connection_error
+
+
+_PLACEHOLDER_RE = re.compile(r'%(?:\(([^)]*)\))?s|%%')
+
+
+def join_queries(queries, separator=';\n'):
+    """Join queries with their parameters into one query with one dictionary
+    of parameters. The placeholders of every query are renamed, so
+    positional and named parameters can be mixed::
+
+        >>> join_queries([('SELECT %s', (1,)), ('SELECT %(a)s', {'a': 2})])
+        ('SELECT %(p0_0)s;\nSELECT %(p1_a)s', {'p0_0': 1, 'p1_a': 2})
+
+    :param queries: A list of ``(query, parameters)`` tuples. Parameters can
+                    be ``None``, the query isn't formatted then.
+    :param separator: The string between the queries.
+    :return: A tuple with the query and the parameters.
+    """
+    parts = []
+    merged = {}
+    for i, (query, parameters) in enumerate(queries):
+        if parameters is None:
+            parts.append(query.replace('%', '%%'))
+            continue
+        positions = itertools.count()
+        def rename(match):
+            if match.group(0) == '%%':
+                return '%%'
+            name = match.group(1)
+            if name is None:
+                name = next(positions)
+            key = 'p%d_%s' % (i, name)
+            merged[key] = parameters[name]
+            return '%%(%s)s' % key
+        parts.append(_PLACEHOLDER_RE.sub(rename, query))
+    return separator.join(parts), merged
+
+
+def values_pages(operation, argslist, template=None, page_size=100):
+    """Split ``argslist`` into pages and return a multi-row query with its
+    parameters for every page, like ``psycopg2.extras.execute_values``::
+
+        >>> list(values_pages('INSERT INTO t (a, b) VALUES %s', [(1, 2), (3, 4)]))
+        [('INSERT INTO t (a, b) VALUES (%(p0_0)s, %(p0_1)s),(%(p1_0)s, %(p1_1)s)',
+          {'p0_0': 1, 'p0_1': 2, 'p1_0': 3, 'p1_1': 4})]
+
+    :param operation: A query with one ``%s`` placeholder for the rows.
+    :param argslist: A sequence of sequences or dictionaries.
+    :param template: The template of one row, e.g. ``(%s, %s, now())`` or
+                     ``(%(id)s, %(name)s)``. Required for dictionaries. By
+                     default it has one placeholder for every value.
+    :param page_size: The maximum number of rows in one query.
+    :return: A generator of ``(query, parameters)`` tuples.
+    """
+    matches = [m for m in _PLACEHOLDER_RE.finditer(operation) if m.group(0) != '%%']
+    if len(matches) != 1 or matches[0].group(0) != '%s':
+        raise ValueError('the query must contain exactly one %s placeholder')
+    # the rows are put in the query which is formatted with the parameters
+    # of all rows, so escaped percent signs stay escaped
+    before = operation[:matches[0].start()]
+    after = operation[matches[0].end():]
+
+    page = []
+    for args in argslist:
+        page.append(args)
+        if len(page) == page_size:
+            yield _values_page(before, after, page, template)
+            page = []
+    if page:
+        yield _values_page(before, after, page, template)
+
+
+def _values_page(before, after, rows, template):
+    if template is None:
+        template = '(%s)' % ', '.join(['%s'] * len(rows[0]))
+    values, parameters = join_queries([(template, row) for row in rows], ',')
+    return before + values + after, parameters
+
 
 class QueryChain(object):
     """Run a chain of queries in the given order.
@@ -32,38 +117,130 @@ class QueryChain(object):
     here %s, %s', ('and some', 'paramaters here')]``. A query
     without paramaters doesn't need to be in a list.
 
+    When a query fails the remaining queries are skipped. The exception is
+    passed on to the callback in place of the cursor of the failed query
+    and the skipped queries have ``None``.
+
+    With ``pipeline=True`` the queries don't wait for each other, they are
+    sent in one round trip as one multi-statement query. PostgreSQL runs
+    such a query in one transaction, so either all queries succeed or none.
+    Only the cursor of the last query is passed on, the others are
+    ``None``. When the pipeline fails the queries are executed again one by
+    one in a transaction on one connection to find the query that failed.
+    That transaction is always rolled back. The error of the pipeline is
+    passed on in place of the failed query and the other queries have
+    ``None``. When the failed query isn't found, or the connection was lost
+    (the pipeline may have been committed, so it's not executed again),
+    every query has the error. Only use this mode for queries that don't
+    depend on each other.
+
     :param db: A ``momoko.Client`` or ``momoko.AdispClient`` instance.
     :param queries: A tuple or with all the queries.
     :param callback: The function that needs to be executed once all the
                      queries are finished.
+    :param cancel_token: A ``CancelToken``. When it's cancelled the running
+                         query is cancelled, the remaining queries are skipped
+                         and the callback isn't called. Optional.
+    :param pipeline: Send all queries in one round trip.
     :return: A list with the resulting cursors is passed on to the callback.
     """
-    def __init__(self, db, queries, callback):
+    def __init__(self, db, queries, callback, cancel_token=None, pipeline=False):
         self._db = db
         self._cursors = []
-        self._queries = list(queries)
-        self._queries.reverse()
+        self._queries = []
+        for query in queries:
+            if isinstance(query, str):
+                query = [query]
+            self._queries.append((query[0], query[1] if len(query) > 1 else ()))
+        self._size = len(self._queries)
         self._callback = callback
-        self._collect(None)
+        self._cancel_token = cancel_token
+
+        if pipeline and self._size > 1:
+            query, parameters = join_queries(self._queries)
+            self._db.execute(query, parameters, callback=self._pipelined,
+                             cancel_token=cancel_token)
+        else:
+            self._queries.reverse()
+            self._collect(None)
 
-    def _collect(self, cursor):
+    def _collect(self, cursor, error=None):
+        if self._cancel_token is not None and self._cancel_token.cancelled:
+            return
+        if error is not None:
+            self._cursors.append(error)
+            self._finish()
+            return
         if cursor is not None:
             self._cursors.append(cursor)
         if not self._queries:
-            if self._callback:
-                self._callback(self._cursors)
+            self._finish()
             return
         query = self._queries.pop()
-        if isinstance(query, str):
-            query = [query]
-        self._db.execute(*query, callback=self._collect)
+        self._db.execute(*query, callback=self._collect,
+                         cancel_token=self._cancel_token)
+
+    def _finish(self):
+        self._cursors.extend([None] * (self._size - len(self._cursors)))
+        if self._callback:
+            self._callback(self._cursors)
+
+    def _pipelined(self, cursor, error=None):
+        if error is None:
+            self._cursors = [None] * (self._size - 1) + [cursor]
+            self._finish()
+            return
+        if self._cancel_token is not None and self._cancel_token.cancelled:
+            return
+        self._error = error
+        self._cursors = [error] * self._size
+        if is_connection_error(error):
+            self._finish()
+            return
+        # find the failed query, on a pinned connection so nothing else runs
+        # in the transaction
+        self._pool = self._db._pool
+        self._conn = None
+        self._step = 0
+        self._pool.new_cursor('execute', ('BEGIN',), self._replay, pin=True)
+
+    def _replay(self, cursor, error=None):
+        if self._conn is None:
+            if error is not None:
+                # the transaction couldn't be started
+                self._finish()
+                return
+            self._conn = cursor.connection
+        elif error is not None:
+            self._cursors = [None] * self._size
+            self._cursors[self._step - 1] = self._error
+            self._rollback()
+            return
+
+        if self._step == self._size:
+            self._rollback()
+            return
+        query = self._queries[self._step]
+        self._step += 1
+        self._pool.new_cursor('execute', query, self._replay, connection=self._conn)
+
+    def _rollback(self):
+        self._pool.new_cursor('execute', ('ROLLBACK',), self._rolled_back,
+                              connection=self._conn)
+
+    def _rolled_back(self, cursor, error=None):
+        self._pool.release(self._conn)
+        if error is not None:
+            logging.warning('Could not roll back replayed chain: %s', error)
+        self._finish()
 
 
 class BatchQuery(object):
     """Run a batch of queries all at once.
 
     **Note:** Every query needs a free connection. So if three queries are
-    are executed, three free connections are used.
+    are executed, three free connections are used. Use ``max_concurrency`` to
+    limit the number of queries that run at the same time.
 
     A dictionary with queries looks like this::
 
@@ -81,10 +258,21 @@ class BatchQuery(object):
     :param queries: A dictionary with all the queries.
     :param callback: The function that needs to be executed once all the
                      queries are finished.
+    :param cancel_token: A ``CancelToken``. When it's cancelled the running
+                         queries are cancelled and the callback isn't called.
+                         Optional.
+    :param max_concurrency: The maximum number of queries that run at the
+                            same time. The next query is started when one is
+                            done. All queries are started at once by default.
+    :param fail_fast: Cancel the queries that are still running or waiting
+                      when a query fails and call the callback right away.
     :return: A dictionary with the same keys as the given queries with the
-             resulting cursors as values is passed on to the callback.
+             resulting cursors as values is passed on to the callback. The
+             value of a failed query is the exception, the value of a query
+             that was cancelled by ``fail_fast`` is ``None``.
     """
-    def __init__(self, db, queries, callback):
+    def __init__(self, db, queries, callback, cancel_token=None,
+                 max_concurrency=None, fail_fast=False):
         from clients import AdispClient
         self._db = db
 
@@ -94,26 +282,442 @@ class BatchQuery(object):
             self.execute = self._db.execute
 
         self._callback = callback
-        self._queries = {}
         self._args = {}
         self._size = len(queries)
-
+        self._max_concurrency = max_concurrency
+        self._fail_fast = fail_fast
+        self._running = 0
+        self._starting = False
+        self._done = False
+
+        # fail_fast needs its own token to cancel the running queries
+        self._cancel_token = cancel_token
+        self._user_token = None
+        if fail_fast:
+            self._cancel_token = CancelToken()
+            if cancel_token is not None:
+                self._user_token = cancel_token
+                cancel_token.add_callback(self._cancel_token.cancel)
+
+        self._keys = list(queries)
+        self._pending = []
         for key, query in list(queries.items()):
             if isinstance(query, str):
                 query = [query, ()]
-            query.append(functools.partial(self._collect, key))
-            self._queries[key] = query
+            self._pending.append((key, query))
+        self._pending.reverse()
 
-        for query in list(self._queries.values()):
-            self.execute(*query)
+        if not self._size:
+            self._finish()
+        else:
+            self._start()
+
+    def _start(self):
+        # _collect can be called before execute returns, the loop is only
+        # run once so a long batch doesn't recurse
+        if self._starting:
+            return
+        self._starting = True
+        try:
+            while (self._pending and not self._done and (not self._max_concurrency
+                    or self._running < self._max_concurrency)):
+                key, query = self._pending.pop()
+                self._running += 1
+                self.execute(*query, callback=functools.partial(self._collect, key),
+                             cancel_token=self._cancel_token)
+        finally:
+            self._starting = False
+
+    def _collect(self, key, cursor, error=None):
+        if self._done:
+            return
+        self._running -= 1
+        self._size -= 1
+        self._args[key] = error if error is not None else cursor
+
+        if error is not None and self._fail_fast:
+            for key in self._keys:
+                self._args.setdefault(key, None)
+            self._pending = []
+            self._done = True
+            self._cancel_token.cancel()
+            self._finish()
+        elif not self._size:
+            self._done = True
+            self._finish()
+        else:
+            self._start()
 
-    def _collect(self, key, cursor):
-        self._size = self._size - 1
-        self._args[key] = cursor
-        if not self._size and self._callback:
+    def _finish(self):
+        if self._user_token is not None:
+            self._user_token.remove_callback(self._cancel_token.cancel)
+        if self._callback:
             self._callback(self._args)
 
 
+class CancelToken(object):
+    """A token to cancel queries that are no longer needed.
+
+    Pass the token to ``execute``, ``chain`` or ``batch`` and call ``cancel``
+    when the result isn't needed anymore, e.g. because the client went away.
+    Queries that haven't started yet are skipped, running queries are
+    cancelled with ``connection.cancel()`` and their callbacks aren't called.
+    The connections are freed as soon as the server has cancelled the query.
+    """
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+
+    def cancel(self):
+        """Cancel all queries that use this token.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception('Cancel callback failed')
+
+    def add_callback(self, callback):
+        """Call ``callback`` when the token is cancelled. It's called right
+        away if the token is already cancelled.
+        """
+        if self.cancelled:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Remove a callback that was added with ``add_callback``.
+        """
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+
+class CancelMixin(object):
+    """A mixin for ``tornado.web.RequestHandler`` that cancels the queries of
+    a request when the client closes the connection.
+
+    Use ``self.cancel_token`` for the queries of the request::
+
+        class MainHandler(momoko.CancelMixin, tornado.web.RequestHandler):
+            @tornado.web.asynchronous
+            def get(self):
+                self.db.execute('SELECT pg_sleep(10)', callback=self._on_result,
+                                cancel_token=self.cancel_token)
+    """
+    @property
+    def cancel_token(self):
+        token = getattr(self, '_cancel_token', None)
+        if token is None:
+            token = self._cancel_token = CancelToken()
+        return token
+
+    def on_connection_close(self):
+        super(CancelMixin, self).on_connection_close()
+        self.cancel_token.cancel()
+
+
+class QueryEvent(object):
+    """The events of one database operation. Listeners that are added with
+    ``AsyncPool.add_listener`` get the same event object for every step, the
+    timestamps (``time.time()``) are filled in along the way.
+
+    - ``function`` -- ``execute``, ``executemany`` or ``callproc``.
+    - ``query`` -- the SQL template (or the procedure name).
+    - ``parameters`` -- the parameters.
+    - ``enqueued`` -- when the operation was requested.
+    - ``checked_out`` -- when a connection was taken from the pool.
+    - ``executed`` -- when the query was sent to the server.
+    - ``completed`` -- when the result was received.
+    - ``finished`` -- when the callback returned.
+    - ``connection_id`` -- the backend pid of the connection.
+    - ``rowcount`` -- the row count of the cursor.
+    - ``error`` -- the exception when the query failed.
+    """
+    __slots__ = ('listeners', 'function', 'query', 'parameters', 'enqueued',
+                 'checked_out', 'executed', 'completed', 'finished',
+                 'connection_id', 'rowcount', 'error', 'data')
+
+    def __init__(self, listeners, function, query, parameters=None):
+        self.listeners = listeners
+        self.function = function
+        self.query = query
+        self.parameters = parameters
+        self.enqueued = time.time()
+        self.checked_out = None
+        self.executed = None
+        self.completed = None
+        self.finished = None
+        self.connection_id = None
+        self.rowcount = -1
+        self.error = None
+        # room for listeners to keep their own state, e.g. a tracing span
+        self.data = {}
+
+    @property
+    def wait_time(self):
+        """Time in seconds it took to get a connection."""
+        if self.checked_out is None:
+            return None
+        return self.checked_out - self.enqueued
+
+    @property
+    def server_time(self):
+        """Time in seconds between sending the query and the result."""
+        if self.executed is None or self.completed is None:
+            return None
+        return self.completed - self.executed
+
+    @property
+    def callback_time(self):
+        """Time in seconds the callback took."""
+        if self.finished is None:
+            return None
+        return self.finished - self.completed
+
+    @property
+    def total_time(self):
+        """Time in seconds from the request until the callback returned."""
+        if self.finished is None:
+            return None
+        return self.finished - self.enqueued
+
+    def fire(self, name):
+        """Call the method ``name`` of every listener with the event.
+        """
+        for listener in self.listeners:
+            method = getattr(listener, name, None)
+            if method is not None:
+                try:
+                    method(self)
+                except Exception:
+                    logging.exception('Query listener %s failed', name)
+
+
+class Loader(object):
+    """Merge point lookups into one query.
+
+    Keys that are requested with ``load`` in the same IOLoop iteration (or
+    within ``window`` seconds) are looked up with one query. The query has a
+    single placeholder for a list of keys, like this::
+
+        'SELECT id, name FROM users WHERE id = ANY(%s)'
+
+    The rows are handed out by the value in ``key_column``, so the keys that
+    are requested must be of the same type as that column. Results are kept
+    until the end of the IOLoop iteration, a key that is requested twice is
+    only looked up once.
+
+    :param fetch: A callable that executes a query, ``fetch(query, parameters,
+                  callback)``, and calls the callback with a list of rows.
+    :param query: The query with one placeholder for the list of keys.
+    :param key_column: Index of the column with the key.
+    :param many: If ``True`` a list of rows is returned for every key instead
+                 of a single row.
+    :param window: Time in seconds to wait for more keys. By default keys are
+                   collected until the end of the current IOLoop iteration.
+    :param max_keys: A query is executed right away when this many keys are
+                     collected.
+    :param ioloop: An instance of Tornado's IOLoop.
+    """
+    def __init__(self, fetch, query, key_column=0, many=False, window=0,
+                 max_keys=1000, ioloop=None):
+        self._ioloop = ioloop or IOLoop.instance()
+        self._fetch = fetch
+        self._query = query
+        self._key_column = key_column
+        self._many = many
+        self._window = window
+        self._max_keys = max_keys
+        self._pending = {}
+        self._cache = {}
+        self._timeout = None
+        self._scheduled = False
+
+    def load(self, key, callback):
+        """Look up a single key.
+
+        :param key: The key to look up.
+        :param callback: The function that is called with the row (``None``
+                         if there's no row) or the list of rows when ``many``
+                         is set. When the query fails the callback gets
+                         ``None`` and the error.
+        """
+        if key in self._cache:
+            self._ioloop.add_callback(functools.partial(callback, self._cache[key]))
+            return
+
+        callbacks = self._pending.get(key)
+        if callbacks is not None:
+            callbacks.append(callback)
+            return
+        self._pending[key] = [callback]
+
+        if len(self._pending) >= self._max_keys:
+            self._flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            if self._window:
+                self._timeout = self._ioloop.add_timeout(
+                    time.time() + self._window, self._flush)
+            else:
+                self._ioloop.add_callback(self._flush)
+
+    def _flush(self):
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._scheduled = False
+
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._fetch(self._query, (list(pending),),
+                functools.partial(self._collect, pending))
+
+    def _collect(self, pending, rows, error=None):
+        results = {}
+        if error is None:
+            try:
+                for row in rows or ():
+                    key = row[self._key_column]
+                    if self._many:
+                        results.setdefault(key, []).append(row)
+                    elif key not in results:
+                        results[key] = row
+            except Exception as e:
+                error = e
+
+        if error is not None:
+            for callbacks in pending.itervalues():
+                for callback in callbacks:
+                    self._call(callback, None, error)
+            return
+
+        if not self._cache:
+            self._ioloop.add_callback(self._cache.clear)
+        values = dict((key, results.get(key, [] if self._many else None)) for key in pending)
+        self._cache.update(values)
+        for key, callbacks in pending.iteritems():
+            for callback in callbacks:
+                self._call(callback, values[key])
+
+    def _call(self, callback, *args):
+        # a failing callback mustn't keep the other keys waiting
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('Loader callback failed')
+
+
+def fetch_tuples(cursor):
+    """Return all rows as tuples.
+    """
+    return cursor.fetchall()
+
+
+def fetch_one(cursor):
+    """Return the first row as a tuple.
+    """
+    return cursor.fetchone()
+
+
+_record_classes = {}
+
+
+def record_class(names):
+    """Return a record class (a named tuple) for the given column names.
+
+    Classes are cached per column layout.
+    """
+    names = tuple(names)
+    try:
+        return _record_classes[names]
+    except KeyError:
+        if len(_record_classes) >= 1000:
+            _record_classes.clear()
+        cls = _record_classes[names] = namedtuple('Record', names, rename=True)
+        return cls
+
+
+def fetch_records(cursor):
+    """Return all rows as records. A record is a named tuple, its fields can
+    be accessed by column name and it takes as much memory as a tuple.
+    """
+    cls = record_class([column[0] for column in cursor.description])
+    return map(cls._make, cursor)
+
+
+def fetch_columns(cursor, chunk_size=1000):
+    """Return the result as columns, an ordered dictionary with a list of
+    values for every column. Columns with only floats are stored in an
+    ``array('d')`` and columns with only integers in an ``array('l')``.
+    """
+    names = [column[0] for column in cursor.description]
+    columns = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        values = zip(*rows)
+        if columns is None:
+            columns = [_new_column(column) for column in values]
+            continue
+        for i, column in enumerate(columns):
+            size = len(column)
+            try:
+                column.extend(values[i])
+            except (TypeError, OverflowError):
+                # a NULL or a too big value, fall back to a list
+                columns[i] = column[:size].tolist() + list(values[i])
+    if columns is None:
+        columns = [[] for name in names]
+    return OrderedDict(zip(names, columns))
+
+
+def _new_column(values):
+    types = set(map(type, values))
+    try:
+        if types == set([float]):
+            return array('d', values)
+        if types <= set([int, long]):
+            return array('l', values)
+    except OverflowError:
+        pass
+    return list(values)
+
+
+RESULT_FACTORIES = {
+    'fetchall': fetch_tuples,
+    'fetchone': fetch_one,
+    'tuples': fetch_tuples,
+    'records': fetch_records,
+    'columns': fetch_columns,
+}
+
+
+def get_factory(factory):
+    """Return a result factory by name (``tuples``, ``records`` or
+    ``columns``). Callables are returned as is.
+    """
+    if callable(factory):
+        return factory
+    return RESULT_FACTORIES[factory]
+
+
+def apply_factory(factory, callback, cursor, error=None):
+    """Call the callback with the result made by factory from the cursor.
+    Errors are passed on to the callback together with the cursor.
+    """
+    if error is not None:
+        callback(cursor, error)
+    else:
+        callback(factory(cursor))
+
+
 class Poller(object):
     """A poller that polls the PostgreSQL connection and calls the callbacks
     when the connection state is ``POLL_OK``.
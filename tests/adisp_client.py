@@ -57,6 +57,16 @@ class AdispClientTest(tornado.testing.AsyncTestCase):
         for key, cursor in cursors.items():
             self.assertEqual(cursor.fetchall(), expected[key])
 
+    @momoko.process
+    def test_batch_concurrency(self):
+        """Test executing a batch query with limited concurrency.
+        """
+        input = dict(('query%d' % i, ['SELECT %s;', (i,)]) for i in range(5))
+        cursors = yield self.db.batch(input, max_concurrency=2)
+
+        for key, cursor in cursors.items():
+            self.assertEqual(cursor.fetchall(), [(int(key[5:]),)])
+
     @momoko.process
     def test_chain_query(self):
         """Test executing a chain query.
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
 import sys
+import time
+import functools
 import unittest
 
+import psycopg2
+import psycopg2.extensions
 import tornado.ioloop
 import tornado.testing
 import momoko
@@ -57,6 +61,42 @@ class AsyncClientTest(tornado.testing.AsyncTestCase):
         for key, cursor in cursors.items():
             self.assertEqual(cursor.fetchall(), expected[key])
 
+    def test_batch_concurrency(self):
+        """Test limiting the concurrency of a batch and fail fast.
+        """
+        pool = self.db._pool
+        class Counter(object):
+            highest = 0
+            def on_execute(self, event):
+                running = sum(1 for conn in pool._pool if conn.isexecuting())
+                self.highest = max(self.highest, running)
+        counter = Counter()
+        self.db.add_listener(counter)
+
+        queries = dict(('q%d' % i, ['SELECT %s, pg_sleep(0.01)', (i,)]) for i in range(10))
+        self.db.batch(queries, callback=self.stop, max_concurrency=2)
+        cursors = self.wait()
+        self.assertEqual(counter.highest, 2)
+        self.assertEqual(sorted(cursors), sorted(queries))
+        for key, cursor in cursors.items():
+            self.assertEqual(cursor.fetchone()[0], int(key[1:]))
+        self.assertEqual(queries['q0'], ['SELECT %s, pg_sleep(0.01)', (0,)])
+
+        start = time.time()
+        queries = {'slow1': 'SELECT pg_sleep(2)', 'slow2': 'SELECT pg_sleep(2)', 'bad': 'SELECT 1/0'}
+        self.db.batch(queries, callback=self.stop, fail_fast=True)
+        cursors = self.wait()
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(isinstance(cursors['bad'], psycopg2.DataError))
+        self.assertEqual((cursors['slow1'], cursors['slow2']), (None, None))
+
+        # without fail_fast the errors are collected
+        queries = {'good': 'SELECT 1', 'bad': 'SELECT 1/0'}
+        self.db.batch(queries, callback=self.stop, max_concurrency=1)
+        cursors = self.wait()
+        self.assertTrue(isinstance(cursors['bad'], psycopg2.DataError))
+        self.assertEqual(cursors['good'].fetchall(), [(1,)])
+
     def test_chain_query(self):
         """Test executing a chain query.
         """
@@ -75,6 +115,760 @@ class AsyncClientTest(tornado.testing.AsyncTestCase):
         for index, cursor in enumerate(cursors):
             self.assertEqual(cursor.fetchall(), expected[index])
 
+    def test_chain_pipeline(self):
+        """Test sending a chain in one round trip.
+        """
+        self.db.execute('DROP TABLE IF EXISTS momoko_chain; '
+                        'CREATE TABLE momoko_chain (id int PRIMARY KEY, name text)',
+                        callback=self.stop)
+        self.wait()
+
+        executed = []
+        self.db.add_listener(type('Recorder', (object,), {
+            'on_execute': lambda self, event: executed.append(event.query)})())
+        queries = (
+            ['INSERT INTO momoko_chain VALUES (%s, %s)', (1, '100%')],
+            ['INSERT INTO momoko_chain VALUES (%(id)s, %(name)s)', {'id': 2, 'name': 'two'}],
+            "INSERT INTO momoko_chain VALUES (3, '%%')",
+            'SELECT id, name FROM momoko_chain ORDER BY id'
+        )
+        self.db.chain(queries, callback=self.stop, pipeline=True)
+        cursors = self.wait()
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(cursors[:3], [None, None, None])
+        self.assertEqual(cursors[3].fetchall(), [(1, '100%'), (2, 'two'), (3, '%')])
+
+        # the failed query is found and nothing is changed
+        del executed[:]
+        queries = (
+            ['INSERT INTO momoko_chain VALUES (%s, %s)', (4, 'four')],
+            ['INSERT INTO momoko_chain VALUES (%s, %s)', (1, 'duplicate')],
+            ['INSERT INTO momoko_chain VALUES (%s, %s)', (5, 'five')],
+        )
+        self.db.chain(queries, callback=self.stop, pipeline=True)
+        cursors = self.wait()
+        self.assertEqual(cursors[0], None)
+        self.assertTrue(isinstance(cursors[1], psycopg2.IntegrityError))
+        self.assertEqual(cursors[2], None)
+        self.assertEqual(executed[-1], 'ROLLBACK')
+        self.assertEqual(self.db._pool._pinned, set())
+
+        # queries that succeed when they are replayed are rolled back too,
+        # a sequence isn't transactional so the second query fails only once
+        self.db.execute('DROP SEQUENCE IF EXISTS momoko_once; CREATE SEQUENCE momoko_once',
+                        callback=self.stop)
+        self.wait()
+        del executed[:]
+        once = (
+            ['INSERT INTO momoko_chain VALUES (%s, %s)', (6, 'six')],
+            "SELECT 1 / (nextval('momoko_once') - 1)",
+        )
+        self.db.chain(once, callback=self.stop, pipeline=True)
+        cursors = self.wait()
+        self.assertTrue(all(isinstance(c, psycopg2.DataError) for c in cursors))
+        self.assertEqual(executed[-1], 'ROLLBACK')
+
+        self.db.execute('SELECT count(*) FROM momoko_chain', callback=self.stop)
+        self.assertEqual(self.wait().fetchone(), (3,))
+
+        # without pipeline the remaining queries are skipped too
+        self.db.chain(queries, callback=self.stop)
+        cursors = self.wait()
+        self.assertEqual(cursors[0].rowcount, 1)
+        self.assertTrue(isinstance(cursors[1], psycopg2.IntegrityError))
+        self.assertEqual(cursors[2], None)
+
+        # the pipeline may have been committed when the connection was lost,
+        # so it isn't executed again
+        from momoko.testing import FakeAsyncClient
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'failure_rate': 1})
+        del executed[:]
+        db.add_listener(type('Recorder', (object,), {
+            'on_execute': lambda self, event: executed.append(event.query)})())
+        db.chain(queries, callback=self.stop, pipeline=True)
+        cursors = self.wait()
+        self.assertTrue(all(isinstance(c, psycopg2.OperationalError) for c in cursors))
+        self.assertEqual(len(executed), 1)
+        db.close()
+
+    def test_execute_values(self):
+        """Test executing many rows in pages.
+        """
+        self.db.execute('DROP TABLE IF EXISTS momoko_values; '
+                        'CREATE TABLE momoko_values (id int PRIMARY KEY, name text)',
+                        callback=self.stop)
+        self.wait()
+
+        executed = []
+        self.db.add_listener(type('Recorder', (object,), {
+            'on_execute': lambda self, event: executed.append(event.query)})())
+        rows = [(i, 'name %d%%' % i) for i in range(25)]
+        self.db.execute_values('INSERT INTO momoko_values (id, name) VALUES %s', rows,
+                               page_size=10, callback=self.stop)
+        self.assertEqual(self.wait(), 25)
+        self.assertEqual(len(executed), 3)
+
+        rows = [{'id': i, 'name': 'x'} for i in range(25, 30)]
+        self.db.execute_values('INSERT INTO momoko_values VALUES %s RETURNING id', rows,
+                               template='(%(id)s, upper(%(name)s))', callback=self.stop,
+                               fetch=True, max_concurrency=2, page_size=2)
+        self.assertEqual(sorted(self.wait()), [(i,) for i in range(25, 30)])
+
+        # the second page fails, the third is skipped
+        rows = [(i, 'again') for i in (30, 31, 1, 32, 33)]
+        self.db.execute_values('INSERT INTO momoko_values VALUES %s', rows, page_size=2,
+                               callback=lambda total, error=None: self.stop((total, error)))
+        total, error = self.wait()
+        self.assertEqual(total, 2)
+        self.assertTrue(isinstance(error, psycopg2.IntegrityError))
+
+        self.db.execute("SELECT count(*), max(name) FROM momoko_values WHERE id < 25",
+                        callback=self.stop)
+        self.assertEqual(self.wait().fetchone(), (25, 'name 9%'))
+
+    def test_loader(self):
+        """Test merging point lookups with a loader.
+        """
+        loader = self.db.loader('SELECT k, k * 10 FROM unnest(%s) AS k WHERE k < 5')
+        results = {}
+
+        def on_row(key, row):
+            results.setdefault(key, []).append(row)
+            if sum(map(len, results.values())) == 4:
+                self.stop()
+
+        for key in (1, 2, 2, 7):
+            loader.load(key, functools.partial(on_row, key))
+        self.assertEqual(len(loader._pending), 3)
+        self.wait()
+
+        self.assertEqual(results, {1: [(1, 10)], 2: [(2, 20), (2, 20)], 7: [None]})
+
+        # a failing callback doesn't keep the other keys waiting
+        def fail(row):
+            raise ValueError('callback failed')
+        results.clear()
+        loader = self.db.loader('SELECT k, k * 10 FROM unnest(%s) AS k')
+        loader.load(1, fail)
+        loader.load(2, fail)
+        for key in (1, 2, 3, 4):
+            loader.load(key, functools.partial(on_row, key))
+        self.wait()
+        self.assertEqual(sorted(results), [1, 2, 3, 4])
+        self.assertEqual(results[4], [(4, 40)])
+
+    def test_result_factories(self):
+        """Test records and columns result factories.
+        """
+        query = 'SELECT i AS a, i * 0.5 AS b, NULLIF(i, 1500) AS c FROM generate_series(1, 2000) AS i'
+        self.db.execute(query, callback=self.stop, factory='records')
+        records = self.wait()
+        self.assertEqual(len(records), 2000)
+        self.assertEqual(records[0].a, 1)
+        self.assertEqual(records[1], (2, 1, 2))
+
+        self.db.execute(query, callback=self.stop, factory='columns')
+        columns = self.wait()
+        self.assertEqual(columns.keys(), ['a', 'b', 'c'])
+        self.assertEqual(columns['a'].typecode, 'l')
+        self.assertEqual(list(columns['a']), range(1, 2001))
+        self.assertTrue(isinstance(columns['c'], list))
+        self.assertEqual(columns['c'][1498:1501], [1499, None, 1501])
+
+    def test_connection_setup(self):
+        """Test init SQL, typecasters and session reset.
+        """
+        self.db.execute("DROP TYPE IF EXISTS momoko_mood; "
+                        "CREATE TYPE momoko_mood AS ENUM ('sad', 'happy')", callback=self.stop)
+        self.wait()
+
+        def register_mood(conn, oid, array_oid):
+            mood = psycopg2.extensions.new_type((oid,), 'MOOD', lambda value, cursor: value.upper())
+            psycopg2.extensions.register_type(mood, conn)
+
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+            'max_conn': 1,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'init_sql': ["SET application_name = 'momoko_test'"],
+            'type_casters': {'momoko_mood': register_mood},
+            'reset_sql': 'RESET search_path'
+        })
+        def settle():
+            # wait for the reset to finish
+            self.io_loop.add_timeout(time.time() + 0.1, self.stop)
+            self.wait()
+
+        settle()
+        db.execute("SELECT current_setting('application_name'), 'happy'::momoko_mood",
+                   callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.fetchall(), [('momoko_test', 'HAPPY')])
+        settle()
+
+        db.execute("SET search_path = momoko", callback=self.stop)
+        self.wait()
+        settle()
+        db.execute("SHOW search_path", callback=self.stop)
+        cursor = self.wait()
+        self.assertNotEqual(cursor.fetchone()[0], 'momoko')
+        self.assertEqual(len(db._pool._pool), 1)
+        db.close()
+
+    def test_listen(self):
+        """Test receiving notifications and reconnecting the listener.
+        """
+        received = []
+        def on_notify(notify):
+            received.append((notify.channel, notify.payload))
+            self.stop()
+
+        self.db.listen('momoko "test"', on_notify)
+        self.io_loop.add_timeout(time.time() + 0.2, self.stop)
+        self.wait()
+
+        self.db.execute("NOTIFY \"momoko \"\"test\"\"\", 'first'", callback=lambda c: None)
+        self.wait()
+        self.assertEqual(received, [('momoko "test"', 'first')])
+
+        # terminate the listening backend, it's listened to again after a second
+        pid = self.db._pool._listener._conn.get_backend_pid()
+        self.db.execute('SELECT pg_terminate_backend(%s)', (pid,), callback=lambda c: None)
+        self.io_loop.add_timeout(time.time() + 1.5, self.stop)
+        self.wait()
+
+        self.db.execute("SELECT pg_notify('momoko \"test\"', 'second')", callback=lambda c: None)
+        self.wait()
+        self.assertEqual(received[-1], ('momoko "test"', 'second'))
+
+        self.db.unlisten('momoko "test"', on_notify)
+        self.io_loop.add_timeout(time.time() + 0.2, self.stop)
+        self.wait()
+        self.assertEqual(self.db._pool._listener._listening, set())
+
+        # the listener of a fake client uses a fake connection as well
+        from momoko.testing import FakeAsyncClient, FakeConnection
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0})
+        db.listen('momoko', on_notify)
+        self.io_loop.add_timeout(time.time() + 0.2, self.stop)
+        self.wait()
+        self.assertIsInstance(db._pool._listener._conn, FakeConnection)
+        self.assertEqual(db._pool._listener._listening, set(['momoko']))
+        db.close()
+
+    def test_cancel(self):
+        """Test cancelling running and pending queries.
+        """
+        called = []
+        token = momoko.CancelToken()
+        self.db.chain(['SELECT pg_sleep(10)', 'SELECT 1'],
+                      callback=called.append, cancel_token=token)
+        self.io_loop.add_timeout(time.time() + 0.2, token.cancel)
+        self.io_loop.add_timeout(time.time() + 0.5, self.stop)
+        start = time.time()
+        self.wait()
+        self.assertEqual(called, [])
+        self.assertFalse(any(conn.isexecuting() for conn in self.db._pool._pool))
+        self.assertTrue(time.time() - start < 2)
+
+        # a cancelled token skips the query
+        self.db.execute('SELECT 1', callback=called.append, cancel_token=token)
+        self.db.execute('SELECT 42', callback=self.stop, cancel_token=momoko.CancelToken())
+        cursor = self.wait()
+        self.assertEqual(cursor.fetchall(), [(42,)])
+        self.assertEqual(called, [])
+
+    def test_fake_connection(self):
+        """Test the in-process fake connection.
+        """
+        from momoko.testing import FakeAsyncClient
+
+        db = FakeAsyncClient({
+            'ioloop': self.io_loop,
+            'cleanup_timeout': 0,
+            'latency': 0.05,
+            'results': lambda query, parameters: [(query, parameters)]
+        })
+        start = time.time()
+        db.execute('SELECT %s', (1,), callback=self.stop)
+        cursor = self.wait()
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(cursor.fetchall(), [('SELECT %s', (1,))])
+
+        token = momoko.CancelToken()
+        db.execute('SELECT 1', callback=self.stop, cancel_token=token)
+        token.cancel()
+        db.execute('SELECT 2', callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.fetchone()[0], 'SELECT 2')
+        self.assertFalse(any(conn.isexecuting() for conn in db._pool._pool))
+        db.close()
+
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'failure_rate': 1})
+        db.execute('SELECT 1', callback=lambda cursor, error=None: self.stop(error))
+        error = self.wait()
+        self.assertTrue(isinstance(error, psycopg2.OperationalError))
+        self.assertEqual(db._pool._pool[0].closed, 1)
+
+    def test_listeners(self):
+        """Test query events.
+        """
+        class Recorder(object):
+            def __init__(self):
+                self.calls = []
+            def __getattr__(self, name):
+                if not name.startswith('on_'):
+                    raise AttributeError(name)
+                return lambda event: self.calls.append((name, event))
+
+        recorder, unsampled = Recorder(), Recorder()
+        self.db.add_listener(recorder)
+        self.db.add_listener(unsampled, sample_rate=0)
+
+        def on_result(cursor, error=None):
+            time.sleep(0.02)
+            self.stop(error)
+        self.db.execute('SELECT pg_sleep(0.05), 1', callback=on_result)
+        self.wait()
+        self.assertEqual([name for name, event in recorder.calls],
+                         ['on_enqueue', 'on_checkout', 'on_execute', 'on_complete'])
+        event = recorder.calls[-1][1]
+        self.assertEqual(event.query, 'SELECT pg_sleep(0.05), 1')
+        self.assertEqual(event.rowcount, 1)
+        self.assertTrue(event.server_time >= 0.05)
+        self.assertTrue(event.callback_time >= 0.02)
+        self.assertTrue(event.wait_time >= 0)
+        self.assertTrue(isinstance(event.connection_id, int))
+
+        del recorder.calls[:]
+        self.db.execute('SELECT 1/0', callback=on_result)
+        self.assertTrue(isinstance(self.wait(), psycopg2.DataError))
+        self.assertEqual(recorder.calls[-1][0], 'on_error')
+        self.assertTrue(isinstance(recorder.calls[-1][1].error, psycopg2.DataError))
+
+        del recorder.calls[:]
+        self.db._pool.new_cursor('execute', ('SELECT 1',), self.stop, event=False)
+        self.wait()
+        self.db.remove_listener(recorder)
+        self.db.execute('SELECT 1', callback=self.stop)
+        self.wait()
+        self.assertEqual(recorder.calls, [])
+        self.assertEqual(unsampled.calls, [])
+
+    def test_autosize(self):
+        """Test growing and shrinking the pool with the load.
+        """
+        from momoko.testing import FakeAsyncClient
+
+        sizer = momoko.PoolSizer(target_wait=0.01, interval=0.05, shrink_after=2)
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'min_conn': 1, 'max_conn': 4, 'latency': 0.05,
+                              'autosize': sizer})
+        done = []
+        def on_result(cursor):
+            done.append(cursor.connection)
+            if len(done) == 40:
+                self.stop()
+        for i in range(40):
+            db.execute('SELECT 1', callback=on_result)
+        self.wait()
+        self.assertEqual(sizer.size, 4)
+        self.assertEqual(len(set(done)), 4)
+
+        # the pool is idle and shrinks back
+        self.io_loop.add_timeout(time.time() + 0.5, self.stop)
+        self.wait()
+        self.assertEqual((sizer.size, len(db._pool._pool)), (1, 1))
+        db.close()
+
+        # a fixed size pool lets operations wait instead of connecting more
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'min_conn': 1, 'max_conn': 2, 'latency': 0.01})
+        del done[:]
+        for i in range(40):
+            db.execute('SELECT 1', callback=on_result)
+        self.wait()
+        self.assertEqual(len(set(done)), 2)
+        db.close()
+
+        # operations that wait for the first connections of a full pool
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 2,
+            'max_conn': 2,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop
+        })
+        del done[:]
+        for i in range(40):
+            db.execute('SELECT 1', callback=on_result)
+        self.wait()
+        self.assertEqual(len(set(done)), 2)
+        db.close()
+
+    def test_quotas(self):
+        """Test limiting the connections of a tag.
+        """
+        from momoko.testing import FakeAsyncClient
+
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'min_conn': 4, 'max_conn': 4, 'latency': 0.02,
+                              'quotas': {'slow': 1}})
+        done = []
+        busy = []
+        def on_result(tag, cursor):
+            done.append(tag)
+            busy.append(db._pool._tag_busy['slow'])
+            if len(done) == 16:
+                self.stop()
+        for i in range(8):
+            db.execute('SELECT 1', callback=functools.partial(on_result, 'slow'), tag='slow')
+        for i in range(8):
+            db.execute('SELECT 2', callback=functools.partial(on_result, None))
+        self.wait()
+        # the other operations didn't wait for the slow ones
+        self.assertEqual(done[-6:], ['slow'] * 6)
+        self.assertTrue(max(busy) <= 1)
+        self.assertEqual(len(db._pool._tag_waiting['slow']), 0)
+        db.close()
+
+        # operations that waited for their quota were already let through by
+        # the circuit breaker
+        breaker = momoko.CircuitBreaker(reset_timeout=10)
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'min_conn': 2, 'latency': 0.02, 'quotas': {'slow': 1},
+                              'circuit_breaker': breaker})
+        results = []
+        def on_slow(cursor, error=None):
+            results.append(error)
+            if len(results) == 2:
+                self.stop()
+        for i in range(2):
+            db.execute('SELECT 1', callback=on_slow, tag='slow')
+        breaker._open()
+        self.wait()
+        self.assertEqual((results, breaker.rejected), ([None, None], 0))
+        db.close()
+
+        # operations that wait for a new connection count for the quota
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 0,
+            'max_conn': 5,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'quotas': {'slow': 1}
+        })
+        del results[:]
+        on_slow = lambda cursor: (results.append(cursor.connection),
+                                  len(results) == 5 and self.stop())
+        for i in range(5):
+            db.execute('SELECT 1', callback=on_slow, tag='slow')
+        self.wait()
+        self.assertEqual((len(set(results)), len(db._pool._pool)), (1, 1))
+        self.assertEqual(db._pool._tag_connecting['slow'], 0)
+        db.close()
+
+    def test_array_fetcher(self):
+        """Test fetching arrays in a worker thread.
+        """
+        try:
+            import numpy
+        except ImportError:
+            return
+        from momoko.arrays import AsyncArrayFetcher
+
+        fetcher = AsyncArrayFetcher({
+            'host': settings.host,
+            'port': settings.port,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 1,
+        }, self.io_loop)
+        fetcher.fetch('SELECT i FROM generate_series(1, %s) AS i', (3,), callback=self.stop)
+        self.assertEqual(list(self.wait()['i']), [1, 2, 3])
+        fetcher.fetch('SELECT i FROM momoko_missing', callback=lambda result, error: self.stop(error))
+        self.assertTrue(isinstance(self.wait(), psycopg2.ProgrammingError))
+        # the connection is rolled back after the error
+        fetcher.fetch('SELECT 1::int8 AS n', callback=self.stop)
+        self.assertEqual(list(self.wait()['n']), [1])
+        worker = fetcher._worker
+        fetcher.close()
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+
+    def test_host_budget(self):
+        """Test sharing a connection budget between pools and processes.
+        """
+        import os
+        import shutil
+        import tempfile
+        from momoko.budget import HostBudget
+        from momoko.testing import FakeAsyncClient
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'budget')
+            budget = HostBudget(path, total=3, check_interval=0.05)
+
+            # a process that dies with two connections
+            pid = os.fork()
+            if pid == 0:
+                # never return into the test runner
+                status = 1
+                try:
+                    HostBudget(path, total=3).acquire(2)
+                    status = 0
+                finally:
+                    os._exit(status)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(budget.status()['processes'], {pid: 2})
+
+            db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                                  'min_conn': 1, 'max_conn': 5, 'latency': 0.02,
+                                  'budget': budget})
+            done = []
+            def on_result(cursor):
+                done.append(cursor.connection)
+                if len(done) == 10:
+                    self.stop()
+            for i in range(10):
+                db.execute('SELECT 1', callback=on_result)
+            self.wait()
+            self.assertEqual(len(set(done)), 3)
+            self.assertEqual(budget.status()['processes'], {os.getpid(): 3})
+
+            # the idle connections of the first pool are given to the second
+            other = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                                     'min_conn': 0, 'budget': budget})
+            other.execute('SELECT 1', callback=self.stop)
+            self.assertEqual(self.wait().fetchall(), [(1,)])
+            self.assertTrue(budget.denied > 0)
+            self.assertEqual(len(db._pool._pool), 1)
+
+            db.close()
+            other.close()
+            self.assertEqual(budget.status()['used'], 0)
+            budget.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_retry_policy(self):
+        """Test retrying idempotent operations.
+        """
+        from momoko.testing import FakeAsyncClient
+        from momoko.retry import is_transient_error
+
+        policy = momoko.RetryPolicy(max_attempts=10, base_delay=0.001)
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'failure_rate': 0.5, 'seed': 1, 'retry_policy': policy})
+        for i in range(5):
+            db.execute('SELECT 1', callback=self.stop, idempotent=True)
+            self.assertEqual(self.wait().fetchall(), [(1,)])
+        self.assertTrue(policy.retries > 0)
+        db.close()
+
+        policy = momoko.RetryPolicy(base_delay=0.001, budget_ratio=0,
+                                    budget_per_second=0, max_budget=1)
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0,
+                              'failure_rate': 1, 'retry_policy': policy})
+        on_error = lambda cursor, error=None: self.stop(error)
+        db.execute('SELECT 1', callback=on_error)
+        self.assertTrue(isinstance(self.wait(), psycopg2.OperationalError))
+        self.assertEqual(policy.retries, 0)
+
+        # the budget allows one retry
+        db.execute('SELECT 1', callback=on_error, idempotent=True)
+        self.assertTrue(isinstance(self.wait(), psycopg2.OperationalError))
+        self.assertEqual((policy.retries, policy.exhausted), (1, 1))
+        db.close()
+
+        # SQL errors aren't retried
+        policy = momoko.RetryPolicy(base_delay=0.001)
+        self.db._pool._retry_policy = policy
+        self.db.execute('SELECT * FROM momoko_does_not_exist', callback=on_error,
+                        idempotent=True)
+        self.assertFalse(is_transient_error(self.wait()))
+        self.db.execute("DO $$ BEGIN RAISE EXCEPTION 'conflict' USING ERRCODE = '40001'; END $$",
+                        callback=on_error)
+        self.assertTrue(is_transient_error(self.wait()))
+        self.assertEqual(policy.retries, 0)
+        self.db._pool._retry_policy = None
+
+    def test_circuit_breaker(self):
+        """Test rejecting operations while the database is unreachable.
+        """
+        breaker = momoko.CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        db = momoko.AsyncClient({
+            'host': settings.host,
+            'port': 1,
+            'database': settings.database,
+            'user': settings.user,
+            'password': settings.password,
+            'min_conn': 0,
+            'cleanup_timeout': 0,
+            'ioloop': self.io_loop,
+            'circuit_breaker': breaker
+        })
+        on_error = lambda cursor, error=None: self.stop(error)
+        for i in range(2):
+            db.execute('SELECT 1', callback=on_error)
+            self.assertTrue(isinstance(self.wait(), psycopg2.OperationalError))
+        self.assertEqual(breaker.state, 'open')
+
+        errors = []
+        db.execute('SELECT 1', callback=lambda cursor, error: errors.append(error))
+        self.assertTrue(isinstance(errors[0], momoko.CircuitOpenError))
+        self.assertEqual(breaker.status()['rejected'], 1)
+
+        # a failed probe opens the breaker again
+        time.sleep(0.1)
+        self.assertEqual(breaker.state, 'half-open')
+        db.execute('SELECT 1', callback=on_error)
+        db.execute('SELECT 1', callback=lambda cursor, error: errors.append(error))
+        self.assertTrue(isinstance(self.wait(), psycopg2.OperationalError))
+        self.assertEqual((breaker.state, len(errors)), ('open', 2))
+
+        # a successful probe closes it
+        time.sleep(0.1)
+        db._pool._kwargs['port'] = settings.port
+        db.execute('SELECT 42', callback=self.stop)
+        self.assertEqual(self.wait().fetchall(), [(42,)])
+        self.assertEqual(breaker.state, 'closed')
+
+        # a probe that fails before it's sent gives its place back
+        breaker._open()
+        time.sleep(0.1)
+        self.assertRaises(IndexError, db.execute, 'SELECT %s', (), callback=self.stop)
+        db.execute('SELECT 42', callback=self.stop)
+        self.assertEqual(self.wait().fetchall(), [(42,)])
+        self.assertEqual(breaker.state, 'closed')
+        db.close()
+
+        # a probe without a result expires
+        breaker = momoko.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record(psycopg2.OperationalError())
+        time.sleep(0.05)
+        self.assertEqual((breaker.allow_request(), breaker.allow_request()), (True, False))
+        time.sleep(0.05)
+        self.assertTrue(breaker.allow_request())
+
+    def test_query_stats(self):
+        """Test statistics per fingerprint and the slow query log.
+        """
+        import logging
+        from momoko.stats import fingerprint
+
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'"),
+                         'SELECT * FROM t WHERE id IN (?) AND name = ?')
+        self.assertEqual(fingerprint("INSERT INTO t VALUES (1, 'it''s'),\n (-2.5, %s)"),
+                         'INSERT INTO t VALUES (?)')
+
+        logged = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                logged.append(record.getMessage())
+        handler = Handler()
+        logging.getLogger('momoko.slow').addHandler(handler)
+
+        stats = momoko.QueryStats(max_entries=2, slow_threshold=0.05)
+        self.db.add_listener(stats)
+        try:
+            for query in ("SELECT 'secret', pg_sleep(0.05)", 'SELECT 1/0',
+                          "SELECT 'other', pg_sleep(0)", 'SELECT generate_series(1, 3)'):
+                self.db.execute(query, callback=lambda cursor, error=None: self.stop())
+                self.wait()
+        finally:
+            logging.getLogger('momoko.slow').removeHandler(handler)
+
+        self.assertEqual(stats.evicted, 1)
+        self.assertEqual(stats.get('SELECT 1/0'), None)
+        entry = stats.get("SELECT 'x', pg_sleep(1)")
+        self.assertEqual(entry['calls'], 2)
+        self.assertEqual(entry['rows'], 2)
+        self.assertTrue(entry['max_time'] >= 0.05)
+        self.assertEqual(stats.top(1)[0]['fingerprint'], 'SELECT ?, pg_sleep(?)')
+        self.assertEqual(len(logged), 1)
+        self.assertTrue('SELECT ?, pg_sleep(?)' in logged[0])
+        self.assertFalse('secret' in logged[0])
+
+    def test_explain_slow_queries(self):
+        """Test EXPLAIN of slow queries and plan change tracking.
+        """
+        plans = []
+        sampler = self.db.explain_slow_queries(threshold=0, sample_rate=1, max_per_minute=3)
+        sampler.on_plan = lambda event, fingerprint, plan, changed: (
+            plans.append((event, fingerprint, changed)), self.stop())
+        recorder = []
+        self.db.add_listener(type('Recorder', (object,), {
+            'on_execute': lambda self, event: recorder.append(event.query)})())
+
+        self.db.execute('SELECT 1 WHERE %s', (True,), callback=lambda cursor: None)
+        self.wait()
+        event, fingerprint, changed = plans[0]
+        self.assertEqual(fingerprint, 'SELECT ? WHERE ?')
+        self.assertEqual(event.data['plan'][0]['Plan']['Node Type'], 'Result')
+        self.assertFalse(changed)
+        self.assertEqual(recorder, ['SELECT 1 WHERE %s'])
+
+        # the same fingerprint with a plan that depends on the parameter
+        sampler.threshold = 1
+        self.db.execute('DROP TABLE IF EXISTS momoko_plan; '
+                        'CREATE TABLE momoko_plan (id int PRIMARY KEY); '
+                        'INSERT INTO momoko_plan SELECT generate_series(1, 10000); '
+                        'ANALYZE momoko_plan', callback=self.stop)
+        self.wait()
+        sampler.threshold = 0
+        query = 'SELECT count(*) FROM momoko_plan WHERE id < %s'
+        self.db.execute(query, (5,), callback=lambda cursor: None)
+        self.wait()
+        self.db.execute(query, (10000,), callback=lambda cursor: None)
+        self.wait()
+        self.assertTrue(plans[-1][2])
+        self.assertEqual(sampler.plans['SELECT count(*) FROM momoko_plan WHERE id < ?']['changes'], 1)
+
+        # the cap is reached
+        self.db.execute('SELECT 3', callback=self.stop)
+        self.wait()
+        self.io_loop.add_timeout(time.time() + 0.1, self.stop)
+        self.wait()
+        self.assertEqual(len(plans), 3)
+
+        # the default on_plan logs the slow query with its plan
+        import logging
+        logged = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                logged.append(record.getMessage())
+        handler = Handler()
+        logging.getLogger('momoko.slow').addHandler(handler)
+        try:
+            event, fingerprint, changed = plans[-1]
+            momoko.stats.ExplainSampler.on_plan(sampler, event, fingerprint,
+                                                event.data['plan'], changed)
+        finally:
+            logging.getLogger('momoko.slow').removeHandler(handler)
+        self.assertTrue(fingerprint in logged[0])
+        self.assertTrue('"Node Type"' in logged[0])
+        self.assertTrue(event.data['plan_hash'] in logged[0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -34,6 +34,100 @@ class BlockingClientTest(unittest.TestCase):
 
         self.assertEqual(cursor.fetchall(), [(42, 12, 40, 11)])
 
+    def test_fetch_array(self):
+        """Test fetching a result into NumPy arrays.
+        """
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        query = ("SELECT i, i * 0.5::float8 AS half, i %% 2 = 0 AS even, "
+                 "'2012-01-01'::date + i AS day FROM generate_series(1, %s) AS i")
+        result = self.db.fetch_array(query, (1000,))
+        self.assertEqual(result.dtype.names, ('i', 'half', 'even', 'day'))
+        self.assertEqual(result['i'].dtype, numpy.dtype('i4'))
+        self.assertEqual(list(result['i'][:3]), [1, 2, 3])
+        self.assertEqual(result['half'][9], 5.0)
+        self.assertEqual(result['even'].sum(), 500)
+        self.assertEqual(str(result['day'][0]), '2012-01-02')
+
+        result = self.db.fetch_array('SELECT NULLIF(i, 2)::float8 AS f, '
+                                     "NULLIF(now(), now()) AS t FROM generate_series(1, 3) AS i",
+                                     columns=True)
+        self.assertTrue(numpy.isnan(result['f'][1]))
+        self.assertEqual(list(result['f'][[0, 2]]), [1.0, 3.0])
+        self.assertTrue(numpy.isnat(result['t']).all())
+
+        self.assertRaises(ValueError, self.db.fetch_array, 'SELECT NULL::int')
+
+    def test_array_parameters(self):
+        """Test NumPy arrays and ``array.array`` as parameters and COPY.
+        """
+        from array import array
+        from collections import OrderedDict
+        try:
+            import numpy
+        except ImportError:
+            return
+        from momoko import arrays
+        arrays.register_adapters()
+
+        with self.db.connection as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT %s, %s, %s', (numpy.arange(3), numpy.array([0.5, numpy.nan]),
+                                                 array('h', [1, 2])))
+            ints, floats, shorts = cursor.fetchone()
+            cursor.execute('SELECT %s', (numpy.array([True, False]),))
+            bools, = cursor.fetchone()
+        self.assertEqual(ints, [0, 1, 2])
+        self.assertEqual(floats[0], 0.5)
+        self.assertTrue(floats[1] != floats[1])
+        self.assertEqual(shorts, [1, 2])
+        self.assertEqual(bools, [True, False])
+
+        with self.db.connection as conn:
+            cursor = conn.cursor()
+            cursor.execute('DROP TABLE IF EXISTS momoko_array_test; '
+                           'CREATE TABLE momoko_array_test (t timestamp, v float4, n int8)')
+
+        columns = OrderedDict()
+        columns['t'] = numpy.array(['2012-01-01T00:00:00', '2012-01-01T00:00:01'], 'M8[us]')
+        columns['v'] = numpy.array([1.5, 2.5])
+        columns['n'] = numpy.array([1, 2], 'i2')
+        self.assertEqual(self.db.copy_arrays('momoko_array_test', columns), 2)
+
+        result = self.db.fetch_array('SELECT t, v, n FROM momoko_array_test ORDER BY n')
+        self.assertEqual(list(result['n']), [1, 2])
+        self.assertEqual(list(result['v']), [1.5, 2.5])
+        self.assertEqual(list(result['t']), list(columns['t']))
+
+        columns['t'][1] = numpy.datetime64('NaT')
+        columns['v'][0] = numpy.nan
+        columns['n'] = numpy.array([3, 4])
+        self.assertEqual(self.db.copy_arrays(('public', 'momoko_array_test'), columns), 2)
+        with self.db.connection as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT t IS NULL, v IS NULL FROM momoko_array_test '
+                           'WHERE n > 2 ORDER BY n')
+            self.assertEqual(cursor.fetchall(), [(False, True), (True, False)])
+
+    def test_array_fallback(self):
+        """Test adapting ``array.array`` without NumPy.
+        """
+        from array import array
+        from momoko import arrays
+        arrays.register_adapters()
+
+        numpy, arrays.numpy = arrays.numpy, None
+        try:
+            with self.db.connection as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT %s, %s', (array('L', [1, 2]), array('d', [0.1, 2.5])))
+                self.assertEqual(cursor.fetchone(), ([1, 2], [0.1, 2.5]))
+        finally:
+            arrays.numpy = numpy
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,13 +2,16 @@
 import unittest
 import os, sys
 import time
+import functools
+
+import psycopg2
 
 import momoko
 from momoko.adisp import process, async
 from tornado.testing import AsyncTestCase
 from tornado import ioloop
 
-from momoko.queue import DbQueryQueue
+from momoko.queue import DbQueryQueue, QueueFull
 
 import settings
 
@@ -49,6 +52,157 @@ class DbQueueTestCase(AsyncTestCase):
         sql = self.db_queue.format_sql('SELECT %(one)s, %(two)s', {'one': 1, 'two': 2})
         self.assertEqual(sql, 'SELECT 1, 2')
 
+        params = {'a': u'привет', 'b': None, 'c': True, 'd': -1.5, 'e': float('nan'), 'f': -3L}
+        sql = self.db_queue.format_sql('%(a)s %(b)s %(c)s %(d)s %(e)s %(f)s', params)
+        self.assertEqual(sql, "'привет' NULL true  -1.5 'NaN'::float  -3")
+        self.assertEqual(params['a'], u'привет')
+
+    def test_bind_params(self):
+        self.db_queue.stop()
+        self.db_queue = DbQueryQueue(self.db, self.io_loop, poll_timeout=0.1, bind_params=True)
+        self.db_queue.start()
+
+        self.db_queue.fetchone("SELECT %s, '%%'", (u'привет',), callback=self.stop)
+        self.assertEqual(self.wait(), (u'привет', u'%'))
+
+        q = self.db_queue
+        q.execute_noresult('INSERT INTO t (a) VALUES (%s)', (1,))
+        q.execute_noresult('INSERT INTO t (a) VALUES (%s)', (2,))
+        q.execute_noresult("INSERT INTO t (a) VALUES ('%')")
+        q.execute_noresult('UPDATE t SET a = %(a)s', {'a': 3})
+        sql, params = q.join_noresult(q.noresult_queue.values())
+        q.noresult_queue.clear()
+        self.assertEqual(sql, "INSERT INTO t (a) VALUES (%s),\n(%s),\n('%%');\nUPDATE t SET a = 3")
+        self.assertEqual(params, (1, 2))
+
+    def test_merge_inserts(self):
+        q = self.db_queue
+        for i in xrange(3):
+            q.execute_noresult('INSERT INTO t (a, b) VALUES (%s, now())', (i,))
+        q.execute_noresult('UPDATE t SET a = 1')
+        q.execute_noresult("insert into t (a, b)\n values (%s, ')')", (u'x',))
+        q.execute_noresult('INSERT INTO t (a) VALUES (1), (2)')
+        q.execute_noresult('INSERT INTO t (a) VALUES (%s) RETURNING a', (1,))
+
+        sql, params = q.join_noresult(q.noresult_queue.values())
+        q.noresult_queue.clear()
+        self.assertEqual(params, None)
+        self.assertEqual(sql.split(';\n'), [
+            'INSERT INTO t (a, b) VALUES (0, now()),\n(1, now()),\n(2, now())',
+            'UPDATE t SET a = 1',
+            "insert into t (a, b) values ('x', ')')",
+            'INSERT INTO t (a) VALUES (1), (2)',
+            'INSERT INTO t (a) VALUES (1) RETURNING a',
+        ])
+
+        # rows with a different number of values aren't merged
+        q.execute_noresult('INSERT INTO t VALUES (%s)', (1,))
+        q.execute_noresult('INSERT INTO t VALUES (%s, %s)', (2, 3))
+        q.execute_noresult("INSERT INTO t VALUES (4, '5, 6')")
+        q.execute_noresult('INSERT INTO t VALUES (coalesce(%s, 7), 8)', (None,))
+        sql, params = q.join_noresult(q.noresult_queue.values())
+        q.noresult_queue.clear()
+        self.assertEqual(sql.split(';\n'), [
+            'INSERT INTO t VALUES (1)',
+            "INSERT INTO t VALUES (2, 3),\n(4, '5, 6'),\n(coalesce(NULL, 7), 8)",
+        ])
+
+    def test_merged_inserts_execute(self):
+        self.db.execute('DROP TABLE IF EXISTS momoko_queue_test; '
+                        'CREATE TABLE momoko_queue_test (a integer);', callback=self.stop)
+        self.wait()
+
+        expected = range(50)
+        def after_execute():
+            expected.pop()
+            if not expected:
+                self.stop()
+
+        for i in xrange(50):
+            self.db_queue.execute_noresult('INSERT INTO momoko_queue_test (a) VALUES (%s)', (i,),
+                                           callback=after_execute)
+        self.db_queue.execute_noresult_queue()
+        self.wait()
+
+        self.db.execute('SELECT count(*), sum(a) FROM momoko_queue_test', callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.fetchone(), (50, sum(range(50))))
+
+    def test_noresult_bisection(self):
+        self.db.execute('DROP TABLE IF EXISTS momoko_queue_test; '
+                        'CREATE TABLE momoko_queue_test (a integer);', callback=self.stop)
+        self.wait()
+
+        results = {}
+        def after_execute(i, error=None):
+            results[i] = error
+            if len(results) == 20:
+                self.stop()
+
+        for i in xrange(20):
+            value = 'bad' if i in (3, 15) else i
+            self.db_queue.execute_noresult('INSERT INTO momoko_queue_test (a) VALUES (%s)', (value,),
+                                           callback=functools.partial(after_execute, i))
+        self.db_queue.execute_noresult_queue()
+        self.wait()
+
+        self.assertEqual(sorted(i for i, error in results.items() if error), [3, 15])
+        self.assertTrue(isinstance(results[3], psycopg2.DataError))
+        self.assertEqual(self.db_queue.stats()['noresult_failed'], 2)
+
+        self.db.execute('SELECT count(*) FROM momoko_queue_test', callback=self.stop)
+        cursor = self.wait()
+        self.assertEqual(cursor.fetchone(), (18,))
+
+    def test_noresult_connection_error(self):
+        from momoko.testing import FakeAsyncClient
+
+        db = FakeAsyncClient({'ioloop': self.io_loop, 'cleanup_timeout': 0, 'failure_rate': 1})
+        q = DbQueryQueue(db, self.io_loop)
+        errors = []
+        def after_execute(error=None):
+            errors.append(error)
+            if len(errors) == 4:
+                self.stop()
+
+        for i in xrange(4):
+            q.execute_noresult('INSERT INTO t (a) VALUES (%s)', (i,), callback=after_execute)
+        q.execute_noresult_queue()
+        self.wait()
+        self.assertTrue(all(isinstance(e, psycopg2.OperationalError) for e in errors))
+        self.assertEqual((q.stats()['noresult_bisected'], db._pool._pool[0].queries), (0, 1))
+        db.close()
+
+    def test_loader(self):
+        loader = self.db_queue.loader('SELECT k %% 2, k FROM unnest(%s) AS k', many=True)
+        results = {}
+
+        def on_rows(key, rows):
+            results[key] = rows
+            if len(results) == 3:
+                self.stop()
+
+        for key in (0, 1, 2):
+            loader.load(key, functools.partial(on_rows, key))
+        self.wait()
+        self.assertEqual(results, {0: [(0, 0), (0, 2)], 1: [(1, 1)], 2: []})
+
+    def test_loader_error(self):
+        loader = self.db_queue.loader('SELECT k FROM unnest(%s) AS k WHERE 1 / 0 = k')
+        results = []
+
+        def on_row(*args):
+            results.append(args)
+            if len(results) == 2:
+                self.stop()
+
+        for key in (1, 2):
+            loader.load(key, on_row)
+        self.wait()
+        self.assertTrue(all(row is None and isinstance(error, psycopg2.DataError)
+                            for row, error in results))
+        self.assertEqual(loader._cache, {})
+
     def test_fetchall(self):
         expected = []
 
@@ -63,6 +217,116 @@ class DbQueueTestCase(AsyncTestCase):
 
         self.wait()
 
+    def test_strict_priority(self):
+        self.db_queue.stop()
+        self.db_queue = DbQueryQueue(self.db, self.io_loop, poll_timeout=0.2, queue_length=1,
+                                     priorities={0: 1, 1: 1}, scheduling='strict')
+        order = []
+
+        def after_fetch(data):
+            order.append(data[0])
+            if len(order) == 5:
+                self.stop()
+
+        for i in xrange(3):
+            self.db_queue.fetchone('SELECT %s', ('low',), callback=after_fetch, priority=1)
+        for i in xrange(2):
+            self.db_queue.fetchone('SELECT %s', ('high',), callback=after_fetch, priority=0)
+        self.db_queue.start()
+        self.wait()
+        self.assertEqual(order, ['high', 'high', 'low', 'low', 'low'])
+
+    def test_default_priority(self):
+        q = DbQueryQueue(self.db, self.io_loop, priorities={0: 1, 1: 1})
+        q.fetchone('SELECT 1', callback=None)
+        q.fetchone('SELECT 0', callback=None, priority=0)
+        self.assertEqual(len(q.queues[1]), 1)
+        self.assertEqual([item[0] for item in q.queue.values()], ['SELECT 0', 'SELECT 1'])
+
+        q = DbQueryQueue(self.db, self.io_loop)
+        q.fetchone('SELECT 1', callback=None)
+        self.assertTrue(q.queue is q.queues[0])
+
+    def test_weighted_priority(self):
+        q = DbQueryQueue(self.db, self.io_loop, queue_length=4, priorities={0: 2, 1: 1}, reserved=1)
+        for i in xrange(6):
+            q.fetchone('SELECT 1', callback=None, priority=1)
+            q.fetchone('SELECT 0', callback=None, priority=0)
+
+        order = []
+        for i in xrange(9):
+            priority = q.next_priority()
+            q.queues[priority].popitem(last=False)
+            order.append(priority)
+        self.assertEqual(order, [0, 1, 0, 0, 1, 0, 0, 1, 0])
+
+        # only the reserved slot is left for lower classes
+        q.running_low = 3
+        self.assertEqual(q.next_priority(), None)
+        q.fetchone('SELECT 0', callback=None, priority=0)
+        self.assertEqual(q.next_priority(), 0)
+
+    def test_overflow_reject(self):
+        q = DbQueryQueue(self.db, self.io_loop, max_items=2, noresult_max_bytes=20)
+        q.fetchone('SELECT 1', callback=None)
+        q.fetchone('SELECT 2', callback=None)
+        self.assertRaises(QueueFull, q.fetchone, 'SELECT 3', callback=None)
+
+        q.execute_noresult('SELECT 1')
+        q.execute_noresult('SELECT 2')
+        self.assertRaises(QueueFull, q.execute_noresult, 'SELECT 3')
+
+        stats = q.stats()
+        self.assertEqual(stats['queued'], 2)
+        self.assertEqual(stats['noresult_queued'], 2)
+        self.assertEqual(stats['noresult_bytes'], 16)
+        self.assertEqual(stats['rejected'], 2)
+
+    def test_overflow_drop_oldest(self):
+        q = DbQueryQueue(self.db, self.io_loop, max_items=2, priorities={0: 1, 1: 1},
+                         overflow='drop_oldest')
+        dropped = []
+        q.fetchone('SELECT 1', callback=dropped.append, priority=1)
+        q.fetchone('SELECT 2', callback=None, priority=0)
+        q.fetchone('SELECT 3', callback=None, priority=0)
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+        self.assertEqual(dropped, [None])
+        self.assertEqual(q.stats()['dropped'], 1)
+        self.assertEqual([i[0] for i in q.queues[0].values()], ['SELECT 2', 'SELECT 3'])
+        self.assertFalse(q.queues[1])
+
+        # a less important query doesn't push out more important ones
+        self.assertRaises(QueueFull, q.fetchone, 'SELECT 4', callback=None, priority=1)
+        q = DbQueryQueue(self.db, self.io_loop, max_items=0, overflow='drop_oldest')
+        self.assertRaises(QueueFull, q.fetchone, 'SELECT 1', callback=None)
+
+    def test_overflow_block(self):
+        self.db_queue.stop()
+        self.db_queue = DbQueryQueue(self.db, self.io_loop, poll_timeout=0.1, max_items=1,
+                                     overflow='block')
+        results = []
+
+        def done(result):
+            results.append(result)
+            if len(results) == 3:
+                self.stop()
+
+        self.db_queue.fetchone('SELECT %s', (1,), callback=lambda data: done(data[0]))
+        self.db_queue.fetchone('SELECT %s', (2,), callback=lambda data: done(data[0]))
+        self.db_queue.wait_for_space(lambda: done('space'))
+        self.assertEqual(self.db_queue.stats()['parked'], 1)
+        self.assertEqual(self.db_queue.stats()['parked_bytes'], len('SELECT 2'))
+        # the parking is full too
+        self.assertRaises(QueueFull, self.db_queue.fetchone, 'SELECT 3', callback=None)
+
+        self.db_queue.start()
+        self.wait()
+        self.assertTrue('space' in results)
+        self.assertEqual([r for r in results if r != 'space'], [1, 2])
+        self.assertEqual(self.db_queue.stats()['parked'], 0)
+
     def test_query_without_result(self):
         sql = ''
         expected = []